@@ -6,9 +6,20 @@ See: https://github.com/linuxkidd/cw2mqtt
 __version__ = "0.9"
 __author__ = "Michael J. Kidd"
 
-from dataclasses import dataclass
-import math, serial, time
-from typing import Dict, Optional
+from dataclasses import asdict, dataclass, fields
+from array import array
+import json, math, select, threading, time
+try:
+    import serial
+except ImportError:
+    # Decoding and replay work without pyserial
+    serial = None
+from typing import Callable, Dict, Optional
+
+from .derived import DerivedMetrics, adjusted_sky
+from .metrics import Metrics
+from .profiling import phase
+from .readings import Reading, Sensor
 
 
 @dataclass
@@ -47,8 +58,98 @@ class SkyTemperatureModel:
     K6: float
     K7: float
 
+    @classmethod
+    def parse(cls, spec: str) -> "SkyTemperatureModel":
+        '''
+        K1,...,K7 or the path of a JSON file holding them by name, as
+        written by CloudWatcher.skymodel fit
+        '''
+        if "," in spec:
+            return cls(*[ float(k) for k in spec.split(",") ])
+        with open(spec) as f:
+            data = json.load(f)
+        return cls(*[ float(data[field.name]) for field in fields(cls) ])
+
+    def save(self, path: str, **extra) -> None:
+        with open(path, "w") as f:
+            json.dump({ **asdict(self), **extra }, f, indent=2)
+            f.write("\n")
+
+# Coefficients suggested by Lunatico for the clouds value
+lunatico_sky_temperature_model = SkyTemperatureModel(30, 200, 6, 140, 100, 0, 0)
+
 default_sky_temperature_model = SkyTemperatureModel(100,0,0,0,0,0,0)
 
+# Every response from the unit is made of 15 byte blocks starting with '!'
+# and ends with the handshake block, which starts with '!' 0x11
+BLOCK_SIZE = 15
+HANDSHAKE = b"\x21\x11"
+# Analog readings come from a 10 bit ADC
+ADC_STEPS = 1024
+# Rain frequency and switch state, polled between sweeps for safety alerts
+SAFETY_COMMANDS = [ b"E!", b"F!" ]
+# Most bytes taken from the port by one read
+READ_SIZE = 4096
+# Read timeout of ports select() cannot wait on ( Windows ), seconds
+POLL = 0.05
+
+def parse_int(packet: bytes, start: int = 2, end: int = BLOCK_SIZE) -> int:
+    '''
+    Decode the ASCII number in packet[start:end].
+
+    int() accepts bytes ( and memoryview ) directly and ignores the padding
+    spaces, so no intermediate str is created.
+    '''
+    return int(packet[start:end])
+
+def command_name(cmd: bytes) -> str:
+    '''
+    cmd as the metrics count it, P####! under P! whatever the level
+    '''
+    return str(cmd[:1] + b"!", "ascii") if len(cmd) > 2 else str(cmd, "ascii")
+
+def is_address(port: str) -> bool:
+    '''
+    Whether port is the address of a CloudWatcher.share daemon rather than
+    a serial port
+    '''
+    return port.startswith(( "unix:", "tcp:" ))
+
+# Descriptors of every reading the handlers produce
+SKY_IR          = Sensor("skyir", "Sky IR Temp", "degC", prefix=b"1")
+AMBIENT_IR      = Sensor("ambir", "Ambient IR Temp", "degC", prefix=b"2")
+AMBIENT_NTC     = Sensor("temp", "NTC Ambient Temp", "degC", prefix=b"3")
+LIGHT           = Sensor("light", None, "kOhm", prefix=b"4")
+RAIN_NTC        = Sensor("temp", "Rain Sensor NTC Temperature", "degC", prefix=b"5")
+ZENER_VOLTAGE   = Sensor("zvolt", "Zener Voltage", "V", prefix=b"6")
+SQM             = Sensor("mpsas", "SQM", "mpsas", prefix=b"8")
+HUMIDITY        = Sensor("hum", "Humidity", "%", prefix=b"h")
+HUMIDITY_HR     = Sensor("hum", "Humidity", "%", prefix=b"hh")
+SERIAL_NUMBER   = Sensor("serial", "Serial Number")
+ZENER_CONSTANT  = Sensor("zener_voltage", "Zener Constant")
+LDR_MAX         = Sensor("LDRMaxResistance", "LDR Max Resistance")
+LDR_PULL_UP     = Sensor("LDRPullUpResistance", "LDR Pull Up Resistance")
+RAIN_BETA       = Sensor("RainBeta", "Rain Beta")
+RAIN_R25        = Sensor("RainResAt25", "Rain Resistance at 25C")
+RAIN_PULL_UP    = Sensor("RainPullUpResistance", "Rain Pull Up Resistance")
+SHUTDOWN_DELAY  = Sensor("auto_shutdown_dealy", "Auto Shutdown Delay", "seconds")
+SHUTDOWN_SWITCH = Sensor("auto_shutdown_switch", "Auto Shutdown Switch State")
+SHUTDOWN_HEAT   = Sensor("auto_shutodwn_heater", "Auto Shutdown Rain Heat Level", "%")
+DEVICE_NAME     = Sensor("name", "Device Name")
+ABS_PRESSURE    = Sensor("abspress", "Absolute Pressure", "hPa", prefix=b"p")
+PWM             = Sensor("pwm", "PWM Level", "%", prefix=b"Q")
+ATM_TEMP        = Sensor("atmtemp", "Temperature at Atm Press Sensor", "degC", prefix=b"q")
+RAIN_FREQ       = Sensor("rain_freq", "Rain Sensor Frequency", "Hz", prefix=b"R")
+HUM_TEMP        = Sensor("hum_temp", "Temperature at Humidity Sensor", "degC", prefix=b"t")
+HUM_TEMP_HR     = Sensor("hum_temp", "Temperature at Humidity Sensor", "degC", prefix=b"th")
+FW_VERSION      = Sensor("version", "FW Version")
+WIND_PRESENT    = Sensor("windpresent", "Wind Sensor Present?")
+WIND            = Sensor("wind", "Wind Speed", "km/h", prefix=b"w")
+WIND_RAW        = Sensor("wind", bare=True)
+SWITCH          = Sensor("switch", "Switch State")
+# Blocks no handler knows, keyed by prefix
+unknown_sensors: Dict[ str, Sensor ] = {}
+
 class CloudWatcherException(Exception):
     pass
 
@@ -57,24 +158,70 @@ class CloudWatcher:
     analog_cache: CWAnalogCache
     auto_shutdown: Auto_Shutdown
     constants: CWConstants
+    derived: DerivedMetrics
     errors: int
     HASL: float
-    serial: serial.Serial
+    serial: Optional[ "serial.Serial" ]
     has8: bool
-
-    def __init__(self, port: str, HASL: float):
+    max_wait: float = 5
+    rxbuf: bytearray
+    handlers: Dict[ bytes, Callable ]
+    metrics: Metrics
+    # Held for every exchange with the unit, commands may come from several threads
+    lock: threading.RLock
+    amb_table: Optional[array]
+    rain_table: Optional[array]
+    ldr_table: Optional[array]
+    # Anything with a write(result) method, e.g. tslog.TimeSeriesLog
+    recorder = None
+    # Anything with a write(block) method, e.g. tslog.CaptureLog
+    capture = None
+    # Anything with an observe(result) method, e.g. heater.HeaterController
+    heater = None
+    # Anything with a phase(name) context manager, e.g. profiling.Profiler
+    profiler = None
+    # Dirty reads in a row which take the link down, 0 never does
+    error_limit: int = 3
+    # Seconds before reopening the port, doubled after every failed attempt
+    min_backoff: float = 1
+    max_backoff: float = 10
+    # Called with True or False as the link comes up or goes down
+    on_link: Optional[ Callable[ [bool], None ] ] = None
+
+    def __init__(self, port: Optional[str], HASL: float):
+        '''
+        With port None there is no serial port, only decoding ( process_block
+        and the process_* handlers ) works, e.g. to replay captures.
+        '''
         self.errors = 0
+        self.port = port
+        self.link_up = True
+        self.backoff = self.min_backoff
+        self.retry_at = 0.0
         self.has8 = False
+        self.rxbuf = bytearray()
+        self.metrics = Metrics()
+        self.lock = threading.RLock()
+        self.invalidate_tables()
+        self.handlers = { k: f.__get__(self) for k, f in self.dispatch_table().items() }
         self.HASL = HASL
         self.ambient_temp = -999
-        self.serial = serial.Serial(
-            port = port,
-            baudrate = 9600,
-            parity = serial.PARITY_NONE,
-            bytesize = serial.EIGHTBITS,
-            xonxoff = False,
-            timeout = 2,
-        )
+        self.derived = DerivedMetrics()
+        self.derived.set("elevation", HASL)
+        if port is None:
+            self.serial = None
+        elif serial is None:
+            raise CloudWatcherException("Fatal: pyserial is not installed")
+        else:
+            self.serial = serial.Serial(
+                port = port,
+                baudrate = 9600,
+                parity = serial.PARITY_NONE,
+                bytesize = serial.EIGHTBITS,
+                xonxoff = False,
+                # Set once: every change of the timeout reconfigures the port
+                timeout = 0 if hasattr(serial.Serial, "fileno") else POLL,
+            )
         self.constants = CWConstants( 
             AbsZero = 273.15,
             AmbPullUpResistance = 9.9,
@@ -108,58 +255,269 @@ class CloudWatcher:
         self.errors = 0
 
     def close(self) -> None:
+        if self.serial is not None:
+            self.serial.close()
+
+    def reopen(self) -> None:
         self.serial.close()
+        self.open()
+        self.rxbuf.clear()
 
-    def read_block(self) -> list:
+    def link_ready(self) -> bool:
+        '''
+        Whether a command should go to the unit.  While the link is down
+        commands fail at once, except when it is time to reopen the port;
+        the first clean read after that brings the link up again.
+        '''
+        if self.link_up:
+            return True
+        now = time.monotonic()
+        if now < self.retry_at:
+            self.metrics.rejected += 1
+            return False
+        self.retry_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+        try:
+            self.reopen()
+        except CloudWatcherException:
+            print(f"{self.port}: cannot reopen, next attempt in {self.retry_at - now:g} seconds")
+            self.metrics.rejected += 1
+            return False
+        self.metrics.reconnects += 1
+        return True
+
+    def set_link(self, up: bool) -> None:
+        self.link_up = up
+        if up:
+            self.backoff = self.min_backoff
+        else:
+            self.retry_at = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        print(f"{self.port}: link {'up' if up else 'down'}")
+        if self.on_link is not None:
+            self.on_link(up)
+
+    def read_done(self, clean: bool) -> None:
+        '''
+        Count a read, taking the link down after error_limit dirty reads in
+        a row and up on a clean one
+        '''
+        if clean:
+            self.errors = 0
+            if not self.link_up:
+                self.set_link(True)
+            return
+        self.errors += 1
+        self.metrics.timeouts += 1
+        if self.link_up and self.error_limit and self.errors >= self.error_limit:
+            self.set_link(False)
+
+    def lost(self, e: Exception) -> None:
+        '''
+        The port failed, e.g. the USB adapter was unplugged: close it and
+        take the link down without waiting for timeouts.  With error_limit
+        0 nothing would reopen it, the error is raised instead.
+        '''
+        if not self.error_limit:
+            raise e
+        print(f"{self.port}: {e}")
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        if self.link_up:
+            self.set_link(False)
+
+    def read_block(self, discard: bool = True) -> Optional[ Dict[ str, Reading ] ]:
+        '''
+        Read 15 byte blocks until the handshake block ( !\x11 ) arrives.
+
+        Bytes are collected into an incremental buffer as select() reports
+        them, so this returns as soon as the handshake block is received
+        instead of polling.  Anything which does not look like a block is skipped.
+
+        With discard=False, bytes received after the handshake block are kept
+        for the next call, which is what query() relies on.
+        '''
         result = {}
-        max_wait = 5
-        start = time.time()
+        buf = self.rxbuf
+        deadline = time.monotonic() + self.max_wait
         clean = False
-        while abs(time.time() - start) < max_wait:
-            if self.serial.in_waiting >= 15:
-                block = self.serial.read(min([self.serial.in_waiting,15]))
-                if block[0:2] == b"\x21\x11":
-                    if self.serial.in_waiting > 0:
-                        junk = self.serial.read(self.serial.in_waiting)
-                    clean = True
+        while True:
+            block = self.next_block()
+            if block is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.serial.is_open:
+                    # Timed out or lost
+                    break
+                try:
+                    if not self.wait_readable(remaining):
+                        break
+                    chunk = self.serial.read(READ_SIZE)
+                except OSError as e:
+                    self.lost(e)
                     break
-                elif block[0] == 33:
+                if not chunk:
+                    continue
+                self.metrics.bytes_read += len(chunk)
+                buf += chunk
+            elif block[0:2] == HANDSHAKE:
+                if discard:
+                    buf.clear()
                     try:
-                        res = self.process_block(block)
-                    except:
-                        pass
-                    else:                        
-                        try:
-                            result.update(res)
-                        except:
-                            try:
-                                for i in res:
-                                    result.update(i)
-                            except:
-                                pass
-            time.sleep(0.05)
+                        if self.serial.in_waiting > 0:
+                            junk = self.serial.read(self.serial.in_waiting)
+                            self.metrics.bytes_read += len(junk)
+                    except OSError as e:
+                        self.lost(e)
+                        break
+                clean = True
+                break
+            else:
+                self.merge_block(result, block)
 
+        self.read_done(clean)
         if not clean:
-            self.errors += 1
+            buf.clear()
         else:
-            self.errors = 0
+            self.record(result)
             return result
 
-    def process_block(self, block: bytes) -> Dict[ str, float ]:
-        assert block[0] == 33
-        ret = str(block[1:3],'ascii').strip()
-        func = f"process_{ret}"
-        try:
-            method = getattr(self,func)
-        except:
-            ret = str(block[1:2],'ascii').strip()
-            func = f"process_{ret}"
+    def wait_readable(self, timeout: float) -> bool:
+        '''
+        Wait up to timeout seconds for bytes from the unit.  The port reads
+        without blocking, unless select() cannot wait on it and reads wait
+        up to POLL seconds instead.
+        '''
+        if self.serial.timeout:
+            return True
+        return bool(select.select([ self.serial.fileno() ], [], [], timeout)[0])
+
+    def record(self, result: dict) -> None:
+        '''
+        Log the readings of a clean result, then add the derived readings
+        which go with it, see derived, and pass it to the heater controller
+        '''
+        with phase(self.profiler, "record"):
+            if self.recorder is not None and result:
+                try:
+                    self.recorder.write(result)
+                except OSError as e:
+                    print(f"Cannot log readings: {e}")
+            self.derived.update(result)
+            if self.heater is not None:
+                self.heater.observe(result)
+
+    def next_block(self) -> Optional[bytes]:
+        '''
+        Cut the next 15 byte block out of the receive buffer, or None when a
+        complete block has not arrived yet.  Bytes in front of a block are
+        skipped by resyncing on the next '!'.
+        '''
+        buf = self.rxbuf
+        while len(buf) >= BLOCK_SIZE:
+            if buf[0] != 33:
+                start = buf.find(b"!", 1)
+                if start < 0:
+                    buf.clear()
+                else:
+                    del buf[:start]
+                continue
+            block = bytes(buf[:BLOCK_SIZE])
+            del buf[:BLOCK_SIZE]
+            return block
+        return None
+
+    def merge_block(self, result: dict, block: bytes) -> None:
+        '''
+        Decode a block into result, a dict of Readings by key, ignoring
+        anything which fails to decode
+        '''
+        if self.capture is not None:
             try:
-                method = getattr(self,func)
-            except:
-                return { f"unknown_{ret}": f"{block}"}
+                self.capture.write(block)
+            except OSError as e:
+                print(f"Cannot capture blocks: {e}")
+        try:
+            if self.profiler is None:
+                res = self.process_block(block)
+            else:
+                with self.profiler.phase("decode"):
+                    res = self.process_block(block)
+        except Exception:
+            return
+        if type(res) is Reading:
+            result[res.sensor.key] = res
+        elif res:
+            for r in res:
+                result[r.sensor.key] = r
+
+    def query(self, commands: list, pipeline: bool = True) -> list:
+        '''
+        Run several commands with a single buffer reset.
 
-        return method(block)
+        Commands ( e.g. [ "S!", "T!", "C!" ] ) are written back to back and
+        the response stream is split on the handshake blocks, giving one
+        result per command in the same order.  A command which times out
+        gives None, just like read_block().
+
+        With pipeline=False each command is written only once the previous
+        response has been read, which still saves the per command reset.
+        While the link is down every command gives None at once.
+        '''
+        commands = [ c if isinstance(c, bytes) else str.encode(c, "ascii") for c in commands ]
+        with self.lock:
+            if not self.reset_serial_buffers():
+                return [ None ] * len(commands)
+            start = time.perf_counter()
+            if pipeline:
+                self.write(b"".join(commands))
+            results = []
+            for cmd in commands:
+                if not self.link_up:
+                    # Went down part way through
+                    results.append(None)
+                    continue
+                if not pipeline:
+                    self.write(cmd)
+                result = self.read_block(discard=False)
+                # Pipelined commands are timed from the previous response
+                now = time.perf_counter()
+                self.metrics.observe(command_name(cmd), now - start, result is not None)
+                start = now
+                results.append(result)
+            self.rxbuf.clear()
+            return results
+
+    def process_block(self, block: bytes):
+        '''
+        Decode one block, giving a Reading, a list of Readings or None
+        '''
+        assert block[0] == 33
+        handler = self.handlers.get(block[1:3]) or self.handlers.get(block[1:2])
+        if handler is None:
+            ret = str(block[1:2],'ascii').strip()
+            self.metrics.unknown[ret] = self.metrics.unknown.get(ret, 0) + 1
+            sensor = unknown_sensors.get(ret)
+            if sensor is None:
+                sensor = unknown_sensors[ret] = Sensor(f"unknown_{ret}", bare=True)
+            return Reading(sensor, f"{block}")
+        return handler(block)
+
+    @classmethod
+    def dispatch_table(cls) -> Dict[ bytes, Callable ]:
+        '''
+        Map of block prefix ( e.g. b"1", b"hh" ) to process_* function,
+        built once per class.
+        '''
+        table = cls.__dict__.get("_dispatch")
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                if name.startswith("process_") and 0 < len(name) - 8 <= 2:
+                    table[str.encode(name[8:], "ascii")] = getattr(cls, name)
+            cls._dispatch = table
+        return table
 
     def process_ntc(self, x: int,pullUp: float,at25: float,beta: float) -> float:
         x = min([max([x,1]),1022])
@@ -167,81 +525,130 @@ class CloudWatcher:
         r = math.log( r / at25 )
         return round(1 / ( ( r / beta ) + ( 1 / ( self.constants.AbsZero + 25 ) ) ) - self.constants.AbsZero, 1)
 
+    def process_ldr(self, x: int) -> float:
+        x = min([max([x,1]),1022])
+        return round(self.constants.LDRPullUpResistance / ( ( 1023 / x ) - 1 ),1)
+
+    def build_tables(self) -> None:
+        '''
+        Precompute the ambient NTC, rain NTC and LDR values for every ADC
+        reading, so decoding !3, !4 and !5 blocks is a single index.
+
+        Called lazily from the handlers; invalidate_tables() forces a rebuild
+        and must be called after changing the constants by hand.
+        '''
+        c = self.constants
+        self.amb_table  = array("d", [ self.process_ntc(x, c.AmbPullUpResistance, c.AmbResAt25, c.AmbBeta) for x in range(ADC_STEPS) ])
+        self.rain_table = array("d", [ self.process_ntc(x, c.RainPullUpResistance, c.RainResAt25, c.RainBeta) for x in range(ADC_STEPS) ])
+        self.ldr_table  = array("d", [ self.process_ldr(x) for x in range(ADC_STEPS) ])
+
+    def invalidate_tables(self) -> None:
+        self.amb_table = None
+        self.rain_table = None
+        self.ldr_table = None
+
+    def set_constants(self, constants: Dict[ str, float ]) -> None:
+        '''
+        Set CWConstants fields, or zener_voltage, by name, e.g. from the
+        readings of process_M
+        '''
+        names = { f.name for f in fields(self.constants) }
+        for name, value in constants.items():
+            if name in names:
+                setattr(self.constants, name, value)
+            elif name == "zener_voltage":
+                self.analog_cache.zener_voltage = value
+            else:
+                raise ValueError(f"Unknown constant {name}")
+        self.invalidate_tables()
+
     def process_1(self, packet: bytes):
         # Sky IR Tempreature
-        x = int(str(packet[2:], "ascii").strip())
-        return { 'skyir': { 'name': 'Sky IR Temp', 'raw': x, 'value': round(x/100,2), 'unit': 'degC' } }
+        x = parse_int(packet)
+        return Reading(SKY_IR, round(x/100,2), x)
 
     def process_2(self, packet: bytes):
         # IR Ambient Temperature
-        x = int(str(packet[2:], "ascii").strip())
-        return { 'ambir': { 'raw': x, 'name': 'Ambient IR Temp', 'value': round(x/100,2), 'unit': 'degC' } }
+        x = parse_int(packet)
+        return Reading(AMBIENT_IR, round(x/100,2), x)
 
     def process_3(self, packet: bytes):
         # NTC Ambient Temperature
-        x = int(str(packet[2:], "ascii").strip())
-        y = self.process_ntc(
-                x, 
-                self.constants.AmbPullUpResistance, 
-                self.constants.AmbResAt25, 
-                self.constants.AmbBeta )
+        x = parse_int(packet)
+        if 0 <= x < ADC_STEPS:
+            if self.amb_table is None:
+                self.build_tables()
+            y = self.amb_table[x]
+        else:
+            y = self.process_ntc(
+                    x, 
+                    self.constants.AmbPullUpResistance, 
+                    self.constants.AmbResAt25, 
+                    self.constants.AmbBeta )
         if y < -40:
             return
 
-        return { 'temp': { 'name': 'NTC Ambient Temp', 'raw': x, 
-            'value': y, 'unit': 'degC' } }
+        return Reading(AMBIENT_NTC, y, x)
 
     def process_4(self, packet: bytes):
         # LDR Ambient Light
         ## When the NEW light sensor is present (output !8), the old output is synthesized but should be ignored
-        if not has8:
-            x = int(str(packet[2:], "ascii").strip())
-            y = min([max([x,1]),1022])
-            return { 'light': { 'raw': x, 'value': round(self.constants.LDRPullUpResistance / ( ( 1023 / y ) - 1 ),1), 'unit': 'kOhm' } }
+        if not self.has8:
+            x = parse_int(packet)
+            if 0 <= x < ADC_STEPS:
+                if self.ldr_table is None:
+                    self.build_tables()
+                value = self.ldr_table[x]
+            else:
+                value = self.process_ldr(x)
+            return Reading(LIGHT, value, x)
         return
 
     def process_5(self, packet: bytes):
         # NTC Temperature of Rain Sensor
-        x = int(str(packet[2:], "ascii").strip())
-        return { 'temp': { 'raw': x, 'name': 'Rain Sensor NTC Temperature', 'value': 
-            self.process_ntc(
-                x,
-                self.constants.RainPullUpResistance,
-                self.constants.RainResAt25, 
-                self.constants.RainBeta ), 'unit': 'degC'} }
+        x = parse_int(packet)
+        if 0 <= x < ADC_STEPS:
+            if self.rain_table is None:
+                self.build_tables()
+            y = self.rain_table[x]
+        else:
+            y = self.process_ntc(
+                    x,
+                    self.constants.RainPullUpResistance,
+                    self.constants.RainResAt25, 
+                    self.constants.RainBeta )
+        return Reading(RAIN_NTC, y, x)
 
     def process_6(self, packet: bytes):
         # Zener Voltage reference
-        x = int(str(packet[2:], "ascii").strip())
-        return { 'zvolt': { 'raw': x, 'name': 'Zener Voltage', 'value': round(1023 * self.analog_cache.zener_voltage / x,3), 'unit': 'V' } }
+        x = parse_int(packet)
+        return Reading(ZENER_VOLTAGE, round(1023 * self.analog_cache.zener_voltage / x,3), x)
 
-    def process_8(self, packet: bytes, temp: float = -999):
+    def process_8(self, packet: bytes):
         # NEW Light Sensor 
         self.has8 = True
         ## When the NEW light sensor is present, the old output is synthesized but should be ignored
-        x = int(str(packet[2:], "ascii").strip())
+        x = parse_int(packet)
         mpsas = self.constants.SQReference - ( 2.5 * math.log( 250000/x, 10 ))
-        if temp > -999:
-            mpsas = ( mpsas - 0.042 ) + ( 0.00212 * temp )
-        return { 'mpsas': { 'raw': x, 'name': 'SQM', 'value': round(mpsas,1), 'unit': 'mpsas' } }
+        return Reading(SQM, round(mpsas,1), x)
 
     def process_h(self, packet: bytes):
         # Humidity
-        x = int(str(packet[2:], "ascii").strip())
+        x = parse_int(packet)
         if x == 100:
             # sensor error
             return
         y = min([ max([ 0, x ]), 100 ])
-        return { 'hum': { 'raw': x, 'name': 'Humidity', 'value': round( y * 125 / 100 - 6, 1 ), 'unit': '%' } }
+        return Reading(HUMIDITY, round( y * 125 / 100 - 6, 1 ), x)
 
     def process_hh(self, packet: bytes):
         # High Res Humidity
-        x = int(str(packet[3:], "ascii").strip())
-        return { 'hum': { 'raw': x, 'name': 'Humidity', 'value': round( x * 125 / 65536 - 6, 1 ), 'unit': '%' } }
+        x = parse_int(packet, 3)
+        return Reading(HUMIDITY_HR, round( x * 125 / 65536 - 6, 1 ), x)
 
     def process_K(self, packet: bytes):
         # Serial Number
-        return { 'serial': { 'name': 'Serial Number', 'value': str(packet[2:14], "ascii").strip() } }
+        return Reading(SERIAL_NUMBER, str(packet[2:14], "ascii").strip())
 
     def process_M(self, packet: bytes):
         x = packet[2:]
@@ -251,14 +658,15 @@ class CloudWatcher:
         self.constants.RainBeta             = ( 256 * x[6] + x[7] )
         self.constants.RainResAt25          = ( 256 * x[8] + x[9] ) / 10
         self.constants.RainPullUpResistance = ( 256 * x[10] + x[11] ) / 10
-        
+        self.invalidate_tables()
+
         return [ 
-            { "zener_voltage": { 'name': 'Zener Constant', 'value': self.analog_cache.zener_voltage }},
-            { "LDRMaxResistance": { 'name': 'LDR Max Resistance', 'value': self.constants.LDRMaxResistance }},
-            { "LDRPullUpResistance": { 'name': 'LDR Pull Up Resistance', 'value': self.constants.LDRPullUpResistance }},
-            { "RainBeta": { 'name': 'Rain Beta', 'value': self.constants.RainBeta }},
-            { "RainResAt25": { 'name': 'Rain Resistance at 25C', 'value': self.constants.RainResAt25 }},
-            { "RainPullUpResistance": { 'name': 'Rain Pull Up Resistance', 'value': self.constants.RainPullUpResistance }},
+            Reading(ZENER_CONSTANT, self.analog_cache.zener_voltage),
+            Reading(LDR_MAX, self.constants.LDRMaxResistance),
+            Reading(LDR_PULL_UP, self.constants.LDRPullUpResistance),
+            Reading(RAIN_BETA, self.constants.RainBeta),
+            Reading(RAIN_R25, self.constants.RainResAt25),
+            Reading(RAIN_PULL_UP, self.constants.RainPullUpResistance),
         ]
 
     def process_m(self, packet: bytes):
@@ -269,144 +677,141 @@ class CloudWatcher:
         if x[3] > 98:
             self.auto_shutdown.heat = 10
         return [
-            { "auto_shutdown_dealy": { "name": "Auto Shutdown Delay", "value": self.auto_shutdown.delay, "unit": "seconds" }},
-            { "auto_shutdown_switch": { "name": "Auto Shutdown Switch State", "value": self.auto_shutdown.switch }},
-            { "auto_shutodwn_heater": { "name": "Auto Shutdown Rain Heat Level", "value": self.auto_shutdown.heat, "unit": "%" }}
+            Reading(SHUTDOWN_DELAY, self.auto_shutdown.delay),
+            Reading(SHUTDOWN_SWITCH, self.auto_shutdown.switch),
+            Reading(SHUTDOWN_HEAT, self.auto_shutdown.heat),
         ]
 
     def process_N(self, packet: bytes):
         # Name
-        return { "name": { 'name': 'Device Name', 'value': str(packet[2:],"ascii").strip() } }
+        return Reading(DEVICE_NAME, str(packet[2:],"ascii").strip())
 
     def process_p(self, packet: bytes ):
-        # Atmospheric Pressure, Pascals
-        results = []
-        x = int(str(packet[2:],"ascii").strip())
-        press = x / 16
-        results.append({ 'abspress': { 'name': 'Absolute Pressure', "raw": x, "value": round(press,1), "unit": "hPa" }})
-        if self.HASL > -999 and self.ambient_temp > -999:
-            press *= math.pow( 1 - ( 0.0065 * self.HASL / ( self.ambient_temp + 0.0065 * self.HASL + self.constants.AbsZero )), -5.275 )
-            results.append({ 'relpress': { 'name': 'Relative Pressure', "raw": x, "value": round(press,1), "unit": "hPa" }})
-        return results
+        # Atmospheric Pressure, Pascals.  The relative pressure is derived
+        x = parse_int(packet)
+        return Reading(ABS_PRESSURE, round(x / 16, 1), x)
 
     def process_Q(self, packet: bytes):
         # PWM Duty Cycle
-        x = int(str(packet[2:],"ascii").strip())
-        return { 'pwm': { 'raw': x, 'name': 'PWM Level', 'value': round( x * 100 / 1023, 1 ), "unit": "%" } }
+        x = parse_int(packet)
+        return Reading(PWM, round( x * 100 / 1023, 1 ), x)
 
     def process_q(self, packet: bytes):
         # Temperature of Atmospheric Pressure Sensor
-        x = int(str(packet[2:],"ascii").strip())
-        return { 'atmtemp': { 'raw': x, 'name': 'Temperature at Atm Press Sensor', 'value': round( x / 100, 1 ), 'unit': 'degC' } }
+        x = parse_int(packet)
+        return Reading(ATM_TEMP, round( x / 100, 1 ), x)
 
     def process_R(self, packet: bytes):
         # Rain Frequence Counter
-        x = int(str(packet[2:],"ascii").strip())
-        return { 'rain_freq': { 'value': x, 'name': 'Rain Sensor Frequency', 'unit': 'Hz' } }
+        x = parse_int(packet)
+        return Reading(RAIN_FREQ, x)
 
     def process_t(self, packet: bytes):
         # Temperature of Relative Humidity sensor
-        x = int(str(packet[2:],"ascii").strip())
+        x = parse_int(packet)
         if x == 100:
             return
         y = ( x * 1.7572 ) - 46.85
         self.ambient_temp = y
-        return { 'hum_temp': { 'raw': x, 'name': 'Temperature at Humidity Sensor', 'value': round( y, 1), 'unit': 'degC' } }
+        return Reading(HUM_TEMP, round( y, 1), x)
 
     def process_th(self, packet: bytes):
         # Temperature of Relative Humidity sensor
-        x = int(str(packet[3:],"ascii").strip())
+        x = parse_int(packet, 3)
         y = ( x * 175.72 / 65536 ) - 46.85
         self.ambient_temp = y
-        return { 'hum_temp': { 'raw': x, 'name': 'Temperature at Humidity Sensor', 'value': round( y, 1 ), 'unit': 'degC' } }
+        return Reading(HUM_TEMP_HR, round( y, 1 ), x)
 
     def process_V(self, packet: bytes):
-        # Firmware Version Number
-        x = int(str(packet[2:14],"ascii").strip())/100
-        return { 'version': { 'name': 'FW Version', 'value': x } }
+        # Firmware Version Number, a decimal such as 5.89, or in hundredths
+        text = str(packet[2:], "ascii").strip()
+        x = float(text) if "." in text else int(text)/100
+        return Reading(FW_VERSION, x)
 
     def process_v(self, packet: bytes):
         # is Wind Sensor Present
-        x = int(str(packet[2:],"ascii").strip())
-        return { "windpresent": { 'name': 'Wind Sensor Present?', 'value': x } }
+        x = parse_int(packet)
+        return Reading(WIND_PRESENT, x)
 
     def process_w(self, packet: bytes, sensor: int = 1):
         # Wind Speed
         # sensor: 
         #   0 = grey model ( discontinued )
         #   1 = black model
-        x = int(str(packet[2:],"ascii").strip())
+        x = parse_int(packet)
         if sensor==0:
-            return { "wind": x }
+            return Reading(WIND_RAW, x)
         elif sensor==1:
             if x == 0:
                 wind = 0
             else:
                 wind = x * 0.84 + 3
-            return { "wind": { 'raw': x, 'name': 'Wind Speed', 'value': round(wind,1), 'unit': 'km/h' } }
+            return Reading(WIND, round(wind,1), x)
 
     def process_X(self, packet: bytes):
-        return { "switch": { 'name': 'Switch State', 'value': "open" } }
+        return Reading(SWITCH, "open")
 
     def process_Y(self, packet: bytes):
-        return { "switch": { 'name': 'Switch State', 'value': "closed" } }
+        return Reading(SWITCH, "closed")
 
     def get_atm_temp(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"q!")
-        return self.read_block()
+        return self.command(b"q!")
 
     def get_constants(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"M!")
-        return self.read_block()
+        return self.command(b"M!")
 
     def get_humidity(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"h!")
-        return self.read_block()
+        return self.command(b"h!")
 
     def get_hum_temp(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"t!")
-        return self.read_block()
+        return self.command(b"t!")
 
     def get_name(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"A!")
-        return self.read_block()
+        return self.command(b"A!")
 
     def get_pressure(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"p!")
-        return self.read_block()
+        return self.command(b"p!")
+
+    def set_pwm(self,pwm) -> Optional[dict]:
+        '''
+        Set the rain heater duty cycle, 0 to 1023.  The unit answers with
+        the new level, which is returned
+        '''
+        return self.command(self.pwm_packet(pwm))
 
-    def set_pwm(self,pwm) -> None:
-        packet = "P"+("0000"+str(max(min(1023,pwm),0)))[-4:]+"!"
-        self.reset_serial_buffers()
-        self.serial.write(str.encode(packet,"ascii"))
+    @staticmethod
+    def pwm_packet(pwm: int) -> bytes:
+        return str.encode("P"+("0000"+str(max(min(1023,int(pwm)),0)))[-4:]+"!", "ascii")
 
     def get_pwm(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"Q!")
-        return self.read_block()
+        return self.command(b"Q!")
 
     def get_rain_freq(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"E!")
-        return self.read_block()
+        return self.command(b"E!")
+
+    def get_safety(self) -> Optional[dict]:
+        '''
+        Rain frequency and switch state in one round trip
+        '''
+        result = {}
+        for temp in self.query(SAFETY_COMMANDS):
+            if temp:
+                result.update(temp)
+        return result or None
 
     def get_sensor_temp(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"T!")
-        return self.read_block()
+        return self.command(b"T!")
 
     def get_serial(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"K!")
-        return self.read_block()
+        return self.command(b"K!")
 
     def set_shutdown(self, delay: int, state: int, heat_power: int) -> None:
+        with self.lock:
+            if self.reset_serial_buffers():
+                self.write(self.shutdown_packet(delay, state, heat_power))
+
+    @staticmethod
+    def shutdown_packet(delay: int, state: int, heat_power: int) -> bytes:
         '''
         auto_shutdown.delay  = ( 256 * x[0] + x[1] ) * 1.1
         auto_shutdown.switch = x[2]
@@ -422,77 +827,66 @@ class CloudWatcher:
         packet[3] = max(min(2,state),0)
         packet[4] = max(min(99,heat_power),0)
 
-        self.reset_serial_buffers()
-        self.serial.write(packet)
+        return bytes([ ord(c) if isinstance(c, str) else c for c in packet ])
 
     def get_shutdown(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"m!")
-        return self.read_block()
+        return self.command(b"m!")
     
     def get_sky_irtemp(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"S!")
-        return self.read_block()
+        return self.command(b"S!")
 
     def get_switch(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"F!")
-        return self.read_block()
+        return self.command(b"F!")
     
     def set_switch_close(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"H!")
-        return self.read_block()
+        return self.command(b"H!")
 
     def set_switch_open(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"G!")
-        return self.read_block()
+        return self.command(b"G!")
 
     def get_values(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"C!")
-        return self.read_block()
+        return self.command(b"C!")
 
     def get_version(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"B!")
-        return self.read_block()
+        return self.command(b"B!")
 
     def get_wind_sensor(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"v!")
-        return self.read_block()
+        return self.command(b"v!")
 
     def get_wind_speed(self) -> None:
-        self.reset_serial_buffers()
-        self.serial.write(b"V!")
-        return self.read_block()
-
-    def reset_serial_buffers(self) -> None:
-        self.serial.write(b"z!")
-        self.read_block()
+        return self.command(b"V!")
 
-    def get_adjusted_sky(self, Ts: float, Ta: float, model: SkyTemperatureModel = default_sky_temperature_model) -> float:
-        if abs((model.K2 / 10 - Ta)) < 1:
-            T67 = (
-                math.copysign(1, model.K6)
-                * math.copysign(1, Ta - model.K2 / 10)
-                * abs((model.K2 / 10 - Ta))
-            )
-        else:
-            T67 = (
-                model.K6
-                / 10
-                * math.copysign(1, Ta - model.K2 / 10)
-                * (math.log(abs((model.K2 / 10 - Ta))) / math.log(10) + model.K7 / 100)
-            )
+    def reset_serial_buffers(self) -> bool:
+        '''
+        Returns False when the link is down and a command should not be sent
+        '''
+        if not self.link_ready():
+            return False
+        start = time.perf_counter()
+        self.write(b"z!")
+        result = self.read_block()
+        self.metrics.observe("z!", time.perf_counter() - start, result is not None)
+        return self.link_up
+
+    def command(self, cmd: bytes) -> Optional[dict]:
+        '''
+        Reset the buffers, send cmd and read its response
+        '''
+        with self.lock:
+            if not self.reset_serial_buffers():
+                return None
+            start = time.perf_counter()
+            self.write(cmd)
+            result = self.read_block()
+            self.metrics.observe(command_name(cmd), time.perf_counter() - start, result is not None)
+            return result
 
-        Td = (
-            (model.K1 / 100) * (Ta - model.K2 / 10)
-            + (model.K3 / 100) * pow(math.exp(Ta * model.K4 / 1000), model.K5 / 100)
-            + T67
-        )
+    def write(self, data: bytes) -> None:
+        self.metrics.bytes_written += len(data)
+        try:
+            self.serial.write(data)
+        except OSError as e:
+            self.lost(e)
 
-        return round(Ts-Td, 2)
+    def get_adjusted_sky(self, Ts: float, Ta: float, model: SkyTemperatureModel = default_sky_temperature_model) -> float:
+        return adjusted_sky(Ts, Ta, model)
@@ -0,0 +1,244 @@
+'''
+asyncio interface to the CloudWatcher
+
+The serial port file descriptor is watched by the event loop, so waiting on
+the unit never blocks other tasks.  POSIX only, like the event loop readers
+it relies on.
+
+    cw = AsyncCloudWatcher("/dev/ttyUSB0", 0)
+    await cw.start()
+    print(await cw.get_sky_irtemp())
+'''
+
+import asyncio, os, time
+from typing import Dict, Optional
+
+from . import CloudWatcher, CloudWatcherException, HANDSHAKE, SAFETY_COMMANDS, command_name
+from .readings import Reading
+
+
+class AsyncCloudWatcher(CloudWatcher):
+    '''
+    CloudWatcher whose commands are coroutines.
+
+    Decoding, constants and lookup tables are shared with CloudWatcher; only
+    the serial I/O differs.  start() must be awaited from the event loop
+    before any command is sent.
+
+    Commands from concurrent tasks are serialized by `lock`, in the order
+    they were issued.
+    '''
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    readable: Optional[asyncio.Event] = None
+    lock: Optional[asyncio.Lock] = None
+    # File descriptor given to the event loop, None when not watched
+    fd: Optional[int] = None
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.readable = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.rxbuf.clear()
+        self.watch()
+
+    def watch(self) -> None:
+        self.fd = self.serial.fileno()
+        self.loop.add_reader(self.fd, self.data_received)
+
+    def unwatch(self) -> None:
+        if self.loop is not None and self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        self.fd = None
+
+    def stop(self) -> None:
+        self.unwatch()
+        self.loop = None
+
+    def close(self) -> None:
+        self.stop()
+        super().close()
+
+    def reopen(self) -> None:
+        self.unwatch()
+        super().reopen()
+        if self.loop is not None:
+            self.watch()
+
+    def lost(self, e: Exception) -> None:
+        # Before the port is closed, its descriptor may be reused
+        self.unwatch()
+        if self.readable is not None:
+            self.readable.set()
+        if self.error_limit:
+            super().lost(e)
+
+    def data_received(self) -> None:
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.lost(e)
+            return
+        if data:
+            self.metrics.bytes_read += len(data)
+            self.rxbuf += data
+            self.readable.set()
+
+    async def read_block(self, discard: bool = True) -> Optional[ Dict[ str, Reading ] ]:
+        '''
+        Wait for the handshake block, see CloudWatcher.read_block
+        '''
+        result = {}
+        deadline = self.loop.time() + self.max_wait
+        clean = False
+        while True:
+            block = self.next_block()
+            if block is None:
+                if self.fd is None:
+                    if not self.error_limit:
+                        # Nothing would reopen it, let the unit be restarted
+                        raise CloudWatcherException("port lost")
+                    break
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                self.readable.clear()
+                try:
+                    await asyncio.wait_for(self.readable.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            elif block[0:2] == HANDSHAKE:
+                if discard:
+                    self.rxbuf.clear()
+                clean = True
+                break
+            else:
+                self.merge_block(result, block)
+
+        self.read_done(clean)
+        if not clean:
+            self.rxbuf.clear()
+        else:
+            self.record(result)
+            return result
+
+    async def reset_serial_buffers(self) -> bool:
+        if not self.link_ready():
+            return False
+        start = time.perf_counter()
+        self.write(b"z!")
+        result = await self.read_block()
+        self.metrics.observe("z!", time.perf_counter() - start, result is not None)
+        return self.link_up
+
+    async def command(self, cmd: bytes) -> Optional[dict]:
+        async with self.lock:
+            if not await self.reset_serial_buffers():
+                return None
+            start = time.perf_counter()
+            self.write(cmd)
+            result = await self.read_block()
+            self.metrics.observe(command_name(cmd), time.perf_counter() - start, result is not None)
+            return result
+
+    async def query(self, commands: list, pipeline: bool = True) -> list:
+        '''
+        See CloudWatcher.query
+        '''
+        commands = [ c if isinstance(c, bytes) else str.encode(c, "ascii") for c in commands ]
+        async with self.lock:
+            if not await self.reset_serial_buffers():
+                return [ None ] * len(commands)
+            start = time.perf_counter()
+            if pipeline:
+                self.write(b"".join(commands))
+            results = []
+            for cmd in commands:
+                if not self.link_up:
+                    results.append(None)
+                    continue
+                if not pipeline:
+                    self.write(cmd)
+                result = await self.read_block(discard=False)
+                now = time.perf_counter()
+                self.metrics.observe(command_name(cmd), now - start, result is not None)
+                start = now
+                results.append(result)
+            self.rxbuf.clear()
+            return results
+
+    async def get_atm_temp(self) -> Optional[dict]:
+        return await self.command(b"q!")
+
+    async def get_constants(self) -> Optional[dict]:
+        return await self.command(b"M!")
+
+    async def get_humidity(self) -> Optional[dict]:
+        return await self.command(b"h!")
+
+    async def get_hum_temp(self) -> Optional[dict]:
+        return await self.command(b"t!")
+
+    async def get_name(self) -> Optional[dict]:
+        return await self.command(b"A!")
+
+    async def get_pressure(self) -> Optional[dict]:
+        return await self.command(b"p!")
+
+    async def set_pwm(self, pwm) -> Optional[dict]:
+        return await self.command(self.pwm_packet(pwm))
+
+    async def get_pwm(self) -> Optional[dict]:
+        return await self.command(b"Q!")
+
+    async def get_rain_freq(self) -> Optional[dict]:
+        return await self.command(b"E!")
+
+    async def get_safety(self) -> Optional[dict]:
+        '''
+        See CloudWatcher.get_safety
+        '''
+        result = {}
+        for temp in await self.query(SAFETY_COMMANDS):
+            if temp:
+                result.update(temp)
+        return result or None
+
+    async def get_sensor_temp(self) -> Optional[dict]:
+        return await self.command(b"T!")
+
+    async def get_serial(self) -> Optional[dict]:
+        return await self.command(b"K!")
+
+    async def set_shutdown(self, delay: int, state: int, heat_power: int) -> None:
+        async with self.lock:
+            if await self.reset_serial_buffers():
+                self.write(self.shutdown_packet(delay, state, heat_power))
+
+    async def get_shutdown(self) -> Optional[dict]:
+        return await self.command(b"m!")
+
+    async def get_sky_irtemp(self) -> Optional[dict]:
+        return await self.command(b"S!")
+
+    async def get_switch(self) -> Optional[dict]:
+        return await self.command(b"F!")
+
+    async def set_switch_close(self) -> Optional[dict]:
+        return await self.command(b"H!")
+
+    async def set_switch_open(self) -> Optional[dict]:
+        return await self.command(b"G!")
+
+    async def get_values(self) -> Optional[dict]:
+        return await self.command(b"C!")
+
+    async def get_version(self) -> Optional[dict]:
+        return await self.command(b"B!")
+
+    async def get_wind_sensor(self) -> Optional[dict]:
+        return await self.command(b"v!")
+
+    async def get_wind_speed(self) -> Optional[dict]:
+        return await self.command(b"V!")
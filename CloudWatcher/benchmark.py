@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the CloudWatcher package
+
+    python3 -m CloudWatcher.benchmark decode    # decoder throughput, against getattr dispatch
+    python3 -m CloudWatcher.benchmark cycle     # cw2mqtt cycles against the simulator
+    python3 -m CloudWatcher.benchmark rain      # rain event to MQTT alert latency
+    python3 -m CloudWatcher.benchmark startup   # process start to first MQTT publish
+    python3 -m CloudWatcher.benchmark sinks     # cycles with and without a slow sink
+
+Run with --help for the options of each benchmark.
+'''
+import argparse, json, os, queue, random, socket, subprocess, sys, tempfile, threading, time, types
+import CloudWatcher as cf
+from CloudWatcher.simulator import Simulator
+from CloudWatcher.publisher import Pipeline
+from CloudWatcher.sinks import Sink
+from CloudWatcher.stats import RingBuffer
+
+def block(payload: bytes) -> bytes:
+    return (b"!" + payload + b" " * cf.BLOCK_SIZE)[:cf.BLOCK_SIZE]
+
+# A representative mix of the blocks seen during a cw2mqtt sweep
+sample_blocks = [
+    block(b"1      -1234"),
+    block(b"2       1523"),
+    block(b"3        523"),
+    block(b"4        812"),
+    block(b"5        498"),
+    block(b"6        260"),
+    block(b"8      12345"),
+    block(b"R       2754"),
+    block(b"hh     31210"),
+    block(b"th     24312"),
+    block(b"p      15840"),
+    block(b"q       1523"),
+    block(b"w         12"),
+    block(b"X  "),
+]
+
+class NullMQTT:
+    '''
+    Stands in for the paho client, counting what would be published
+    '''
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.listener = None
+
+    def publish(self, topic: str, payload: str, retain: bool = False, qos: int = 0):
+        self.messages += 1
+        self.bytes += len(payload)
+        if self.listener:
+            self.listener(topic, payload, retain)
+
+class SlowSink(Sink):
+    '''
+    Takes `delay` seconds over every message, sleeping or, with cpu, busy
+    in Python and holding the GIL like an encoder would
+    '''
+    batch = 1
+    linger = 0
+
+    def __init__(self, delay: float, cpu: bool = False, **options):
+        super().__init__("slow", **options)
+        self.delay = delay
+        self.cpu = cpu
+
+    def write(self, items: list) -> None:
+        if not self.cpu:
+            time.sleep(self.delay)
+            return
+        deadline = time.perf_counter() + self.delay
+        while time.perf_counter() < deadline:
+            pass
+
+class StubBroker:
+    '''
+    Just enough of an MQTT 3.1.1 broker to accept one client at a time and
+    note when each topic is first published to
+    '''
+    def __init__(self):
+        self.sock = socket.create_server(( "127.0.0.1", 0 ))
+        self.port = self.sock.getsockname()[1]
+        self.published = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self) -> None:
+        while True:
+            conn, addr = self.sock.accept()
+            threading.Thread(target=self.serve, args=( conn, ), daemon=True).start()
+
+    def serve(self, conn: socket.socket) -> None:
+        f = conn.makefile("rb")
+        try:
+            while True:
+                head = f.read(1)
+                if not head:
+                    return
+                size = shift = 0
+                while True:
+                    b = f.read(1)[0]
+                    size |= ( b & 127 ) << shift
+                    shift += 7
+                    if b < 128:
+                        break
+                body = f.read(size)
+                kind = head[0] >> 4
+                if kind == 1:
+                    conn.sendall(b"\x20\x02\x00\x00")        # CONNACK
+                elif kind == 3:
+                    topic = body[2:2 + int.from_bytes(body[:2], "big")].decode("utf-8")
+                    self.published.put(( time.perf_counter(), topic ))
+                elif kind == 12:
+                    conn.sendall(b"\xd0\x00")                    # PINGRESP
+                elif kind == 14:
+                    return
+        except ( OSError, IndexError ):
+            pass
+        finally:
+            conn.close()
+
+def baseline_process_block(cw: cf.CloudWatcher, block: bytes):
+    '''
+    process_block as it was before the dispatch table, finding the handler
+    by formatting its name and probing for it with getattr
+    '''
+    assert block[0] == 33
+    ret = str(block[1:3],'ascii').strip()
+    try:
+        method = getattr(cw, f"process_{ret}")
+    except AttributeError:
+        ret = str(block[1:2],'ascii').strip()
+        try:
+            method = getattr(cw, f"process_{ret}")
+        except AttributeError:
+            return { f"unknown_{ret}": f"{block}" }
+    return method(block)
+
+def bench_decode(process_block, frames: int) -> float:
+    '''
+    Decode frames through process_block, returns frames per second
+    '''
+    blocks = sample_blocks * ( frames // len(sample_blocks) + 1 )
+    blocks = blocks[:frames]
+    start = time.perf_counter()
+    for b in blocks:
+        try:
+            process_block(b)
+        except Exception:
+            pass
+    return frames / ( time.perf_counter() - start )
+
+def decode(args):
+    cw = cf.CloudWatcher(None, 0)
+    best = max(bench_decode(cw.process_block, args.frames) for i in range(args.repeat))
+    baseline = max(bench_decode(types.MethodType(baseline_process_block, cw), args.frames) for i in range(args.repeat))
+    print(f"decode: {best:,.0f} frames/s")
+    print(f"getattr dispatch: {baseline:,.0f} frames/s ( {best / baseline:.2f}x )")
+
+def start_cw2mqtt(sim: Simulator, argv: list):
+    '''
+    Import cw2mqtt and set it up like its __main__ block does, publishing
+    to a NullMQTT client.  Returns the module and the CloudWatcher.
+    '''
+    from CloudWatcher import cw2mqtt
+    port = sim.start()
+    cw2mqtt.args = cw2mqtt.parse_args(argv + [ "-p", port ])
+    cw2mqtt.retain = cw2mqtt.args.retain
+    cw2mqtt.topic = cw2mqtt.args.topic
+    cw2mqtt.interval = cw2mqtt.args.interval
+    cw2mqtt.sky_model = cf.SkyTemperatureModel.parse(cw2mqtt.args.model)
+    cw2mqtt.tune_threads()
+    cw2mqtt.mqttc = NullMQTT()
+    cw2mqtt.publisher = cw2mqtt.make_publisher(cw2mqtt.mqttc)
+    cw2mqtt.output = cw2mqtt.make_output([ cw2mqtt.publisher ])
+    cw = cf.CloudWatcher(port, cw2mqtt.args.elevation)
+    cw2mqtt.cw = cw
+    cw2mqtt.attach_model(cw, port)
+    return cw2mqtt, cw
+
+def report(name: str, values: list, unit: str, scale: float = 1):
+    values = sorted(values)
+    mean = sum(values) / len(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    print(f"{name:>16}: mean {mean*scale:10.3f}  min {values[0]*scale:10.3f}  p95 {p95*scale:10.3f}  max {values[-1]*scale:10.3f} {unit}")
+
+def cycle(args):
+    '''
+    Run cw2mqtt sampling cycles against the simulator, back to back
+    '''
+    sim = Simulator(args.baud, args.garbage, args.short, args.timeout, seed=1)
+    extra = args.cw2mqtt[1:] if args.cw2mqtt[:1] == [ "--" ] else args.cw2mqtt
+    cw2mqtt, cw = start_cw2mqtt(sim, [ "-n", str(args.samples) ] + extra)
+    cw.max_wait = args.max_wait
+    cloud_list = RingBuffer(cw2mqtt.args.cloud_window)
+    history = {}
+
+    latency = []
+    cpu = []
+    trips = []
+    frames = []
+    for i in range(args.cycles):
+        commands = sim.commands
+        blocks = sim.blocks
+        wall = time.perf_counter()
+        thread = time.thread_time()
+        cw2mqtt.mqtt_send(cw2mqtt.run_cycle(cw, cloud_list, history))
+        cpu.append(time.thread_time() - thread)
+        latency.append(time.perf_counter() - wall)
+        trips.append(sim.commands - commands)
+        frames.append(sim.blocks - blocks)
+    sim.stop()
+    cw2mqtt.publisher.stop()
+
+    print(f"cycle: {args.cycles} cycles of {args.samples} sweeps at {args.baud or 'unpaced'} baud")
+    report("latency", latency, "ms", 1000)
+    report("cpu", cpu, "ms", 1000)
+    report("round trips", trips, "/cycle")
+    report("frames", frames, "/cycle")
+    print(f"{'frames/s':>16}: {sum(frames) / sum(latency):,.0f}")
+    print(f"{'published':>16}: {cw2mqtt.mqttc.messages / args.cycles:.1f} messages, {cw2mqtt.mqttc.bytes / args.cycles:,.0f} bytes /cycle")
+    print(f"{'suppressed':>16}: {cw2mqtt.publisher.suppressed / args.cycles:.1f} readings /cycle")
+
+def rain(args):
+    '''
+    Run cw2mqtt against the simulator, start and stop rain at random points
+    of the interval and time the retained alert and the averaged rain_freq
+    message which follow
+    '''
+    sim = Simulator(args.baud, seed=1)
+    cw2mqtt, cw = start_cw2mqtt(sim, [ "-n", str(args.samples), "-i", str(args.interval), "-S", "0", "--safety", str(args.safety) ])
+    wet, limit = ( float(x) for x in cw2mqtt.args.rain_limits.split(",") )
+    published = queue.Queue()
+
+    def listener(topic: str, payload: str, retain: bool):
+        key = topic.split("/", 1)[1]
+        if key in ( "safety/rain", "rain_freq" ):
+            published.put(( time.perf_counter(), key, json.loads(payload), retain ))
+
+    cw2mqtt.mqttc.listener = listener
+    threading.Thread(target=cw2mqtt.main, daemon=True).start()
+
+    def wait_for(start: float, raining: bool) -> dict:
+        found = {}
+        deadline = time.perf_counter() + args.interval * 3
+        while len(found) < 2 and time.perf_counter() < deadline:
+            try:
+                at, key, payload, retain = published.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if at < start or key in found:
+                continue
+            if key == "safety/rain" and ( payload['value'] == "rain" ) == raining and retain:
+                found[key] = at - start
+            elif key == "rain_freq" and ( payload['value'] < limit ) == raining:
+                found[key] = at - start
+        return found
+
+    rnd = random.Random(1)
+    dry = sim.values["R"]
+    alert = []
+    averaged = []
+    for i in range(args.events):
+        for raining, freq in ( ( True, args.rain_freq ), ( False, dry ) ):
+            time.sleep(rnd.uniform(0, args.interval))
+            start = time.perf_counter()
+            sim.values["R"] = freq
+            found = wait_for(start, raining)
+            if "safety/rain" in found:
+                alert.append(found["safety/rain"])
+            if "rain_freq" in found:
+                averaged.append(found["rain_freq"])
+
+    print(f"rain: {args.events} rain events, --safety {args.safety} at {args.baud or 'unpaced'} baud, {args.interval} s interval")
+    if alert:
+        report("alert", alert, "s")
+    if averaged:
+        report("averaged", averaged, "s")
+    print(f"{'missed':>16}: {args.events * 2 - len(alert) if args.safety else '-'} alerts, {args.events * 2 - len(averaged)} averaged")
+
+def startup(args):
+    '''
+    Start cw2mqtt as a new process against the simulator and a stub broker,
+    timing the first message and the first reading to be published
+    '''
+    sim = Simulator(args.baud, seed=1)
+    port = sim.start()
+    broker = StubBroker()
+    extra = args.cw2mqtt[1:] if args.cw2mqtt[:1] == [ "--" ] else args.cw2mqtt
+    first = []
+    reading = []
+    with tempfile.TemporaryDirectory() as cache:
+        for i in range(args.runs + 1):
+            if args.cold:
+                for name in os.listdir(cache):
+                    os.unlink(os.path.join(cache, name))
+            while not broker.published.empty():
+                broker.published.get()
+            start = time.perf_counter()
+            proc = subprocess.Popen([ sys.executable, "-m", "CloudWatcher.cw2mqtt", "-b", f"127.0.0.1:{broker.port}", "-p", port,
+                                      "-n", str(args.samples), "--cache", cache ] + extra, stdout=subprocess.DEVNULL)
+            times = {}
+            deadline = start + 60
+            while "reading" not in times and time.perf_counter() < deadline:
+                try:
+                    at, topic = broker.published.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                times.setdefault("first", at - start)
+                if topic.endswith("/skyir"):
+                    times["reading"] = at - start
+            proc.terminate()
+            proc.wait()
+            if i == 0 and not args.cold:
+                # Fills the cache
+                continue
+            if "first" in times:
+                first.append(times["first"])
+            if "reading" in times:
+                reading.append(times["reading"])
+    sim.stop()
+
+    print(f"startup: {args.runs} runs, {'cold' if args.cold else 'warm'} cache, {args.samples} sweeps at {args.baud or 'unpaced'} baud")
+    if first:
+        report("first message", first, "ms", 1000)
+    if reading:
+        report("first reading", reading, "ms", 1000)
+
+def sinks(args):
+    '''
+    Run cw2mqtt sampling cycles against the simulator without and then with
+    a sink slower than the messages come, timing the cycles and the calls
+    handing their messages over
+    '''
+    sim = Simulator(args.baud, seed=1)
+    extra = args.cw2mqtt[1:] if args.cw2mqtt[:1] == [ "--" ] else args.cw2mqtt
+    cw2mqtt, cw = start_cw2mqtt(sim, [ "-n", str(args.samples) ] + extra)
+    cloud_list = RingBuffer(cw2mqtt.args.cloud_window)
+    history = {}
+
+    def run(name: str, stages: list):
+        cw2mqtt.output = Pipeline([ cw2mqtt.publisher ] + cw2mqtt.output.stages[1:] + stages)
+        latency = []
+        handover = []
+        for i in range(args.cycles):
+            wall = time.perf_counter()
+            messages = cw2mqtt.run_cycle(cw, cloud_list, history)
+            sent = time.perf_counter()
+            cw2mqtt.mqtt_send(messages)
+            handover.append(time.perf_counter() - sent)
+            latency.append(time.perf_counter() - wall)
+        print(name)
+        report("latency", latency, "ms", 1000)
+        report("handover", handover, "us", 1e6)
+
+    print(f"sinks: {args.cycles} cycles of {args.samples} sweeps at {args.baud or 'unpaced'} baud")
+    run("without", [])
+    slow = SlowSink(args.delay, args.cpu, queue=args.queue)
+    slow.start()
+    run(f"with a sink taking {args.delay} s per message{' of CPU' if args.cpu else ''}", [ slow ])
+    stats = slow.snapshot()
+    print(f"{'slow sink':>16}: {stats['written']} written, {stats['dropped']} dropped, {stats['queued']} queued")
+    slow.stop(0)
+    sim.stop()
+    cw2mqtt.publisher.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("decode", help="Decoder throughput")
+    p.add_argument("-n", "--frames", default = 200000, type=int, help="Number of frames to decode")
+    p.add_argument("-r", "--repeat", default = 5, type=int,      help="Repeat count, best run is reported")
+    p.set_defaults(func=decode)
+
+    p = sub.add_parser("cycle", help="cw2mqtt sampling cycles against the device simulator")
+    p.add_argument("-b", "--baud",    default = 9600, type=int,  help="Simulated line speed, 0 for no pacing ( default 9600 )")
+    p.add_argument("-c", "--cycles",  default = 5, type=int,     help="Number of cycles ( default 5 )")
+    p.add_argument("-g", "--garbage", default = 0, type=float,   help="Probability of garbage before a block")
+    p.add_argument("-m", "--max-wait", default = 5, type=float,  help="CloudWatcher.max_wait in seconds ( default 5 )")
+    p.add_argument("-n", "--samples", default = 5, type=int,     help="Sweeps per cycle ( default 5 )")
+    p.add_argument("-s", "--short",   default = 0, type=float,   help="Probability of a short block")
+    p.add_argument("-t", "--timeout", default = 0, type=float,   help="Probability of no response to a command")
+    p.add_argument("cw2mqtt", nargs = argparse.REMAINDER,        help="cw2mqtt options, e.g. -- --max-age 300 --deadband 0.5")
+    p.set_defaults(func=cycle)
+
+    p = sub.add_parser("rain", help="Time from a simulated rain event to the MQTT alert")
+    p.add_argument("-b", "--baud",    default = 9600, type=int,  help="Simulated line speed, 0 for no pacing ( default 9600 )")
+    p.add_argument("-e", "--events",  default = 5, type=int,     help="Number of rain events, each starts and stops ( default 5 )")
+    p.add_argument("-f", "--rain-freq", default = 1200, type=int, help="Rain sensor frequency while raining ( default 1200 )")
+    p.add_argument("-i", "--interval", default = 5, type=int,    help="cw2mqtt interval ( default 5 )")
+    p.add_argument("-n", "--samples", default = 5, type=int,     help="Sweeps per cycle ( default 5 )")
+    p.add_argument("-s", "--safety",  default = 0.5, type=float, help="cw2mqtt --safety, 0 to time the averaged message only ( default 0.5 )")
+    p.set_defaults(func=rain)
+
+    p = sub.add_parser("startup", help="Time from starting cw2mqtt to its first MQTT publish")
+    p.add_argument("-b", "--baud",    default = 9600, type=int,  help="Simulated line speed, 0 for no pacing ( default 9600 )")
+    p.add_argument("-c", "--cold",    action = 'store_true',     help="Start every run without the --cache file")
+    p.add_argument("-n", "--samples", default = 1, type=int,     help="Sweeps per cycle ( default 1 )")
+    p.add_argument("-r", "--runs",    default = 5, type=int,     help="Number of runs ( default 5 )")
+    p.add_argument("cw2mqtt", nargs = argparse.REMAINDER,        help="cw2mqtt options, e.g. -- -a")
+    p.set_defaults(func=startup)
+
+    p = sub.add_parser("sinks", help="cw2mqtt sampling cycles with and without a slow sink")
+    p.add_argument("-b", "--baud",    default = 9600, type=int,  help="Simulated line speed, 0 for no pacing ( default 9600 )")
+    p.add_argument("-c", "--cycles",  default = 5, type=int,     help="Number of cycles of each run ( default 5 )")
+    p.add_argument(      "--cpu",     action = 'store_true',     help="The slow sink keeps the CPU busy instead of sleeping")
+    p.add_argument("-d", "--delay",   default = 0.5, type=float, help="Seconds the slow sink takes per message ( default 0.5 )")
+    p.add_argument("-n", "--samples", default = 5, type=int,     help="Sweeps per cycle ( default 5 )")
+    p.add_argument("-q", "--queue",   default = 100, type=int,   help="Queue size of the slow sink ( default 100 )")
+    p.add_argument("cw2mqtt", nargs = argparse.REMAINDER,        help="cw2mqtt options, e.g. -- --sink csv:/tmp/csv")
+    p.set_defaults(func=sinks)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -5,133 +5,729 @@ by Michael J. Kidd
 https://github.com/linuxkidd/
 
 - Provides decoded packet data to MQTT in JSON format.
-- HomeAssistant Discovery protocol enabled.
+- HomeAssistant Discovery protocol, with --discovery homeassistant.
 
 Implements CloudWatcher protocol versions 1.0 to 1.4
 
 For command line option help, please run with --help.
 '''
-import argparse,json,math,signal,time
+import argparse,atexit,math,os,signal,sys,threading,time
+from typing import TYPE_CHECKING
 import CloudWatcher as cf
+from CloudWatcher import is_address, metrics
+from CloudWatcher.metadata import METADATA, MetadataCache
+from CloudWatcher.profiling import phase
+from CloudWatcher.publisher import Deadband, Pipeline, Publisher
+from CloudWatcher.readings import Reading, Sensor
+from CloudWatcher.stats import Accumulator, RingBuffer
+# Optional features are imported by the code enabling them
+if TYPE_CHECKING:
+    from CloudWatcher.safety import SafetyMonitor
+    from CloudWatcher.scheduler import Scheduler
 
-def signal_handler(signal, frame):
-    print('SIGINT received.  Terminating.')
+def signal_handler(signum, frame):
+    print(f'{signal.Signals(signum).name} received.  Terminating.')
     exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
+# Exit through atexit so the sinks write what they hold
+signal.signal(signal.SIGTERM, signal_handler)
 
-def get_avg(mylist: list):
-    return sum(mylist)/len(mylist)
-
-def get_stdev(mylist: list):
-    avg = get_avg(mylist)
-    ls=[]
-    for i in mylist:
-        ls.append((i - avg)**2)
-    return math.sqrt( sum(ls) / (len(mylist) - 1) )
-
-def trim_list(mylist: list):
+def reload_model(signal, frame):
     '''
-    Trim a list of entries which fall outside of 1 stdev
+    Read the --model file again, e.g. after CloudWatcher.skymodel fit
     '''
-    avg = get_avg(mylist)
-    stdev = get_stdev(mylist)
-    min = avg - stdev
-    max = avg + stdev
-    newlist = []
+    global sky_model
+    try:
+        sky_model = cf.SkyTemperatureModel.parse(args.model)
+        print(f"Sky temperature model {sky_model}")
+        for derived in engines.values():
+            derived.set("sky_model", sky_model)
+    except ( OSError, ValueError, KeyError, TypeError ) as e:
+        print(f"Cannot load the sky temperature model {args.model}: {e}")
 
-    for x in mylist:
-        if x >= min or x <= max:
-            newlist.append(x)
-    return newlist
-
-def mqtt_on_connect(client, userdata, flags, rc):
+def mqtt_on_connect(client, userdata, flags, rc, properties=None):
     mqtt_connected = True
     if debug>0:
         print("MQTT Connected with code "+str(rc))
+    # The broker may have published the will while we were away.  With -d
+    # every unit has its own availability, <topic>/availability is the
+    # process's own, which its will takes offline.
+    if topic not in available:
+        client.publish(f"{topic}/availability", "online", retain=True)
+    for prefix, payload in list(available.items()):
+        client.publish(f"{prefix}/availability", payload, retain=True)
+    if args.discovery:
+        client.subscribe(f"{args.discovery}/status")
+        # Configs lost with the connection go out with the next interval
+        for discovery in list(discoveries.values()):
+            discovery.retry()
+
+def mqtt_on_message(client, userdata, message):
+    # Home Assistant came online, it may have lost the configs if the
+    # broker does not keep retained messages
+    if message.topic == f"{args.discovery}/status" and message.payload == b"online" and not message.retain:
+        for discovery in list(discoveries.values()):
+            discovery.force()
+
+def mqtt_send(messages: list, prefix: str = None):
+    '''
+    Queue the messages of one interval, see Publisher.publish
+    '''
+    prefix = prefix or topic
+    messages = [ m for m in messages if m ]
+    if args.discovery and args.broker:
+        discover(messages, prefix)
+    with phase(profiler, "queue"):
+        output.publish(messages, prefix)
+
+def discover(messages: list, prefix: str):
+    '''
+    Publish the --discovery configs of the unit under prefix which changed,
+    retained and to the broker only
+    '''
+    discovery = discoveries.get(prefix)
+    if discovery is None:
+        from CloudWatcher.discovery import Discovery
+        discovery = discoveries[prefix] = Discovery(args.cache, prefix, args.combined, f"{topic}/availability")
+    configs = discovery.update(messages)
+    if configs:
+        # One topic per config, ahead of the readings, whatever --combined,
+        # remembered once the client has sent it
+        publisher.publish(configs, args.discovery, retain=True, urgent=True, sent=discovery.sent)
+
+def mqtt_alert(message: dict, prefix: str = None):
+    '''
+    Publish a safety alert retained, ahead of any queued messages
+    '''
+    with phase(profiler, "queue"):
+        output.publish([ message ], prefix or topic, retain=True, urgent=True)
+
+def connect_mqtt():
+    '''
+    Create the paho client, connect it and attach it to the publisher.  Run
+    on its own thread, importing paho takes about as long as opening the
+    unit and reading it.
+    '''
+    global mqttc
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        print("Fatal: paho-mqtt is not installed")
+        os._exit(1)
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        # paho-mqtt 2.x
+        mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    else:
+        mqttc = mqtt.Client() #create new instance
+    mqttc.on_connect = mqtt_on_connect
+    mqttc.on_message = mqtt_on_message
+    mqttc.will_set(f"{topic}/availability", "offline", retain=True)
+
+    try:
+        mqttc.connect(*parse_broker(args.broker)) #connect to broker
+    except:
+        # The network loop keeps retrying in the background
+        print("MQTT Broker ( {0:s} ) Connection Failed".format(args.broker))
+
+    publisher.attach(mqttc)
+
+def make_publisher(client) -> Publisher:
+    '''
+    Start the Publisher configured by the command line
+    '''
+    deadbands = {}
+    default = 0.0
+    for spec in args.deadband:
+        key, sep, delta = spec.rpartition("=")
+        if sep:
+            deadbands[key] = float(delta)
+        else:
+            default = float(delta)
+    p = Publisher(client, args.retain, args.combined, Deadband(deadbands, default, args.max_age), args.queue, args.queue_policy)
+    p.start()
+    return p
+
+def tune_threads():
+    '''
+    Apply --switch-interval, the longest a busy thread such as a sink keeps
+    the GIL from the serial loop, which wakes up for every few blocks from
+    the unit
+    '''
+    if args.switch_interval:
+        sys.setswitchinterval(args.switch_interval)
+
+def make_output(stages: list) -> Pipeline:
+    '''
+    The stages given, e.g. the Publisher, followed by the --sink sinks,
+    each started on its own thread
+    '''
+    sinks = []
+    if args.sink:
+        from CloudWatcher.sinks import parse_sink
+        sinks = [ parse_sink(spec) for spec in args.sink ]
+    for sink in sinks:
+        sink.start()
+        atexit.register(sink.stop)
+    return Pipeline(stages + sinks)
+
+# Metrics of every running unit, keyed by port
+units = {}
+# Derived metrics of every running unit, keyed by port
+engines = {}
+# profiling.Profiler with --profile
+profiler = None
+# Last availability published, keyed by topic prefix
+available = {}
+# Home Assistant discovery of every running unit, keyed by topic prefix
+discoveries = {}
+
+GUST = Sensor("gust", "Wind Gust", "km/h")
 
-def mqtt_send(resp: dict):
-    #if mqtt_connected:
-    if True:
-        for key in resp.keys():
-            mqttc.publish(f"{topic}/{key}", json.dumps(resp[key]), retain=retain)
+# hum_temp, humidity, values, rain_freq, pressure, atm_temp, sensor_temp, wind_speed, sky_irtemp
+sweep = [ b"t!", b"h!", b"C!", b"E!", b"p!", b"q!", b"T!", b"V!", b"S!" ]
+
+def add_sample(stats: dict, last: dict, temp: dict):
+    '''
+    Fold one query result into the per key statistics of the interval
+    '''
+    for k, reading in temp.items():
+        last[k] = reading
+        try:
+            value = float(reading.value)
+        except (TypeError, ValueError):
+            continue
+        if k not in stats:
+            stats[k] = Accumulator(args.sigma)
+        stats[k].add(value)
+
+def summarize(cw: cf.CloudWatcher, stats: dict, last: dict, cloud_list: RingBuffer, history: dict) -> list:
+    '''
+    Build the messages published at the end of an interval
+    '''
+    messages = []
+    means = {}
+    for k in stats.keys():
+        summary = stats[k].summary()
+        last[k].value = means[k] = round(summary.mean,2)
+        if k=="clouds":
+            # Published with its window below
+            continue
+        messages.append({ f"{k}": last[k] })
+        if k=="wind":
+            means['gust'] = summary.max
+            messages.append({ 'gust': Reading(GUST, summary.max) })
+
+    if args.history and means:
+        for k in means.keys():
+            if k not in history:
+                history[k] = RingBuffer(args.history)
+            history[k].append(means[k])
+        messages.append({ 'history': { k: history[k].summary() for k in means.keys() } })
+
+    if 'clouds' not in means:
+        return messages
+
+    cloud_list.append(means['clouds'])
+    if len(cloud_list):
+        clouds = { 'value': round(cloud_list.mean,1), 'unit': 'delta C', 'epoch': math.floor(time.time()), 'window': cloud_list.summary(1) }
+        if args.cloud_list:
+            clouds['cloud_list'] = cloud_list.values()
+        messages.append({ 'clouds': clouds })
+    return messages
+
+def run_cycle(cw: cf.CloudWatcher, cloud_list: RingBuffer, history: dict, safety: "SafetyMonitor" = None) -> list:
+    '''
+    Sample every sensor args.samples times, returns the messages to publish.
+    Each raw sample is also checked by the safety monitor, if any.
+    '''
+    stats = {}
+    last = {}
+    for i in range(0,args.samples):
+        with phase(profiler, "sample"):
+            results = cw.query(sweep)
+        for temp in results:
+            if temp:
+                if safety:
+                    safety.check(temp)
+                with phase(profiler, "aggregate"):
+                    add_sample(stats, last, temp)
+    with phase(profiler, "aggregate"):
+        return summarize(cw, stats, last, cloud_list, history)
+
+def safety_monitor(alert) -> "SafetyMonitor":
+    '''
+    The SafetyMonitor for --safety, or None when it is disabled
+    '''
+    if not args.safety:
+        return None
+    from CloudWatcher.safety import SafetyMonitor
+    wet, rain = ( float(x) for x in args.rain_limits.split(",") )
+    return SafetyMonitor(alert, wet, rain)
+
+def idle(cw: cf.CloudWatcher, safety: "SafetyMonitor", until: float):
+    '''
+    Wait for time.monotonic() to reach until, polling the rain and switch
+    state every args.safety seconds meanwhile
+    '''
+    while True:
+        remaining = until - time.monotonic()
+        if remaining <= 0:
+            return
+        if safety is None:
+            time.sleep(remaining)
+            return
+        start = time.monotonic()
+        safety.check(cw.get_safety())
+        time.sleep(max(min(start + args.safety, until) - time.monotonic(), 0))
+
+def schedules() -> list:
+    '''
+    The default per sensor schedule with the --schedule overrides applied
+    '''
+    from CloudWatcher.scheduler import default_schedule, parse_schedule
+    entries = { s.command: s for s in default_schedule(interval) }
+    for spec in args.schedule:
+        entry = parse_schedule(spec)
+        entries[entry.command] = entry
+    return list(entries.values())
+
+def adaptive_messages(cw: cf.CloudWatcher, sched: "Scheduler", due: list, results: list, now: float, cloud_list: RingBuffer, history: dict, safety: "SafetyMonitor" = None) -> list:
+    '''
+    Feed the responses to the due commands to the scheduler, returns the
+    messages of the sensors which are ready to publish
+    '''
+    messages = []
+    for cmd, temp in zip(due, results):
+        if safety:
+            safety.check(temp)
+        batch = sched.feed(cmd, temp, now)
+        if batch is None:
+            continue
+        stats, last = batch
+        if not stats:
+            # Static data, published as read
+            messages.append(last)
+        else:
+            with phase(profiler, "aggregate"):
+                messages += summarize(cw, stats, last, cloud_list, history)
+    return messages
+
+def export_metrics(cw: cf.CloudWatcher, cycles: int) -> list:
+    '''
+    Write the Prometheus text file and return the heater message, and the
+    stats and profile messages when due after interval number `cycles`
+    '''
+    if args.prom_file:
+        try:
+            metrics.write_textfile(args.prom_file, metrics.prometheus_text(units))
+        except OSError as e:
+            print(f"Cannot write {args.prom_file}: {e}")
+    messages = []
+    if cw.heater is not None:
+        messages.append({ 'heater': cw.heater.snapshot() })
+    if args.stats and cycles % args.stats == 0:
+        messages.append({ 'stats': cw.metrics.snapshot() })
+        if profiler is not None:
+            messages.append({ 'profile': profiler.snapshot() })
+    return messages
+
+def track_link(cw: cf.CloudWatcher, prefix: str, alert):
+    '''
+    Reopen the port of cw after --error-limit dirty reads in a row and
+    publish <prefix>/availability, retained, as its link goes up and down
+    '''
+    def on_link(up: bool):
+        available[prefix] = b"online" if up else b"offline"
+        alert({ 'availability': available[prefix] })
+
+    cw.error_limit = args.error_limit
+    cw.max_backoff = args.max_backoff
+    cw.on_link = on_link
+    on_link(True)
+
+def attach_profiler(target):
+    '''
+    Time the decoding and recording of a unit, or the serialization and
+    writes of an output stage, under --profile
+    '''
+    if hasattr(target, "profiler"):
+        target.profiler = profiler
+
+def attach_heater(cw: cf.CloudWatcher):
+    '''
+    Start the --heater controller of the unit, if any
+    '''
+    if args.heater:
+        from CloudWatcher.heater import parse_heater
+        cw.heater = parse_heater(cw, args.heater)
+        cw.heater.start()
+
+def metadata_cache(cw: cf.CloudWatcher, port: str) -> MetadataCache:
+    '''
+    The --cache file of port, restoring the unit's constants from it.  Has
+    no messages when disabled or not written yet.
+    '''
+    cache = MetadataCache(os.path.join(args.cache, unit_name(port) + ".json") if args.cache else "", port)
+    if args.cache and cache.load():
+        try:
+            cw.set_constants(cache.constants())
+        except ( TypeError, ValueError ):
+            cache.responses = {}
+    return cache
 
 def main():
 
+    safety = safety_monitor(mqtt_alert)
+    cache = metadata_cache(cw, args.port)
+    track_link(cw, topic, mqtt_alert)
+    attach_heater(cw)
+
     def mainLoop():
-        cloud_list = []
-        retain = True
-        mqtt_send(cw.get_serial())
-        mqtt_send(cw.get_version())
-        mqtt_send(cw.get_constants())
+        cloud_list = RingBuffer(args.cloud_window)
+        history = {}
+        # Without cached constants they are needed before decoding anything
+        stale = bool(cache.messages())
+        if stale:
+            mqtt_send(cache.messages())
+        else:
+            results = cw.query(METADATA)
+            cache.update(METADATA, results)
+            mqtt_send(results)
         last_refresh = 0
-        retain = args.retain
+        cycles = 0
         while True:
-            lists = {}
-            last = {}
-            last_refresh = time.time()
-
-            for i in range(0,5):
-                for x in [ 'hum_temp', 'humidity', 'values', 'rain_freq', 'pressure', 'atm_temp', 'sensor_temp', 'wind_speed', 'sky_irtemp']:
-                    method = getattr(cw,'get_'+x)
-                    temp = method()
-                    for k in temp.keys():
-                        last[k] = temp[k]
-                        if k not in lists:
-                            lists[k] = []
-                        lists[k].append(temp[k]['value'])
-            for k in lists.keys():
-                tmplist = trim_list(lists[k])
-                last[k]['value'] = round(get_avg(tmplist),2)
-                mqtt_send({ f"{k}": last[k] })
-                if k=="wind":
-                    mqtt_send({ 'gust': { 'name': 'Wind Gust', 'value': max(lists[k]), 'unit': 'km/h' }})
-
-            try:
-                cloud_list.append(cw.get_adjusted_sky(last['skyir']['value'],cw.ambient_temp,cf.SkyTemperatureModel(30, 200, 6, 140, 100, 0, 0)))
-            except:
-                pass
-            if len(cloud_list) > 21:
-                excess = len(cloud_list)-21
-                del cloud_list[:excess]
-
-            if len(cloud_list):
-                clouds = round(get_avg(cloud_list),1)
-
-            mqtt_send({ 'clouds': { 'value': clouds, 'unit': 'delta C', 'epoch': math.floor(time.time()), 'cloud_list': cloud_list }})
-
-            time.sleep(max([interval - ( time.time() - last_refresh ),0]))
-
-    mainLoop()
+            last_refresh = time.monotonic()
 
-if __name__ == "__main__":
+            messages = run_cycle(cw, cloud_list, history, safety)
+            cycles += 1
+            mqtt_send(messages + export_metrics(cw, cycles))
+
+            if stale:
+                # Read the cached data from the unit once the first interval is out
+                stale = False
+                results = cw.query(METADATA)
+                if cache.update(METADATA, results):
+                    mqtt_send(results)
+
+            idle(cw, safety, last_refresh + interval)
+
+    def adaptiveLoop():
+        cloud_list = RingBuffer(args.cloud_window)
+        history = {}
+        from CloudWatcher.scheduler import Scheduler
+        sched = Scheduler(schedules(), time.monotonic(), args.sigma, args.hold)
+        cycles = 0
+        next_export = time.monotonic() + interval
+        # Static data is part of the schedule, and read again straight away
+        mqtt_send(cache.messages())
+        while True:
+            due = sched.due(time.monotonic())
+            if due:
+                with phase(profiler, "sample"):
+                    results = cw.query(due)
+                cache.update(due, results)
+                mqtt_send(adaptive_messages(cw, sched, due, results, time.monotonic(), cloud_list, history, safety))
+            if time.monotonic() >= next_export:
+                cycles += 1
+                next_export += interval
+                mqtt_send(export_metrics(cw, cycles))
+            idle(cw, safety, min(sched.next_due(), next_export))
+
+    if args.adaptive:
+        adaptiveLoop()
+    else:
+        mainLoop()
+
+async def runDevice(cw, post, alert, cache: MetadataCache):
+    '''
+    Sampling and aggregation of one AsyncCloudWatcher as separate tasks
+    joined by a queue.  Each interval's messages go to post() as a list,
+    safety alerts to alert().  Metadata is published from the cache, if
+    it has any, and read from the unit after the first interval.
+    '''
+    loop = asyncio.get_running_loop()
+    samples = asyncio.Queue()
+    safety = safety_monitor(alert)
+    # Without cached constants they are needed before decoding anything
+    stale = bool(cache.messages())
+    # Tasks started along the way, held as the loop holds tasks weakly and
+    # cancelled with the device
+    background = set()
+
+    async def refresh_metadata():
+        results = await cw.query(METADATA)
+        if cache.update(METADATA, results):
+            post(results)
+
+    async def sampler():
+        next_run = loop.time()
+        while True:
+            for i in range(0,args.samples):
+                with phase(profiler, "sample", False):
+                    results = await cw.query(sweep)
+                for temp in results:
+                    if temp:
+                        if safety:
+                            safety.check(temp)
+                        await samples.put(temp)
+            # End of interval marker
+            await samples.put(None)
+            next_run += interval
+            while next_run < loop.time():
+                # Missed a slot, stay on the original schedule
+                next_run += interval
+            await asyncio.sleep(next_run - loop.time())
+
+    async def aggregator():
+        cloud_list = RingBuffer(args.cloud_window)
+        history = {}
+        stats = {}
+        last = {}
+        cycles = 0
+        while True:
+            temp = await samples.get()
+            if temp is None:
+                with phase(profiler, "aggregate"):
+                    messages = summarize(cw, stats, last, cloud_list, history)
+                cycles += 1
+                post(messages + export_metrics(cw, cycles))
+                stats = {}
+                last = {}
+                if stale and cycles == 1:
+                    # Read the cached data from the unit once the first interval is out
+                    task = asyncio.create_task(refresh_metadata())
+                    background.add(task)
+                    task.add_done_callback(background.discard)
+            else:
+                with phase(profiler, "aggregate"):
+                    add_sample(stats, last, temp)
+
+    async def adaptive():
+        cloud_list = RingBuffer(args.cloud_window)
+        history = {}
+        from CloudWatcher.scheduler import Scheduler
+        sched = Scheduler(schedules(), loop.time(), args.sigma, args.hold)
+        cycles = 0
+        next_export = loop.time() + interval
+        while True:
+            due = sched.due(loop.time())
+            if due:
+                with phase(profiler, "sample", False):
+                    results = await cw.query(due)
+                cache.update(due, results)
+                post(adaptive_messages(cw, sched, due, results, loop.time(), cloud_list, history, safety))
+            if loop.time() >= next_export:
+                cycles += 1
+                next_export += interval
+                post(export_metrics(cw, cycles))
+            await asyncio.sleep(max(min(sched.next_due(), next_export) - loop.time(), 0))
+
+    async def watch():
+        # Takes the serial port between sweeps, the port lock is FIFO
+        while True:
+            start = loop.time()
+            safety.check(await cw.get_safety())
+            await asyncio.sleep(max(start + args.safety - loop.time(), 0))
+
+    await cw.start()
+    attach_heater(cw)
+    tasks = [ watch() ] if safety else []
+    if args.adaptive:
+        # Static data is part of the schedule
+        post(cache.messages())
+        await asyncio.gather(adaptive(), *tasks)
+        return
+    if stale:
+        post(cache.messages())
+    else:
+        results = await cw.query(METADATA)
+        cache.update(METADATA, results)
+        post(results)
+    try:
+        await asyncio.gather(sampler(), aggregator(), *tasks)
+    finally:
+        for task in background:
+            task.cancel()
+
+async def superviseDevice(port: str, prefix: str):
+    '''
+    Keep one device running, restarting it after any failure without
+    affecting the other devices.
+    '''
+    alert = lambda message: mqtt_alert(message, prefix)
+    while True:
+        cw = None
+        try:
+            cw = AsyncCloudWatcher(port, args.elevation )
+            units[port] = cw.metrics
+            attach_log(cw, port)
+            attach_model(cw, port)
+            attach_profiler(cw)
+            track_link(cw, prefix, alert)
+            await runDevice(cw, lambda messages: mqtt_send(messages, prefix), alert, metadata_cache(cw, port))
+        except Exception as e:
+            print(f"{port}: {e}, restarting in {args.restart} seconds")
+            if available.get(prefix) != b"offline":
+                available[prefix] = b"offline"
+                alert({ 'availability': available[prefix] })
+        finally:
+            if cw is not None:
+                if cw.heater is not None:
+                    cw.heater.stop()
+                cw.close()
+                for log in ( cw.recorder, cw.capture ):
+                    if log is not None:
+                        log.close()
+        await asyncio.sleep(args.restart)
+
+async def asyncMain(devices: list):
+    '''
+    Run every ( port, topic ) in devices from this process, sharing one MQTT
+    connection through the publisher queue.
+    '''
+    await asyncio.gather(*[ superviseDevice(port, prefix) for port, prefix in devices ])
+
+def unit_name(port: str) -> str:
+    return port.rstrip('/').split('/')[-1]
+
+def attach_log(cw: cf.CloudWatcher, port: str):
+    '''
+    Log every reading of the unit under --log and every block under
+    --capture, one directory per port
+    '''
+    if args.log or args.capture:
+        from CloudWatcher.tslog import CaptureLog, TimeSeriesLog
+    if args.log:
+        cw.recorder = TimeSeriesLog(os.path.join(args.log, unit_name(port)))
+    if args.capture:
+        cw.capture = CaptureLog(os.path.join(args.capture, unit_name(port)))
+
+def attach_model(cw: cf.CloudWatcher, port: str):
+    '''
+    Derive the clouds value of the unit with the sky temperature model, the
+    one loaded again on SIGHUP
+    '''
+    engines[port] = cw.derived
+    cw.derived.set("sky_model", sky_model)
+
+def parse_device(spec: str) -> tuple:
+    '''
+    PORT or PORT=TOPIC, the topic defaults to the topic prefix followed by
+    the port name.
+    '''
+    port, sep, prefix = spec.partition("=")
+    if not sep:
+        prefix = f"{topic}/{unit_name(port)}"
+    return ( port, prefix )
+
+def parse_broker(spec: str) -> tuple:
+    '''
+    HOST or HOST:PORT, the port defaults to 1883
+    '''
+    host, sep, port = spec.rpartition(":")
+    if sep and port.isdigit():
+        return ( host, int(port) )
+    return ( spec, 1883 )
+
+def parse_args(argv: list = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("-b", "--broker",   default = "",                             help="MQTT Broker to publish to")
+    parser.add_argument("-A", "--adaptive", action = 'store_true',                    help="Poll each sensor on its own schedule, faster while its readings change")
+    parser.add_argument("-a", "--asyncio",  action = 'store_true',                    help="Run sampling and publishing as separate asyncio tasks")
+    parser.add_argument("-b", "--broker",   default = "",                             help="MQTT Broker to publish to, HOST or HOST:PORT")
+    parser.add_argument(      "--cache",    default = "",                             help="Keep the serial number, firmware version and constants of each unit in this directory, e.g. /var/cache/cloudwatcher, to publish them at once after a restart")
+    parser.add_argument(      "--capture",  default = "",                             help="Capture every block received to daily files in a directory per port under this directory, for CloudWatcher.replay")
+    parser.add_argument("-c", "--cloud-window", default = 21, type=int,               help="Number of intervals averaged for the clouds value ( default 21 )")
+    parser.add_argument(      "--cloud-list", action = 'store_true',                  help="Include the raw cloud window in the clouds message")
+    parser.add_argument(      "--combined", action = 'store_true',                    help="Publish each interval as one JSON document on <topic>/state instead of a topic per reading")
+    parser.add_argument("-d", "--device",   action = 'append', default = [],          help="Run several units from one process, PORT or PORT=TOPIC, may be repeated ( implies --asyncio )")
+    parser.add_argument(      "--deadband", action = 'append', default = [],          help="Suppress readings which moved by no more than DELTA, KEY=DELTA or DELTA for every key, may be repeated ( needs --max-age )")
+    parser.add_argument(      "--discovery", default = "",                            help="Publish retained Home Assistant discovery configs of every reading with a unit under this topic prefix, usually homeassistant, only those which changed since the last run ( hashes kept under --cache )")
     parser.add_argument("-e", "--elevation", default = 0, type=int,                   help="Elevation above Sea Level in Meters ( for relative atmospheric pressure calculation )")
+    parser.add_argument(      "--error-limit", default = 3, type=int,                help="Failed reads in a row after which the unit is marked offline and its port reopened, commands failing at once meanwhile ( default 3, 0 disables )")
+    parser.add_argument(      "--heater",   default = "",                             help="Hold the rain sensor heater DELTA degrees above REFERENCE, ambient or dewpoint, as REFERENCE:DELTA optionally followed by ,mode=pid|hysteresis ,period=SECONDS ,kp= ,ki= ,kd= ,band= ,low= ,high= ,step=, publishing <topic>/heater every interval")
+    parser.add_argument(      "--hold",     default = 60, type=float,                 help="Seconds of fast polling after a sensor changes in adaptive mode ( default 60 )")
+    parser.add_argument("-H", "--history",  default = 0, type=int,                   help="Publish rolling statistics of every metric over this many intervals ( default 0, off )")
     parser.add_argument("-i", "--interval", default = 15, type=int,                   help="MQTT update interval ( default 15 second )")
-    parser.add_argument("-p", "--port",     default = "/dev/ttyAMA3",                 help="Comm port descriptor, e.g /dev/ttyUSB0 or COM1")
+    parser.add_argument("-l", "--log",      default = "",                             help="Log every reading to daily binary files in a directory per port under this directory")
+    parser.add_argument(      "--max-age",  default = 0, type=float,                  help="Republish unchanged readings after this many seconds, 0 publishes every reading ( default 0 )")
+    parser.add_argument(      "--max-backoff", default = 10, type=float,             help="Longest wait in seconds between attempts to reopen the port of an offline unit ( default 10 )")
+    parser.add_argument("-m", "--model",    default = "30,200,6,140,100,0,0",         help="Sky temperature model of the clouds value, K1,...,K7 or a JSON file from CloudWatcher.skymodel fit, read again on SIGHUP ( default 30,200,6,140,100,0,0 )")
+    parser.add_argument("-n", "--samples",  default = 5, type=int,                   help="Samples of each sensor per interval ( default 5 )")
+    parser.add_argument(      "--profile",  default = "",                             help="Time sampling, decoding, aggregation and publishing, published with the stats, and on SIGUSR1 start cProfile and tracemalloc, writing their reports to this directory on the next one")
+    parser.add_argument(      "--prom-file", default = "",                            help="Write Prometheus metrics to this file every interval")
+    parser.add_argument(      "--prom-port", default = 0, type=int,                   help="Serve Prometheus metrics over HTTP on this port")
+    parser.add_argument("-p", "--port",     default = "/dev/ttyAMA3",                 help="Comm port descriptor, e.g /dev/ttyUSB0 or COM1, or the address of a CloudWatcher.share daemon, unix:PATH or tcp:HOST:PORT")
+    parser.add_argument("-q", "--queue",    default = 1000, type=int,                 help="Messages held while the broker is slow or unreachable ( default 1000 )")
+    parser.add_argument(      "--queue-policy", default = "coalesce", choices = [ "coalesce", "drop" ], help="coalesce keeps only the newest queued message of a topic, both drop the oldest message when the queue is full ( default coalesce )")
+    parser.add_argument(      "--rain-limits", default = "2100,1700",               help="Rain sensor frequencies below which it is wet and raining, WET,RAIN ( default 2100,1700 )")
+    parser.add_argument("-R", "--restart",  default = 5, type=int,                   help="Seconds before restarting a failed unit in asyncio mode ( default 5 )")
     parser.add_argument("-r", "--retain",   action = 'store_true',                    help="MQTT Retain?")
+    parser.add_argument("-s", "--sigma",    default = 2.0, type=float,                help="Sigma clipping of the samples of each interval ( default 2, 0 disables )")
+    parser.add_argument(      "--safety",   default = 0, type=float,                  help="Poll rain and switch state every this many seconds between sweeps, publishing retained alerts on change ( default 0, off )")
+    parser.add_argument(      "--schedule", action = 'append', default = [],          help="Adaptive schedule of one command, CMD=PERIOD[,SAMPLES[,FAST_PERIOD[,THRESHOLD]]], e.g. S!=15,5,2,1.0")
+    parser.add_argument(      "--sink",     action = 'append', default = [],          help="Also write every message to KIND:TARGET, csv:DIR, parquet:DIR, jsonl:FILE or http:[HOST:]PORT, optionally followed by ,queue=N ,policy=coalesce|drop ,batch=N ,linger=SECONDS, may be repeated")
+    parser.add_argument("-S", "--stats",    default = 4, type=int,                   help="Publish command statistics every this many intervals ( default 4, 0 disables )")
+    parser.add_argument(      "--switch-interval", default = 0, type=float,          help="Longest a busy thread, such as a sink or the heater, holds the GIL while the serial loop waits, in seconds, e.g. 0.001 with busy sinks, 0 leaves Python's 0.005 ( default 0 )")
     parser.add_argument("-t", "--topic",    default = "cloudwatcher",                 help="MQTT topic prefix")
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
 
     broker      = args.broker
     retain      = args.retain
     topic       = args.topic
     interval    = args.interval
+    sky_model   = cf.SkyTemperatureModel.parse(args.model)
+    signal.signal(signal.SIGHUP, reload_model)
+    if args.profile:
+        from CloudWatcher.profiling import Profiler
+        profiler = Profiler(args.profile)
+        signal.signal(signal.SIGUSR1, profiler.toggle)
 
     lastMQTT    = {}
+    debug       = 0
+    tune_threads()
 
+    stages = []
     if broker!="":
-        import paho.mqtt.client as mqtt
         mqtt_connected = False
-        mqttc = mqtt.Client() #create new instance
-        mqttc.on_connect = mqtt_on_connect
-
-        try:
-            mqttc.connect(args.broker, port=1883) #connect to broker
-        except:
-            print("MQTT Broker ( {0:s} ) Connection Failed".format(args.broker))
+        # Messages are queued until connect_mqtt() attaches the client
+        publisher = make_publisher(None)
+        stages.append(publisher)
+        threading.Thread(target=connect_mqtt, daemon=True).start()
+    try:
+        output = make_output(stages)
+        if args.heater:
+            from CloudWatcher.heater import parse_heater
+            # Checked here rather than by every unit
+            parse_heater(None, args.heater)
+    except ( OSError, ValueError ) as e:
+        print(f"Fatal: {e}")
+        exit(1)
+    for stage in output.stages:
+        attach_profiler(stage)
 
-    cw = cf.CloudWatcher(args.port, args.elevation )
+    if args.prom_port:
+        metrics.serve(args.prom_port, lambda: metrics.prometheus_text(units))
 
-    main()
+    if args.device or args.asyncio:
+        import asyncio
+        from CloudWatcher.aio import AsyncCloudWatcher
+        devices = [ parse_device(d) for d in args.device ] or [ ( args.port, topic ) ]
+        if any(is_address(port) for port, prefix in devices):
+            print("Fatal: shared units need the synchronous mode, without -a and -d")
+            exit(1)
+        asyncio.run(asyncMain(devices))
+    else:
+        if is_address(args.port):
+            from CloudWatcher.proxy import SharedCloudWatcher
+            cw = SharedCloudWatcher(args.port, args.elevation )
+        else:
+            cw = cf.CloudWatcher(args.port, args.elevation )
+        units[args.port] = cw.metrics
+        attach_log(cw, args.port)
+        attach_model(cw, args.port)
+        attach_profiler(cw)
+        main()
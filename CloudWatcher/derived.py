@@ -0,0 +1,172 @@
+'''
+Values worked out from readings rather than read from the unit
+
+Each Derivation names the readings ( by key ) and settings it needs, and
+DerivedMetrics keeps the latest value of each, so a derived value is the
+same whichever order the commands run in.  It is only recomputed when one
+of its inputs changed, and goes out with the result holding its first
+input, e.g. the relative pressure with p!:
+
+    derived = DerivedMetrics()
+    derived.set("elevation", 350)
+    derived.update(cw.get_hum_temp())
+    result = cw.get_pressure()
+    derived.update(result)          # adds result["relpress"]
+
+CloudWatcher does this for every result it reads, see CloudWatcher.record.
+'''
+
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .readings import Reading, Sensor
+
+REL_PRESSURE    = Sensor("relpress", "Relative Pressure", "hPa")
+SQM_COMPENSATED = Sensor("mpsas_comp", "SQM Temperature Compensated", "mpsas")
+DEW_POINT       = Sensor("dewpoint", "Dew Point", "degC")
+ABS_HUMIDITY    = Sensor("abshum", "Absolute Humidity", "g/m3")
+# Sky minus modelled clear sky temperature, the clouds value.  The prefix is
+# for replay and skymodel, which write it to reading logs
+SKY_ADJUSTED    = Sensor("clouds", "Adjusted Sky Temp", "delta C", prefix=b"c")
+
+ABS_ZERO = 273.15
+# Magnus formula coefficients over water
+MAGNUS_A = 17.62
+MAGNUS_B = 243.12
+
+
+def adjusted_sky(Ts: float, Ta: float, model) -> float:
+    '''
+    Sky temperature Ts less the clear sky temperature the SkyTemperatureModel
+    gives for the ambient temperature Ta
+    '''
+    if abs((model.K2 / 10 - Ta)) < 1:
+        T67 = (
+            math.copysign(1, model.K6)
+            * math.copysign(1, Ta - model.K2 / 10)
+            * abs((model.K2 / 10 - Ta))
+        )
+    else:
+        T67 = (
+            model.K6
+            / 10
+            * math.copysign(1, Ta - model.K2 / 10)
+            * (math.log(abs((model.K2 / 10 - Ta))) / math.log(10) + model.K7 / 100)
+        )
+
+    Td = (
+        (model.K1 / 100) * (Ta - model.K2 / 10)
+        + (model.K3 / 100) * pow(math.exp(Ta * model.K4 / 1000), model.K5 / 100)
+        + T67
+    )
+
+    return round(Ts-Td, 2)
+
+def relative_pressure(press: float, temp: float, elevation: float) -> Optional[float]:
+    '''
+    Absolute pressure reduced to sea level
+    '''
+    if elevation <= -999:
+        return None
+    return round(press * math.pow( 1 - ( 0.0065 * elevation / ( temp + 0.0065 * elevation + ABS_ZERO )), -5.275 ), 1)
+
+def compensated_mpsas(mpsas: float, temp: float) -> float:
+    '''
+    Sky quality corrected for the temperature of the light sensor
+    '''
+    return round(( mpsas - 0.042 ) + ( 0.00212 * temp ), 2)
+
+def dew_point(humidity: float, temp: float) -> Optional[float]:
+    if humidity <= 0:
+        return None
+    gamma = math.log(min(humidity, 100) / 100) + MAGNUS_A * temp / ( MAGNUS_B + temp )
+    return round(MAGNUS_B * gamma / ( MAGNUS_A - gamma ), 1)
+
+def absolute_humidity(humidity: float, temp: float) -> float:
+    '''
+    Grams of water per cubic metre of air
+    '''
+    vapour = 6.112 * math.exp(MAGNUS_A * temp / ( MAGNUS_B + temp )) * max(min(humidity, 100), 0) / 100
+    return round(216.74 * vapour / ( ABS_ZERO + temp ), 2)
+
+class Derivation:
+    '''
+    sensor's value is compute() of the inputs, keys of readings or of
+    settings given to DerivedMetrics.set().  compute() may return None
+    when there is no value.
+    '''
+    __slots__ = ( "sensor", "inputs", "compute" )
+
+    def __init__(self, sensor: Sensor, inputs: Tuple[ str, ... ], compute: Callable[ ..., Optional[float] ]):
+        self.sensor = sensor
+        self.inputs = inputs
+        self.compute = compute
+
+# In dependency order, a derivation may take the key of an earlier one
+DERIVATIONS = [
+    Derivation(REL_PRESSURE,    ( "abspress", "hum_temp", "elevation" ), relative_pressure),
+    Derivation(SQM_COMPENSATED, ( "mpsas", "hum_temp" ),                 compensated_mpsas),
+    Derivation(DEW_POINT,       ( "hum", "hum_temp" ),                   dew_point),
+    Derivation(ABS_HUMIDITY,    ( "hum", "hum_temp" ),                   absolute_humidity),
+    Derivation(SKY_ADJUSTED,    ( "skyir", "hum_temp", "sky_model" ),    adjusted_sky),
+]
+
+MISSING = object()
+
+class DerivedMetrics:
+    '''
+    Latest inputs and derived values of one unit
+    '''
+    def __init__(self, derivations: Optional[ List[ Derivation ] ] = None):
+        self.derivations = DERIVATIONS if derivations is None else derivations
+        self.values: Dict[ str, object ] = {}
+        self.outputs: List[ Optional[float] ] = [ None ] * len(self.derivations)
+        # Derivations to compute again, by index
+        self.stale = set()
+        self.dependents: Dict[ str, List[int] ] = {}
+        for i, derivation in enumerate(self.derivations):
+            for name in derivation.inputs:
+                self.dependents.setdefault(name, []).append(i)
+        self.computed = 0
+
+    def set(self, name: str, value) -> None:
+        '''
+        Change a setting, e.g. "elevation" or "sky_model"
+        '''
+        self.changed(name, value)
+
+    def changed(self, name: str, value) -> None:
+        if self.values.get(name, MISSING) != value:
+            self.values[name] = value
+            self.stale.update(self.dependents.get(name, ()))
+
+    def update(self, result: Dict[ str, Reading ]) -> None:
+        '''
+        Take the readings in result as inputs and add to it the derived
+        readings whose first input it holds
+        '''
+        dependents = self.dependents
+        for key, reading in result.items():
+            if key in dependents:
+                self.changed(key, reading.value)
+        for i, derivation in enumerate(self.derivations):
+            if derivation.inputs[0] not in result:
+                continue
+            key = derivation.sensor.key
+            if i in self.stale:
+                self.stale.discard(i)
+                self.outputs[i] = self.compute(derivation)
+                if key in dependents:
+                    self.changed(key, self.outputs[i])
+            if self.outputs[i] is not None:
+                result[key] = Reading(derivation.sensor, self.outputs[i])
+
+    def compute(self, derivation: Derivation) -> Optional[float]:
+        args = [ self.values.get(name, MISSING) for name in derivation.inputs ]
+        if MISSING in args or None in args:
+            return None
+        self.computed += 1
+        try:
+            return derivation.compute(*args)
+        except ( ArithmeticError, ValueError, TypeError ):
+            return None
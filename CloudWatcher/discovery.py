@@ -0,0 +1,212 @@
+'''
+Home Assistant MQTT discovery
+
+Discovery keeps the sensors a unit has published, and gives the retained
+config message of each one Home Assistant needs to create its entity, once
+the serial number of the unit is known:
+
+    discovery = Discovery("/var/cache/cloudwatcher", "cloudwatcher")
+    configs = discovery.update(messages)
+    publisher.publish(configs, "homeassistant", retain=True, urgent=True, sent=discovery.sent)
+
+Configs are built from the Sensor of each reading ( key, name and unit ),
+and the SHA-256 of every config the broker was sent is kept in a small
+JSON file per unit, so a restarted cw2mqtt, or one which reconnected,
+sends only the configs which changed.  retry() sends again those which
+never went out, force() sends them all again, for a Home Assistant which
+restarted without the broker keeping them.
+'''
+
+import hashlib, json, os, time
+from typing import Dict, List, Optional
+
+from .derived import SKY_ADJUSTED
+from .readings import Reading, Sensor, value_of
+
+# Home Assistant spelling of units
+UNITS = { "degC": "°C", "delta C": "°C", "g/m3": "g/m³" }
+DEVICE_CLASSES = {
+    "degC": "temperature",
+    "hPa": "atmospheric_pressure",
+    "km/h": "wind_speed",
+    "V": "voltage",
+    "Hz": "frequency",
+}
+# Where the unit does not tell the class apart
+KEY_CLASSES = { "hum": "humidity", "clouds": None }
+# Sensors of published dicts, which carry no Sensor
+SENSORS = { SKY_ADJUSTED.key: SKY_ADJUSTED }
+# Readings describing the device rather than an entity
+DEVICE_KEYS = ( "serial", "version", "name" )
+
+
+def sensor_of(key: str, payload) -> Optional[Sensor]:
+    '''
+    The Sensor of a published reading with a unit, else None
+    '''
+    if type(payload) is Reading:
+        sensor = payload.sensor
+    elif isinstance(payload, dict) and "value" in payload and "unit" in payload:
+        sensor = SENSORS.get(key) or Sensor(key, payload.get("name"), payload["unit"])
+    else:
+        return None
+    return sensor if sensor.unit is not None else None
+
+def config(sensor: Sensor, prefix: str, device: dict, combined: bool = False, will: Optional[str] = None) -> dict:
+    '''
+    Discovery config of sensor, read from prefix/key, or prefix/state with
+    `combined`.  The sensor is available while prefix/availability and the
+    will topic of the process, when another, are both online.
+    '''
+    key = sensor.key
+    node = device["identifiers"][0]
+    availability = [ f"{prefix}/availability" ]
+    if will is not None and will not in availability:
+        availability.append(will)
+    c = {
+        "name": sensor.name or key,
+        "unique_id": f"{node}_{key}",
+        "object_id": f"{node}_{key}",
+        "availability": [ { "topic": t } for t in availability ],
+        "availability_mode": "all",
+        "unit_of_measurement": UNITS.get(sensor.unit, sensor.unit),
+        "state_class": "measurement",
+        "device": device,
+    }
+    if combined:
+        # A document holds only the readings which passed the deadband
+        c["state_topic"] = f"{prefix}/state"
+        c["value_template"] = f"{{{{ value_json['{key}'].value if '{key}' in value_json else this.state }}}}"
+    else:
+        c["state_topic"] = f"{prefix}/{key}"
+        c["value_template"] = "{{ value_json.value }}"
+    device_class = KEY_CLASSES[key] if key in KEY_CLASSES else DEVICE_CLASSES.get(sensor.unit)
+    if device_class is not None:
+        c["device_class"] = device_class
+    return c
+
+def digest(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+class Discovery:
+    '''
+    Discovery configs of the unit publishing under prefix, the SHA-256 of
+    those published kept in directory/discovery-<serial>.json.  With an
+    empty directory they are kept in memory only.  will is the topic of
+    the MQTT last will, when it is not prefix/availability.
+    '''
+    def __init__(self, directory: str, prefix: str, combined: bool = False, will: Optional[str] = None):
+        self.directory = directory
+        self.prefix = prefix
+        self.combined = combined
+        self.will = will
+        self.device: Dict[ str, object ] = {}
+        self.sensors: Dict[ str, Sensor ] = {}
+        # Digest by config topic, of the configs sent
+        self.hashes: Dict[ str, str ] = {}
+        # Digest by config topic, of the configs handed out but not sent yet
+        self.sending: Dict[ str, str ] = {}
+        self.path = ""
+        # New sensors or device data since the last configs
+        self.dirty = False
+
+    def observe(self, messages: list) -> None:
+        for message in messages:
+            for key, payload in message.items():
+                if key in DEVICE_KEYS:
+                    value = value_of(payload)
+                    if self.device.get(key) != value:
+                        self.device[key] = value
+                        self.dirty = True
+                elif key not in self.sensors:
+                    sensor = sensor_of(key, payload)
+                    if sensor is not None:
+                        self.sensors[key] = sensor
+                        self.dirty = True
+
+    def update(self, messages: list) -> List[ dict ]:
+        '''
+        Take the sensors and device data of messages, returns the configs
+        which changed as messages, keyed by topic under the discovery prefix.
+        Each is remembered once passed to sent().
+        '''
+        self.observe(messages)
+        serial = self.device.get("serial")
+        if not self.dirty or not serial:
+            return []
+        self.dirty = False
+        serial = "".join(c if c.isalnum() else "_" for c in str(serial))
+        node = f"cloudwatcher_{serial}"
+        if not self.path and self.directory:
+            self.path = os.path.join(self.directory, f"discovery-{serial}.json")
+            self.load()
+        device = {
+            "identifiers": [ node ],
+            "name": self.device.get("name") or f"CloudWatcher {serial}",
+            "manufacturer": "Lunatico",
+            "model": "AAG CloudWatcher",
+            "serial_number": str(self.device["serial"]),
+        }
+        if self.device.get("version") is not None:
+            device["sw_version"] = str(self.device["version"])
+        configs = {}
+        for key, sensor in self.sensors.items():
+            payload = config(sensor, self.prefix, device, self.combined, self.will)
+            topic = f"sensor/{node}/{key}/config"
+            h = digest(payload)
+            if h in ( self.hashes.get(topic), self.sending.get(topic) ):
+                continue
+            self.sending[topic] = h
+            configs[topic] = payload
+        if not configs:
+            return []
+        return [ configs ]
+
+    def sent(self, topic: str) -> None:
+        '''
+        Remember the config of topic as sent, and save the digests.  Called
+        by the publishing thread once the broker has it.
+        '''
+        h = self.sending.pop(topic, None)
+        if h is None:
+            return
+        self.hashes[topic] = h
+        self.save()
+
+    def retry(self) -> None:
+        '''
+        Send again with the next update the configs which were handed out
+        but never sent, e.g. after reconnecting.  Safe from any thread.
+        '''
+        self.sending = {}
+        self.dirty = True
+
+    def force(self) -> None:
+        '''
+        Send every config again with the next update, e.g. when Home
+        Assistant comes online.  Safe from any thread.
+        '''
+        self.hashes = {}
+        self.sending = {}
+        self.dirty = True
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ( OSError, ValueError ):
+            return
+        if isinstance(data, dict) and isinstance(data.get('hashes'), dict):
+            self.hashes = data['hashes']
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({ 'prefix': self.prefix, 'saved': time.time(), 'hashes': self.hashes }, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Cannot write {self.path}: {e}")
@@ -0,0 +1,263 @@
+'''
+Closed loop control of the rain sensor heater
+
+The rain sensor dries off and sheds dew only while it is warmer than the
+air.  HeaterController holds its temperature a set delta above the ambient
+temperature or the dew point, setting the heater PWM from a thread of its
+own every `period` seconds:
+
+    heater = HeaterController(cw, "dewpoint", 4)
+    cw.heater = heater
+    heater.start()
+
+The thread keeps its cadence whatever the sampling loop is doing, and
+never reads the unit for a reading the sampling sweep already has: every
+result passes through observe(), so a tick only queries C! ( and t!, h!
+for the reference ) when the sweep has not read them lately, and only
+sends P####! when the level moves by `step` percent or more.  Exchanges take the CloudWatcher's
+lock, or run in the event loop of an AsyncCloudWatcher.
+
+When cw2mqtt stops, the unit falls back to its auto shutdown heat level.
+'''
+
+import threading, time
+from typing import Dict, Optional, Tuple
+
+from . import RAIN_NTC
+from .stats import RingBuffer
+
+REFERENCES = { "ambient": "hum_temp", "dewpoint": "dewpoint" }
+# Commands giving each input
+SOURCES = { "sensor": [ b"C!" ], "hum_temp": [ b"t!" ], "dewpoint": [ b"t!", b"h!" ] }
+
+
+class HeaterController:
+    '''
+    PID, or with mode "hysteresis" on / off, control of the rain sensor
+    temperature to `delta` degrees above the reference, "ambient" or
+    "dewpoint".  Output levels are percent, from `low` to `high`.
+
+    The PID takes the derivative of the measurement rather than of the
+    error, so a jump of the dew point does not kick the heater, and stops
+    integrating while the output is held at a limit.  In hysteresis mode
+    the heater goes to `high` below target - band and to `low` above
+    target + band.
+    '''
+    period = 5.0
+    kp = 20.0
+    ki = 0.5
+    kd = 0.0
+    band = 1.0
+    low = 0.0
+    high = 100.0
+    # Smallest change of level sent to the unit, percent
+    step = 1.0
+    # Oldest reference reading used before reading it again, seconds
+    reference_age = 60.0
+    # Ticks kept for the timing statistics
+    window = 120
+
+    def __init__(self, cw, reference: str = "ambient", delta: float = 4.0, mode: str = "pid", **settings):
+        if reference not in REFERENCES:
+            raise ValueError(f"Unknown heater reference {reference}, expected one of {', '.join(REFERENCES)}")
+        if mode not in ( "pid", "hysteresis" ):
+            raise ValueError(f"Unknown heater mode {mode}")
+        for name, value in settings.items():
+            if name not in ( "period", "kp", "ki", "kd", "band", "low", "high", "step" ):
+                raise ValueError(f"Unknown heater setting {name}")
+            setattr(self, name, float(value))
+        if self.period <= 0 or not 0 <= self.low <= self.high <= 100:
+            raise ValueError("Heater period must be positive and 0 <= low <= high <= 100")
+        self.cw = cw
+        self.reference = reference
+        self.delta = delta
+        self.mode = mode
+        self.loop = None
+        # ( time.monotonic(), value ) by input
+        self.seen: Dict[ str, Tuple[ float, float ] ] = {}
+        self.level: Optional[float] = None
+        self.pwm: Optional[int] = None
+        self.target: Optional[float] = None
+        self.integral = 0.0
+        self.last: Optional[ Tuple[ float, float ] ] = None
+        self.heating = False
+        self.stopping = threading.Event()
+        self.thread = None
+        self.ticks = 0
+        self.missed = 0
+        self.overruns = 0
+        self.queries = 0
+        self.writes = 0
+        self.errors = 0
+        self.periods = RingBuffer(self.window)
+        self.jitter = RingBuffer(self.window)
+        self.serial = RingBuffer(self.window)
+
+    def start(self) -> None:
+        '''
+        Start the control thread, for an AsyncCloudWatcher once it is started
+        '''
+        self.loop = getattr(self.cw, "loop", None)
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def observe(self, result: dict) -> None:
+        '''
+        Take the inputs from a result the unit gave, called by
+        CloudWatcher.record from whichever thread read it
+        '''
+        now = time.monotonic()
+        reading = result.get("temp")
+        if reading is not None and reading.sensor is RAIN_NTC:
+            self.seen["sensor"] = ( now, reading.value )
+        for key in ( "hum_temp", "dewpoint" ):
+            reading = result.get(key)
+            if reading is not None:
+                self.seen[key] = ( now, reading.value )
+        reading = result.get("pwm")
+        if reading is not None and self.pwm is not None and reading.raw != self.pwm:
+            # Changed behind our back, e.g. the unit restarted: send it again
+            self.pwm = None
+
+    def fresh(self, name: str, now: float, age: float) -> Optional[float]:
+        seen = self.seen.get(name)
+        if seen is None or now - seen[0] > age:
+            return None
+        return seen[1]
+
+    def call(self, method, *args):
+        '''
+        method(*args) of the CloudWatcher, in its event loop for an
+        AsyncCloudWatcher
+        '''
+        start = time.monotonic()
+        try:
+            if self.loop is None:
+                return method(*args)
+            import asyncio
+            return asyncio.run_coroutine_threadsafe(method(*args), self.loop).result(self.cw.max_wait * 4)
+        finally:
+            self.serial.append(time.monotonic() - start)
+
+    def run(self) -> None:
+        # Ticks are due on a fixed grid from the start, so a late one does
+        # not push the next ones back
+        due = time.monotonic()
+        previous = None
+        while not self.stopping.is_set():
+            remaining = due - time.monotonic()
+            if remaining > 0 and self.stopping.wait(remaining):
+                return
+            now = time.monotonic()
+            self.jitter.append(( now - due ) * 1000)
+            if previous is not None:
+                self.periods.append(now - previous)
+            previous = now
+            try:
+                self.tick(now)
+            except Exception as e:
+                self.errors += 1
+                print(f"Heater: {e}")
+            due += self.period
+            late = time.monotonic() - due
+            if late > 0:
+                # Skip the slots the tick ran over
+                skipped = int(late // self.period) + 1
+                self.overruns += skipped
+                due += skipped * self.period
+
+    def tick(self, now: float) -> None:
+        self.ticks += 1
+        key = REFERENCES[self.reference]
+        commands = []
+        if self.fresh("sensor", now, self.period) is None:
+            commands += SOURCES["sensor"]
+        if self.fresh(key, now, self.reference_age) is None:
+            commands += SOURCES[key]
+        if commands:
+            self.queries += 1
+            self.call(self.cw.query, commands)
+            now = time.monotonic()
+        sensor = self.fresh("sensor", now, self.period * 2)
+        reference = self.fresh(key, now, self.reference_age * 2)
+        if sensor is None or reference is None:
+            self.missed += 1
+            return
+        self.target = reference + self.delta
+        self.level = self.control(sensor, self.target, now)
+        pwm = round(self.level * 1023 / 100)
+        # Reaching a limit always goes out, however small the change
+        if pwm != self.pwm and ( self.pwm is None or abs(pwm - self.pwm) >= self.step * 1023 / 100 or self.level in ( self.low, self.high ) ):
+            if self.call(self.cw.set_pwm, pwm) is not None:
+                self.pwm = pwm
+                self.writes += 1
+
+    def control(self, temp: float, target: float, now: float) -> float:
+        '''
+        Heater level in percent for the sensor temperature temp
+        '''
+        if self.mode == "hysteresis":
+            if temp < target - self.band:
+                self.heating = True
+            elif temp > target + self.band:
+                self.heating = False
+            return self.high if self.heating else self.low
+
+        error = target - temp
+        derivative = 0.0
+        dt = 0.0
+        if self.last is not None:
+            dt = now - self.last[0]
+            if dt > 0:
+                derivative = ( temp - self.last[1] ) / dt
+        self.last = ( now, temp )
+        output = self.kp * error + self.integral - self.kd * derivative
+        if self.low < output < self.high or ( output >= self.high and error < 0 ) or ( output <= self.low and error > 0 ):
+            self.integral = min(max(self.integral + self.ki * error * dt, self.low), self.high)
+            output = self.kp * error + self.integral - self.kd * derivative
+        return min(max(output, self.low), self.high)
+
+    def snapshot(self) -> dict:
+        sensor = self.seen.get("sensor")
+        jitter = self.jitter.summary(2)
+        if jitter:
+            jitter['p95'] = round(self.jitter.percentile(95), 2)
+        return {
+            'mode': self.mode,
+            'reference': self.reference,
+            'target': None if self.target is None else round(self.target, 2),
+            'sensor': None if sensor is None else sensor[1],
+            'level': None if self.level is None else round(self.level, 1),
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'overruns': self.overruns,
+            'queries': self.queries,
+            'writes': self.writes,
+            'errors': self.errors,
+            'period': self.periods.summary(4),
+            'jitter_ms': jitter,
+            'serial': self.serial.summary(3),
+        }
+
+def parse_heater(cw, spec: str) -> HeaterController:
+    '''
+    REFERENCE:DELTA[,mode=pid|hysteresis][,period=S][,kp=][,ki=][,kd=][,band=][,low=][,high=][,step=]
+    '''
+    reference, sep, rest = spec.partition(":")
+    delta, *settings = rest.split(",")
+    try:
+        delta = float(delta)
+    except ValueError:
+        raise ValueError(f"Bad heater {spec}, expected REFERENCE:DELTA with REFERENCE one of {', '.join(REFERENCES)}")
+    options = {}
+    for setting in settings:
+        name, sep, value = setting.partition("=")
+        options[name] = value
+    return HeaterController(cw, reference, delta, **options)
@@ -0,0 +1,94 @@
+'''
+Unit metadata kept between runs
+
+The serial number, firmware version and constants of a unit are read
+before anything else, and the constants are needed to decode its readings.
+MetadataCache keeps the last responses in a small JSON file per port, so a
+restarted cw2mqtt can restore the constants and publish the metadata at
+once, and read them from the unit later:
+
+    cache = MetadataCache("/var/cache/cloudwatcher/ttyUSB0.json", "/dev/ttyUSB0")
+    if cache.load():
+        cw.set_constants(cache.constants())
+    ...
+    if cache.update(METADATA, cw.query(METADATA)):
+        publish(cache.messages())
+'''
+
+import json, os, time
+from typing import Dict, List
+
+from .readings import dumps, value_of
+
+# Serial number, firmware version and constants
+METADATA = [ b"K!", b"B!", b"M!" ]
+
+
+class MetadataCache:
+    '''
+    Responses to the METADATA commands of the unit on `port`, as plain
+    dicts by command.  A file written for another port is ignored.  With
+    an empty path nothing is read or written.
+    '''
+    def __init__(self, path: str, port: str):
+        self.path = path
+        self.port = port
+        self.responses: Dict[ str, dict ] = {}
+
+    def load(self) -> bool:
+        '''
+        Read the file, returns True when it held every METADATA response
+        '''
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ( OSError, ValueError ):
+            return False
+        if not isinstance(data, dict) or data.get('port') != self.port:
+            return False
+        responses = data.get('responses')
+        if not isinstance(responses, dict) or not all(isinstance(responses.get(str(cmd, "ascii")), dict) for cmd in METADATA):
+            return False
+        self.responses = responses
+        return True
+
+    def messages(self) -> List[ dict ]:
+        return [ self.responses[str(cmd, "ascii")] for cmd in METADATA if str(cmd, "ascii") in self.responses ]
+
+    def constants(self) -> Dict[ str, float ]:
+        '''
+        The constants response as CloudWatcher.set_constants() takes them
+        '''
+        return { key: value_of(payload) for key, payload in self.responses.get("M!", {}).items() }
+
+    def update(self, commands: list, results: list) -> bool:
+        '''
+        Take the responses to METADATA commands among commands, saving the
+        file when any changed.  Returns True when one did.
+        '''
+        # Through JSON to compare with what was loaded
+        fresh = { str(cmd, "ascii"): json.loads(dumps(result)) for cmd, result in zip(commands, results) if cmd in METADATA and result }
+        if "B!" in self.responses and fresh.get("B!", self.responses["B!"]) != self.responses["B!"]:
+            # New firmware, whatever else was cached may be stale
+            self.responses = {}
+        changed = False
+        for key, plain in fresh.items():
+            if self.responses.get(key) != plain:
+                self.responses[key] = plain
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def save(self) -> None:
+        if not self.path:
+            # Kept in memory only
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({ 'port': self.port, 'saved': time.time(), 'responses': self.responses }, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Cannot write {self.path}: {e}")
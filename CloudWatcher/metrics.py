@@ -0,0 +1,170 @@
+'''
+Per command latency and error counters for CloudWatcher
+
+Every CloudWatcher carries a Metrics instance as `cw.metrics`.  snapshot()
+gives a plain dict suitable for JSON, prometheus_text() the Prometheus
+text exposition format for one or more units.
+'''
+
+from array import array
+import bisect, os, threading
+from typing import Callable, Dict
+
+# Upper bounds in seconds, a 15 byte block takes ~16 ms at 9600 baud
+LATENCY_BUCKETS = ( 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5 )
+
+
+class Histogram:
+    __slots__ = ( "counts", "sum", "count" )
+
+    def __init__(self):
+        self.counts = array("L", bytes(array("L").itemsize * ( len(LATENCY_BUCKETS) + 1 )))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'buckets': dict(zip([ str(b) for b in LATENCY_BUCKETS ] + [ "+Inf" ], self.counts)),
+        }
+
+class CommandStats:
+    __slots__ = ( "latency", "timeouts" )
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.timeouts = 0
+
+class Metrics:
+    '''
+    Counters updated by CloudWatcher as it talks to the unit
+    '''
+    commands: Dict[ str, CommandStats ]
+    unknown: Dict[ str, int ]
+
+    def __init__(self):
+        self.commands = {}
+        self.unknown = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.rejected = 0
+
+    def observe(self, command: str, seconds: float, ok: bool) -> None:
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.latency.observe(seconds)
+        if not ok:
+            stats.timeouts += 1
+
+    def snapshot(self) -> dict:
+        return {
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'timeouts': self.timeouts,
+            'reconnects': self.reconnects,
+            'rejected': self.rejected,
+            'unknown': dict(self.unknown),
+            'commands': {
+                cmd: {
+                    'timeouts': s.timeouts,
+                    'mean': round(s.latency.sum / s.latency.count, 6) if s.latency.count else None,
+                    'latency': s.latency.snapshot(),
+                } for cmd, s in self.commands.items()
+            },
+        }
+
+def quote(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text(units: Dict[ str, Metrics ], prefix: str = "cloudwatcher") -> str:
+    '''
+    Prometheus text format for the Metrics of each unit, keyed by port.
+    Safe to call from another thread while the units are running.
+    '''
+    lines = []
+    def family(name: str, kind: str, text: str):
+        lines.append(f"# HELP {prefix}_{name} {text}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+    family("command_seconds", "histogram", "Time from sending a command to its handshake block")
+    for port, m in list(units.items()):
+        for cmd, s in list(m.commands.items()):
+            labels = f'port="{quote(port)}",command="{quote(cmd)}"'
+            total = 0
+            for bound, n in zip([ str(b) for b in LATENCY_BUCKETS ] + [ "+Inf" ], s.latency.counts):
+                total += n
+                lines.append(f'{prefix}_command_seconds_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f"{prefix}_command_seconds_sum{{{labels}}} {s.latency.sum}")
+            lines.append(f"{prefix}_command_seconds_count{{{labels}}} {s.latency.count}")
+
+    family("command_timeouts_total", "counter", "Commands without a handshake block in time")
+    for port, m in list(units.items()):
+        for cmd, s in list(m.commands.items()):
+            lines.append(f'{prefix}_command_timeouts_total{{port="{quote(port)}",command="{quote(cmd)}"}} {s.timeouts}')
+
+    family("read_timeouts_total", "counter", "Reads which timed out, including buffer resets")
+    for port, m in list(units.items()):
+        lines.append(f'{prefix}_read_timeouts_total{{port="{quote(port)}"}} {m.timeouts}')
+
+    family("reconnects_total", "counter", "Times the port was reopened after the link went down")
+    for port, m in list(units.items()):
+        lines.append(f'{prefix}_reconnects_total{{port="{quote(port)}"}} {m.reconnects}')
+
+    family("rejected_total", "counter", "Commands failed at once while the link was down")
+    for port, m in list(units.items()):
+        lines.append(f'{prefix}_rejected_total{{port="{quote(port)}"}} {m.rejected}')
+
+    family("unknown_blocks_total", "counter", "Blocks with a prefix no handler knows")
+    for port, m in list(units.items()):
+        for key, n in list(m.unknown.items()):
+            lines.append(f'{prefix}_unknown_blocks_total{{port="{quote(port)}",prefix="{quote(key)}"}} {n}')
+
+    family("bytes_read_total", "counter", "Bytes received from the unit")
+    for port, m in list(units.items()):
+        lines.append(f'{prefix}_bytes_read_total{{port="{quote(port)}"}} {m.bytes_read}')
+
+    family("bytes_written_total", "counter", "Bytes sent to the unit")
+    for port, m in list(units.items()):
+        lines.append(f'{prefix}_bytes_written_total{{port="{quote(port)}"}} {m.bytes_written}')
+
+    return "\n".join(lines) + "\n"
+
+def write_textfile(path: str, text: str) -> None:
+    '''
+    Replace path atomically, for the node_exporter textfile collector
+    '''
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def serve(port: int, text: Callable[ [], str ], host: str = "") -> "ThreadingHTTPServer":
+    '''
+    Serve text() as /metrics from a background thread
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(( host, port ), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,161 @@
+'''
+Profiling of a running cw2mqtt
+
+Profiler times phases of the work where they are called, through the
+profiler hook of the objects doing it, so nothing is timed unless
+profiling is asked for:
+
+    profiler = Profiler("/var/cache/cloudwatcher/profile")
+    cw.profiler = profiler
+    with phase(profiler, "sample"):
+        results = cw.query(sweep)
+    signal.signal(signal.SIGUSR1, profiler.toggle)
+
+Every phase keeps its number of calls, wall and CPU time and longest call
+since the start.  Phases nest: sample includes the decode and record of
+its results, so sample wall less CPU time is time spent waiting on the
+unit.  Awaits are timed on the wall clock only, their CPU time would
+include other tasks.
+
+The first SIGUSR1 starts cProfile, on the thread the signal is handled on
+( the sampling loop ), and tracemalloc; the next one stops them and writes
+cw2mqtt-<time>.prof ( for pstats or snakeviz ) with its top functions in
+-cpu.txt, the allocations since the start in -memory.txt and a
+.tracemalloc snapshot, and the phase timers in -phases.json.
+'''
+
+import contextlib, json, os, threading, time
+from typing import Dict, Iterator, Optional
+
+# Functions and allocation sites listed in the text reports
+TOP = 40
+# Frames of stack kept by tracemalloc for every allocation
+FRAMES = 10
+# What phase() gives without a profiler, reusable
+UNTIMED = contextlib.nullcontext()
+
+
+class Phase:
+    __slots__ = ( "count", "wall", "cpu", "max", "clock" )
+
+    def __init__(self, clock: bool = True):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max = 0.0
+        # False for awaits, whose CPU time is not theirs alone
+        self.clock = clock
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'wall': round(self.wall, 6),
+            'cpu': round(self.cpu, 6) if self.clock else None,
+            'max': round(self.max, 6),
+        }
+
+class Profiler:
+    '''
+    Phase timers, and cProfile / tracemalloc snapshots written to directory
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.phases: Dict[ str, Phase ] = {}
+        self.lock = threading.Lock()
+        self.start = ( time.monotonic(), time.process_time() )
+        self.profile = None
+        self.memory = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str, clock: bool = True) -> Iterator[ None ]:
+        '''
+        Time the enclosed code as part of phase name, on the wall clock only
+        without `clock`
+        '''
+        timer = self.phases.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.phases.setdefault(name, Phase(clock))
+        wall = time.perf_counter()
+        cpu = time.thread_time() if clock else 0.0
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu if clock else 0.0
+            with self.lock:
+                timer.count += 1
+                timer.wall += wall
+                timer.cpu += cpu
+                if wall > timer.max:
+                    timer.max = wall
+
+    def snapshot(self) -> dict:
+        '''
+        Phase timers, with the wall and CPU time of the whole process
+        '''
+        with self.lock:
+            phases = { name: phase.snapshot() for name, phase in self.phases.items() }
+        return {
+            'wall': round(time.monotonic() - self.start[0], 3),
+            'cpu': round(time.process_time() - self.start[1], 3),
+            'profiling': self.profile is not None,
+            'phases': phases,
+        }
+
+    def toggle(self, signum=None, frame=None) -> None:
+        '''
+        Start cProfile and tracemalloc, or stop them and write the reports.
+        A SIGUSR1 handler.
+        '''
+        if self.profile is None:
+            self.begin()
+        else:
+            try:
+                base = self.dump()
+                print(f"Profile written to {base}.*")
+            except OSError as e:
+                print(f"Cannot write the profile: {e}")
+
+    def begin(self) -> None:
+        import cProfile, importlib, tracemalloc
+        # Imported now to keep it out of the allocations reported by dump()
+        importlib.import_module("pstats")
+        tracemalloc.start(FRAMES)
+        self.memory = tracemalloc.take_snapshot()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        print(f"Profiling, signal again to write the reports to {self.directory}")
+
+    def dump(self) -> str:
+        '''
+        Stop profiling and write the reports, returns their common path prefix
+        '''
+        import pstats, tracemalloc
+        profile, self.profile = self.profile, None
+        profile.disable()
+        memory = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        skip = ( tracemalloc.Filter(False, tracemalloc.__file__), )
+        memory = memory.filter_traces(skip)
+        allocated = memory.compare_to(self.memory.filter_traces(skip), "lineno")
+        self.memory = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, time.strftime("cw2mqtt-%Y%m%d-%H%M%S"))
+        profile.dump_stats(base + ".prof")
+        with open(base + "-cpu.txt", "w") as f:
+            pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(TOP)
+        memory.dump(base + ".tracemalloc")
+        with open(base + "-memory.txt", "w") as f:
+            for stat in allocated[:TOP]:
+                print(stat, file=f)
+        with open(base + "-phases.json", "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        return base
+
+def phase(profiler: Optional[ Profiler ], name: str, clock: bool = True):
+    '''
+    Profiler.phase of profiler, or a context which times nothing without one
+    '''
+    return UNTIMED if profiler is None else profiler.phase(name, clock)
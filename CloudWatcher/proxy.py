@@ -0,0 +1,142 @@
+'''
+Client of a CloudWatcher.share daemon
+
+    cw = SharedCloudWatcher("unix:/run/cloudwatcher/ttyUSB0.sock", HASL)
+    print(cw.get_sky_irtemp())
+
+On the socket a request is one length byte followed by the command, e.g.
+b"\\x02S!", and is answered in order by a big endian 16 bit block count
+followed by the 15 byte blocks of the response, without the handshake.  A
+count of 0xFFFF means the unit did not answer.
+
+Kept apart from share, which needs asyncio, so clients start quickly.
+'''
+
+import socket, struct, time
+from typing import List, Optional, Tuple
+
+from . import BLOCK_SIZE, CloudWatcher, CloudWatcherException, command_name
+
+COUNT = struct.Struct(">H")
+NO_RESPONSE = 0xFFFF
+
+
+def parse_address(address: str) -> Tuple[ str, object ]:
+    '''
+    unix:PATH or tcp:HOST:PORT, as ( family, path or ( host, port ) )
+    '''
+    scheme, sep, rest = address.partition(":")
+    if scheme == "unix" and rest:
+        return ( "unix", rest )
+    if scheme == "tcp" and rest:
+        host, sep, port = rest.rpartition(":")
+        return ( "tcp", ( host or "localhost", int(port) ) )
+    raise ValueError(f"Bad address {address}, expected unix:PATH or tcp:HOST:PORT")
+
+class SharedCloudWatcher(CloudWatcher):
+    '''
+    CloudWatcher talking to a share daemon instead of a serial port.  Blocks
+    are decoded here, so constants, recorder and capture work as with a
+    local unit.  Commands given to query() together go out together.  A
+    lost connection gives None results, like a unit which does not answer,
+    and is reopened on the next command.
+    '''
+    sock: Optional[socket.socket] = None
+
+    def __init__(self, address: str, HASL: float):
+        super().__init__(None, HASL)
+        self.address = address
+        self.family, self.where = parse_address(address)
+        self.open()
+
+    def open(self) -> None:
+        self.close()
+        try:
+            if self.family == "unix":
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.max_wait)
+                sock.connect(self.where)
+            else:
+                sock = socket.create_connection(self.where, self.max_wait)
+        except OSError as e:
+            raise CloudWatcherException(f"Fatal: cannot connect to {self.address}: {e}")
+        # A response may queue behind those of other clients
+        sock.settimeout(self.max_wait * 4)
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self.errors = 0
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def exchange(self, commands: List[ bytes ]) -> List[ Optional[ List[ bytes ] ] ]:
+        '''
+        Send commands in one write, returns the blocks of each response
+        '''
+        try:
+            if self.sock is None:
+                self.open()
+            request = b"".join(bytes(( len(cmd), )) + cmd for cmd in commands)
+            self.sock.sendall(request)
+            self.metrics.bytes_written += len(request)
+            results = []
+            for cmd in commands:
+                head = self.rfile.read(COUNT.size)
+                if len(head) < COUNT.size:
+                    raise ConnectionError("connection closed")
+                count = COUNT.unpack(head)[0]
+                if count == NO_RESPONSE:
+                    results.append(None)
+                    continue
+                data = self.rfile.read(count * BLOCK_SIZE)
+                if len(data) < count * BLOCK_SIZE:
+                    raise ConnectionError("connection closed")
+                self.metrics.bytes_read += COUNT.size + len(data)
+                results.append([ data[i:i + BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE) ])
+            return results
+        except ( OSError, CloudWatcherException ) as e:
+            # The stream may be out of step, start over on the next command
+            print(f"{self.address}: {e}")
+            self.close()
+            return [ None ] * len(commands)
+
+    def decode(self, blocks: Optional[ List[ bytes ] ]) -> Optional[dict]:
+        # Link state follows the answers, the daemon does the reopening
+        self.read_done(blocks is not None)
+        if blocks is None:
+            return None
+        result = {}
+        for block in blocks:
+            self.merge_block(result, block)
+        self.record(result)
+        return result
+
+    def command(self, cmd: bytes) -> Optional[dict]:
+        return self.query([ cmd ])[0]
+
+    def query(self, commands: list, pipeline: bool = True) -> list:
+        '''
+        See CloudWatcher.query, the daemon runs the commands in order
+        '''
+        commands = [ c if isinstance(c, bytes) else str.encode(c, "ascii") for c in commands ]
+        with self.lock:
+            start = time.perf_counter()
+            results = []
+            for cmd, blocks in zip(commands, self.exchange(commands)):
+                result = self.decode(blocks)
+                now = time.perf_counter()
+                self.metrics.observe(command_name(cmd), now - start, result is not None)
+                start = now
+                results.append(result)
+            return results
+
+    def reset_serial_buffers(self) -> bool:
+        # The daemon resets the unit before every command
+        return True
+
+    def write(self, data: bytes) -> None:
+        with self.lock:
+            self.exchange([ data ])
@@ -0,0 +1,279 @@
+'''
+Buffered MQTT publishing for cw2mqtt
+
+Readings are filtered by the caller and queued; a background thread
+serializes ( see readings.dumps ) and publishes them while the paho
+network loop runs on its own thread, so a slow or unreachable broker never
+holds up sampling.
+
+    publisher = Publisher(mqttc, deadband=Deadband({ "wind": 1.0 }, 0.1, 300))
+    publisher.start()
+    publisher.publish(messages, "cloudwatcher")
+'''
+
+import collections, functools, itertools, json, threading, time
+from typing import Callable, Dict, Optional
+
+from .profiling import phase
+from .readings import dumps, value_of
+
+# Seconds an urgent message with a `sent` callback has to leave the client
+SENT_TIMEOUT = 10.0
+# Seconds between checks of those messages while the queue is empty
+SENT_POLL = 0.1
+
+
+class Deadband:
+    '''
+    Suppresses readings which moved by no more than their deadband since
+    they were last published, until max_age seconds have passed.  Readings
+    are compared on their 'value', messages without one on their whole
+    content.  max_age 0 disables suppression.
+    '''
+    def __init__(self, deadbands: Optional[Dict[ str, float ]] = None, default: float = 0.0, max_age: float = 0.0):
+        self.deadbands = deadbands or {}
+        self.default = default
+        self.max_age = max_age
+        self.last = {}
+
+    def changed(self, topic: str, key: str, payload, now: float) -> bool:
+        if not self.max_age:
+            return True
+        value = value_of(payload)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = json.dumps(value, sort_keys=True)
+        previous = self.last.get(topic)
+        if previous is not None and now - previous[1] < self.max_age:
+            old = previous[0]
+            if isinstance(value, float) and isinstance(old, float):
+                if abs(value - old) <= self.deadbands.get(key, self.default):
+                    return False
+            elif value == old:
+                return False
+        self.last[topic] = ( value, now )
+        return True
+
+class Publisher:
+    '''
+    Bounded outgoing queue in front of the paho client.
+
+    With policy "coalesce" a newer message for a topic replaces the queued
+    one in its place in line, with "drop" every message is kept in order.
+    Either way the oldest message is dropped once `size` are queued.
+    Urgent messages ( safety alerts ) skip the filters and the line, in a
+    queue of their own of the same size.  Every message dropped counts in
+    `dropped`.
+    Nothing is handed to the client while it is disconnected, or before it
+    is attached when created without one.
+    '''
+    # Anything with a phase(name) context manager, e.g. profiling.Profiler
+    profiler = None
+
+    def __init__(self, client, retain: bool = False, combined: bool = False, deadband: Optional[Deadband] = None, size: int = 1000, policy: str = "coalesce"):
+        if policy not in ( "coalesce", "drop" ):
+            raise ValueError(f"Unknown queue policy {policy}")
+        self.client = client
+        self.retain = retain
+        self.combined = combined
+        self.deadband = deadband or Deadband()
+        self.size = size
+        self.policy = policy
+        self.urgent = collections.deque(maxlen=size)
+        self.pending = collections.OrderedDict()
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.running = False
+        self.thread = None
+        self.published = 0
+        self.suppressed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # ( topic, MQTTMessageInfo, callback, deadline ) of the messages
+        # with a `sent` callback still in the client, publishing thread only
+        self.unsent = []
+
+    def start(self) -> None:
+        if self.client is not None:
+            self.attach(self.client)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def attach(self, client) -> None:
+        '''
+        Start publishing through client, e.g. once paho has connected
+        '''
+        loop_start = getattr(client, "loop_start", None)
+        if loop_start:
+            loop_start()
+        with self.cond:
+            self.client = client
+            self.cond.notify_all()
+
+    def stop(self, timeout: float = 5) -> None:
+        self.flush(timeout)
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        loop_stop = getattr(self.client, "loop_stop", None)
+        if loop_stop:
+            loop_stop()
+
+    def flush(self, timeout: float = 5) -> bool:
+        '''
+        Wait for the queue to drain, returns False on timeout
+        '''
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.urgent or self.pending or self.busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def connected(self) -> bool:
+        if self.client is None:
+            return False
+        is_connected = getattr(self.client, "is_connected", None)
+        return is_connected() if is_connected else True
+
+    def publish(self, messages: list, prefix: str, retain: Optional[bool] = None, urgent: bool = False, sent: Optional[Callable[ [ str ], None ]] = None) -> None:
+        '''
+        Queue the messages of one interval under prefix.  With `combined`
+        the readings which pass the deadband go out as one document on
+        prefix/state, otherwise each on prefix/key.  Urgent messages go out
+        one per key, and `sent` is then called from the publishing thread
+        with the key of each once the client has sent it.
+        '''
+        retain = self.retain if retain is None else retain
+        if urgent:
+            with self.cond:
+                for message in messages:
+                    for key, payload in message.items():
+                        done = None if sent is None else functools.partial(sent, key)
+                        if len(self.urgent) == self.size:
+                            # The deque drops its oldest
+                            self.dropped += 1
+                            print(f"MQTT urgent queue full, dropped {self.urgent[0][0]}")
+                        self.urgent.append(( f"{prefix}/{key}", payload, retain, done ))
+                self.cond.notify_all()
+            return
+
+        now = time.monotonic()
+        doc = {}
+        for message in messages:
+            for key, payload in message.items():
+                if self.deadband.changed(f"{prefix}/{key}", key, payload, now):
+                    doc[key] = payload
+                else:
+                    self.suppressed += 1
+        if not doc:
+            return
+
+        with self.cond:
+            if self.combined:
+                topic = f"{prefix}/state"
+                queued = self.pending.get(topic)
+                if queued is not None:
+                    # Keep the readings of the queued document which did not change since
+                    self.coalesced += 1
+                    doc = { **queued[1], **doc }
+                self.enqueue(topic, doc, retain)
+            else:
+                for key, payload in doc.items():
+                    self.enqueue(f"{prefix}/{key}", payload, retain)
+            self.cond.notify_all()
+
+    def enqueue(self, topic: str, payload, retain: bool) -> None:
+        # Called with the lock held
+        key = topic if self.policy == "coalesce" else next(self.sequence)
+        if key in self.pending and not self.combined:
+            self.coalesced += 1
+        self.pending[key] = ( topic, payload, retain, None )
+        if len(self.pending) > self.size:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+    def ready(self) -> bool:
+        # Called with the lock held
+        return bool(self.urgent or self.pending) and self.connected()
+
+    def run(self) -> None:
+        while True:
+            self.confirm()
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+                if self.running and not self.ready():
+                    # Woken by new messages, connection state is polled
+                    self.cond.wait(SENT_POLL if self.unsent else 1)
+                if not self.running:
+                    self.confirm()
+                    return
+                if not self.ready():
+                    continue
+                if self.urgent:
+                    topic, payload, retain, done = self.urgent.popleft()
+                else:
+                    topic, payload, retain, done = self.pending.popitem(last=False)[1]
+                self.busy = True
+            try:
+                with phase(self.profiler, "serialize"):
+                    payload = dumps(payload)
+                with phase(self.profiler, "mqtt"):
+                    info = self.client.publish(topic, payload, retain=retain)
+                if done is not None:
+                    if hasattr(info, "is_published"):
+                        # paho's MQTTMessageInfo, checked by confirm()
+                        self.unsent.append(( topic, info, done, time.monotonic() + SENT_TIMEOUT ))
+                    else:
+                        done()
+                self.published += 1
+            except Exception as e:
+                print(f"MQTT publish to {topic} failed: {e}")
+
+    def confirm(self) -> None:
+        '''
+        Call the `sent` callbacks of the messages which left the client
+        since, and give up on those which failed or timed out
+        '''
+        if not self.unsent:
+            return
+        now = time.monotonic()
+        unsent = []
+        for topic, info, done, deadline in self.unsent:
+            if info.is_published():
+                try:
+                    done()
+                except Exception as e:
+                    print(f"MQTT sent callback failed: {e}")
+            elif getattr(info, "rc", 0) > 0 or now > deadline:
+                print(f"MQTT publish to {topic} was not sent")
+            else:
+                unsent.append(( topic, info, done, deadline ))
+        self.unsent = unsent
+
+class Pipeline:
+    '''
+    Hands every publish to each stage: the MQTT Publisher, sinks, or
+    anything else with the same publish()
+    '''
+    def __init__(self, stages: Optional[list] = None):
+        self.stages = list(stages or [])
+
+    def publish(self, messages: list, prefix: str, retain: Optional[bool] = None, urgent: bool = False) -> None:
+        for stage in self.stages:
+            stage.publish(messages, prefix, retain, urgent)
+
+    def snapshot(self) -> dict:
+        '''
+        Counters of the stages which keep them, the sinks, by name
+        '''
+        return { stage.name: stage.snapshot() for stage in self.stages if hasattr(stage, "snapshot") }
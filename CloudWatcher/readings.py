@@ -0,0 +1,131 @@
+'''
+Decoded readings
+
+A Reading holds only what varies from block to block, the raw and decoded
+values; the key, name and unit live in its Sensor, which is shared by every
+Reading of that sensor.  JSON is produced only when a reading is published,
+from a template built once per Sensor:
+
+    >>> SKY_IR = Sensor("skyir", "Sky IR Temp", "degC")
+    >>> Reading(SKY_IR, -18.5, -1850).to_json()
+    '{"name": "Sky IR Temp", "raw": -1850, "value": -18.5, "unit": "degC"}'
+'''
+
+import json
+from typing import Optional
+
+
+class Sensor:
+    '''
+    Static description of a reading.  A bare sensor's readings serialize to
+    their value alone.  `prefix` is the block prefix of sensors measured by
+    the unit ( not derived or constant ), the key they are logged under.
+    '''
+    __slots__ = ( "key", "name", "unit", "bare", "prefix", "head", "tail" )
+
+    def __init__(self, key: str, name: Optional[str] = None, unit: Optional[str] = None, bare: bool = False, prefix: Optional[bytes] = None):
+        self.key = key
+        self.name = name
+        self.unit = unit
+        self.bare = bare
+        self.prefix = prefix
+        self.head = "{" if name is None else '{"name": ' + json.dumps(name) + ", "
+        self.tail = "}" if unit is None else ', "unit": ' + json.dumps(unit) + "}"
+
+    def __repr__(self) -> str:
+        return f"Sensor({self.key!r}, {self.name!r}, {self.unit!r})"
+
+class Reading:
+    '''
+    One decoded value.  Item access ( reading['value'] ) is kept for code
+    written against the dicts the handlers used to return.
+    '''
+    __slots__ = ( "sensor", "value", "raw" )
+
+    def __init__(self, sensor: Sensor, value, raw: Optional[int] = None):
+        self.sensor = sensor
+        self.value = value
+        self.raw = raw
+
+    @property
+    def key(self) -> str:
+        return self.sensor.key
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.sensor.name
+
+    @property
+    def unit(self) -> Optional[str]:
+        return self.sensor.unit
+
+    def __repr__(self) -> str:
+        return f"Reading({self.sensor.key!r}, {self.value!r}, raw={self.raw!r})"
+
+    def __getitem__(self, field: str):
+        # The fields to_dict() would give, without building it
+        sensor = self.sensor
+        if sensor.bare:
+            raise TypeError(f"{sensor.key} is a bare reading, use its value")
+        if field == 'value':
+            return self.value
+        if field == 'raw':
+            value = self.raw
+        elif field in ( 'name', 'unit' ):
+            value = getattr(sensor, field)
+        else:
+            value = None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def to_dict(self):
+        sensor = self.sensor
+        if sensor.bare:
+            return self.value
+        d = {}
+        if sensor.name is not None:
+            d['name'] = sensor.name
+        if self.raw is not None:
+            d['raw'] = self.raw
+        d['value'] = self.value
+        if sensor.unit is not None:
+            d['unit'] = sensor.unit
+        return d
+
+    def to_json(self) -> str:
+        sensor = self.sensor
+        if sensor.bare:
+            return json.dumps(self.value)
+        if self.raw is None:
+            return f'{sensor.head}"value": {json.dumps(self.value)}{sensor.tail}'
+        return f'{sensor.head}"raw": {self.raw}, "value": {json.dumps(self.value)}{sensor.tail}'
+
+def dumps(payload) -> str:
+    '''
+    JSON for a published payload: a Reading, a dict which may hold Readings
+    ( a combined document ) or anything json.dumps takes.  bytes are sent
+    as they are, e.g. b"online" for the availability topic
+    '''
+    if type(payload) is bytes:
+        return payload
+    if type(payload) is Reading:
+        return payload.to_json()
+    if type(payload) is dict and any(type(v) is Reading for v in payload.values()):
+        return "{" + ", ".join(f"{json.dumps(k)}: {dumps(v)}" for k, v in payload.items()) + "}"
+    return json.dumps(payload, default=to_plain)
+
+def to_plain(o):
+    if type(o) is Reading:
+        return o.to_dict()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def value_of(payload):
+    '''
+    The 'value' of a Reading or reading shaped dict, else the payload itself
+    '''
+    if type(payload) is Reading:
+        return payload.value
+    if isinstance(payload, dict):
+        return payload.get('value', payload)
+    return payload
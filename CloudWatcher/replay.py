@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+'''
+Decode captured blocks again, e.g. after changing the calibration
+
+Captures are the .cwc day files written by tslog.CaptureLog ( cw2mqtt
+--capture ).  Blocks are decoded in order by a CloudWatcher without a
+serial port, so !M constants blocks update the decoder as they did live;
+overrides given here are applied on top of them.
+
+    for t, reading in replay_readings(paths, constants={ "SQReference": 21.6 }):
+        ...
+
+Or from the shell, writing reading logs ( see tslog ) with one process per
+day file:
+
+    python3 -m CloudWatcher.replay /var/lib/cloudwatcher/capture/ttyUSB0 -o /tmp/redecoded -j 8 --set SQReference=21.6
+'''
+
+import argparse, mmap, os, sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import CloudWatcher, SkyTemperatureModel
+from .readings import Reading
+from .tslog import CAPTURE_MAGIC, CAPTURE_RECORD, CAPTURE_SUFFIX, HEADER, TimeSeriesLog, day_files
+
+
+def read_capture(path: str) -> Iterator[ Tuple[ float, bytes ] ]:
+    '''
+    ( time, block ) of every record in a capture file
+    '''
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        count = ( size - HEADER.size ) // CAPTURE_RECORD.size
+        if count <= 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            magic, record_size = HEADER.unpack_from(m)
+            if magic != CAPTURE_MAGIC or record_size != CAPTURE_RECORD.size:
+                raise ValueError(f"{path} is not a capture file")
+            view = memoryview(m)[HEADER.size:HEADER.size + count * CAPTURE_RECORD.size]
+            try:
+                yield from CAPTURE_RECORD.iter_unpack(view)
+            finally:
+                view.release()
+
+def capture_files(paths: Iterable[ str ]) -> List[ str ]:
+    '''
+    Expand directories to their capture files, oldest first
+    '''
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += day_files(path, CAPTURE_SUFFIX)
+        else:
+            found.append(path)
+    return found
+
+def decode(frames: Iterable[ Tuple[ float, bytes ] ], HASL: float = 0, constants: Optional[ Dict[ str, float ] ] = None,
+           model: Optional[SkyTemperatureModel] = None) -> Iterator[ Tuple[ float, Reading ] ]:
+    '''
+    ( time, Reading ) for every reading decoded from ( time, block ) frames,
+    each followed by the readings derived from it.  With a model, that
+    includes the adjusted sky temperature ( key "clouds" ).
+    '''
+    cw = CloudWatcher(None, HASL)
+    constants = constants or {}
+    cw.set_constants(constants)
+    if model is not None:
+        cw.derived.set("sky_model", model)
+    process_block = cw.process_block
+    derive = cw.derived.update
+    for t, block in frames:
+        try:
+            res = process_block(block)
+        except Exception:
+            continue
+        if res is None:
+            continue
+        if type(res) is Reading:
+            res = ( res, )
+        elif block[1:2] == b"M" and constants:
+            # Overrides win over the constants read from the unit
+            cw.set_constants(constants)
+        result = { reading.sensor.key: reading for reading in res }
+        derive(result)
+        for reading in result.values():
+            yield t, reading
+
+def replay_readings(paths: Iterable[ str ], **options) -> Iterator[ Tuple[ float, Reading ] ]:
+    '''
+    decode() every capture file in paths in order, see decode() for options
+    '''
+    for path in capture_files(paths):
+        yield from decode(read_capture(path), **options)
+
+def replay_file(path: str, out: str, **options) -> int:
+    '''
+    Decode one capture file into reading logs in out, returns the number of
+    records written.  Runs in the worker processes of replay().
+    '''
+    log = TimeSeriesLog(out, autoflush=False)
+    write = log.write
+    try:
+        for t, reading in decode(read_capture(path), **options):
+            write({ reading.sensor.key: reading }, t)
+    finally:
+        log.close()
+    return log.records
+
+def replay(paths: Iterable[ str ], out: str, workers: Optional[int] = None, **options) -> int:
+    '''
+    Decode the capture files of one unit into reading logs in out, one file
+    per worker process at a time.  Each capture file starts with the
+    constants in force, so files decode independently.
+    '''
+    files = capture_files(paths)
+    if os.path.isdir(out) and day_files(out):
+        # Logs are appended to, so a second run would duplicate every record
+        raise ValueError(f"{out} already holds reading logs")
+    if workers == 1:
+        return sum(replay_file(path, out, **options) for path in files)
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [ pool.submit(replay_file, path, out, **options) for path in files ]
+        return sum(job.result() for job in jobs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode captured blocks again")
+    parser.add_argument("captures", nargs = "+",                      help="Capture files or directories of them")
+    parser.add_argument("-e", "--elevation", default = 0, type=float, help="Elevation above Sea Level in Meters ( for relative atmospheric pressure )")
+    parser.add_argument("-j", "--jobs",  default = None, type=int,    help="Worker processes with -o ( default one per CPU )")
+    parser.add_argument("-m", "--model", default = "",               help="Sky temperature model K1,...,K7 or a JSON file from CloudWatcher.skymodel fit, adds the adjusted sky temperature")
+    parser.add_argument("-o", "--out",   default = "",               help="Write reading logs to this directory instead of CSV to stdout")
+    parser.add_argument(      "--set",   action = 'append', default = [], help="Override a constant, NAME=VALUE, e.g. SQReference=21.6, may be repeated")
+    args = parser.parse_args()
+
+    options = {
+        'HASL': args.elevation,
+        'constants': { name: float(value) for name, sep, value in ( s.partition("=") for s in args.set ) },
+        'model': SkyTemperatureModel.parse(args.model) if args.model else None,
+    }
+    if args.out:
+        print(f"{replay(args.captures, args.out, args.jobs, **options)} records written to {args.out}")
+        return
+
+    out = sys.stdout
+    out.write("time,key,raw,value\n")
+    for t, reading in replay_readings(args.captures, **options):
+        out.write(f"{t:.3f},{reading.sensor.key},{'' if reading.raw is None else reading.raw},{reading.value}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+'''
+Rain and switch state alerts for roof and dome safety
+
+Every raw reading is checked as it arrives, before any averaging, and a
+change of state is passed to the alert callback straight away:
+
+    monitor = SafetyMonitor(lambda message: mqtt_send(message, retain=True))
+    monitor.check(cw.get_safety())
+'''
+
+import math, time
+from typing import Callable, Optional
+
+
+class SafetyMonitor:
+    '''
+    Tracks the rain state ( dry, wet or rain ) from the rain sensor
+    frequency, which falls as the sensor gets wet, and the switch state.
+    alert() is called with a message dict on the first reading and on every
+    change.  `hysteresis` Hz keeps a frequency sitting on a limit from
+    flapping.
+    '''
+    def __init__(self, alert: Callable[ [dict], None ], wet: float = 2100, rain: float = 1700, hysteresis: float = 50):
+        self.alert = alert
+        self.wet = wet
+        self.rain = rain
+        self.hysteresis = hysteresis
+        self.rain_state: Optional[str] = None
+        self.switch_state: Optional[str] = None
+        self.alerts = 0
+
+    def classify(self, freq: float) -> str:
+        # Leaving a state needs the frequency to clear its limit by the hysteresis
+        margin = self.hysteresis
+        wet = self.wet + ( margin if self.rain_state in ( "wet", "rain" ) else 0 )
+        rain = self.rain + ( margin if self.rain_state == "rain" else 0 )
+        if freq < rain:
+            return "rain"
+        if freq < wet:
+            return "wet"
+        return "dry"
+
+    def check(self, result: Optional[dict]) -> bool:
+        '''
+        Check one decoded response, returns True when an alert was raised
+        '''
+        if not result:
+            return False
+        raised = False
+        if 'rain_freq' in result:
+            freq = result['rain_freq'].value
+            state = self.classify(freq)
+            if state != self.rain_state:
+                self.rain_state = state
+                self.send('safety/rain', { 'name': 'Rain State', 'value': state, 'rain_freq': freq })
+                raised = True
+        if 'switch' in result:
+            state = result['switch'].value
+            if state != self.switch_state:
+                self.switch_state = state
+                self.send('safety/switch', { 'name': 'Switch State', 'value': state })
+                raised = True
+        return raised
+
+    def send(self, key: str, payload: dict) -> None:
+        payload['epoch'] = math.floor(time.time())
+        self.alerts += 1
+        self.alert({ key: payload })
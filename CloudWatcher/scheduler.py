@@ -0,0 +1,145 @@
+'''
+Per sensor poll scheduling for cw2mqtt
+
+Each command has its own publish period and number of samples averaged per
+publish.  When a reading moves by more than the sensor's threshold between
+two polls, the sensor switches to fast polling and publishes every poll
+until it has been quiet for `hold` seconds.  Static data ( serial number,
+firmware version, constants ) is re-read every `period` and published as
+is.
+'''
+
+from dataclasses import dataclass
+import math
+from typing import Dict, List, Optional, Tuple
+
+from .stats import Accumulator
+
+
+@dataclass
+class SensorSchedule:
+    command: bytes
+    period: float                       # seconds between publishes
+    samples: int = 1                    # samples averaged per publish
+    fast_period: Optional[float] = None # seconds between polls while changing
+    threshold: Optional[float] = None   # change between polls that counts as changing
+    static: bool = False                # publish the response unaveraged
+
+def default_schedule(interval: float = 15) -> List[ SensorSchedule ]:
+    return [
+        SensorSchedule(b"S!", interval,      5, 2, 1.0),     # sky IR
+        SensorSchedule(b"E!", interval,      5, 1, 30),      # rain frequency
+        SensorSchedule(b"T!", interval,      5, 2, 1.0),     # IR sensor ambient
+        SensorSchedule(b"V!", interval,      5, 2, 10),      # wind
+        SensorSchedule(b"t!", interval * 4,  3, 5, 0.5),     # humidity sensor temperature
+        SensorSchedule(b"h!", interval * 4,  3, 5, 3),       # humidity
+        SensorSchedule(b"C!", interval * 4,  3),             # zener, NTC, LDR
+        SensorSchedule(b"p!", interval * 8,  2),             # pressure
+        SensorSchedule(b"q!", interval * 8,  2),             # pressure sensor temperature
+        SensorSchedule(b"K!", 3600, static=True),            # serial number
+        SensorSchedule(b"B!", 3600, static=True),            # firmware version
+        SensorSchedule(b"M!", 3600, static=True),            # constants
+    ]
+
+def parse_schedule(spec: str) -> SensorSchedule:
+    '''
+    CMD=PERIOD[,SAMPLES[,FAST_PERIOD[,THRESHOLD]]], e.g. S!=15,5,2,1.0
+    '''
+    cmd, sep, rest = spec.partition("=")
+    if not sep or not cmd.endswith("!"):
+        raise ValueError(f"Bad schedule {spec}, expected CMD=PERIOD[,SAMPLES[,FAST_PERIOD[,THRESHOLD]]]")
+    fields = rest.split(",")
+    return SensorSchedule(
+        command = str.encode(cmd, "ascii"),
+        period = float(fields[0]),
+        samples = int(fields[1]) if len(fields) > 1 and fields[1] else 1,
+        fast_period = float(fields[2]) if len(fields) > 2 and fields[2] else None,
+        threshold = float(fields[3]) if len(fields) > 3 and fields[3] else None,
+    )
+
+class SensorState:
+    __slots__ = ( "schedule", "next_due", "fast_until", "count", "stats", "last", "previous" )
+
+    def __init__(self, schedule: SensorSchedule, now: float):
+        self.schedule = schedule
+        self.next_due = now
+        self.fast_until = -math.inf
+        self.count = 0
+        self.stats = {}
+        self.last = {}
+        self.previous = {}
+
+class Scheduler:
+    '''
+    Decides which commands are due and folds their responses into
+    per sensor statistics.  It does no I/O, the caller sends the due
+    commands ( typically with CloudWatcher.query ) and feeds the results
+    back.
+    '''
+    def __init__(self, schedules: List[ SensorSchedule ], now: float, sigma: float = 2.0, hold: float = 60):
+        self.sigma = sigma
+        self.hold = hold
+        self.states: Dict[ bytes, SensorState ] = { s.command: SensorState(s, now) for s in schedules }
+
+    def due(self, now: float) -> List[ bytes ]:
+        return [ cmd for cmd, st in self.states.items() if st.next_due <= now ]
+
+    def next_due(self) -> float:
+        return min(st.next_due for st in self.states.values())
+
+    def feed(self, command: bytes, result: Optional[dict], now: float) -> Optional[Tuple[ dict, dict ]]:
+        '''
+        Account for the response to command.  Returns ( stats, last ) when
+        the sensor is due to publish: the Accumulator and latest reading per
+        key, in the form cw2mqtt's summarize() takes.  Static sensors return
+        ( {}, result ).
+        '''
+        st = self.states[command]
+        sched = st.schedule
+        if not result:
+            st.next_due = now + sched.period / max(sched.samples, 1)
+            return None
+        if sched.static:
+            st.next_due = now + sched.period
+            return ( {}, result )
+
+        values = {}
+        for k, reading in result.items():
+            st.last[k] = reading
+            try:
+                values[k] = float(reading.value)
+            except (TypeError, ValueError):
+                pass
+
+        changed = False
+        if sched.threshold is not None:
+            for k, value in values.items():
+                if k in st.previous and abs(value - st.previous[k]) > sched.threshold:
+                    changed = True
+        st.previous.update(values)
+        if changed:
+            # Samples from before the change would only dilute it
+            st.stats = {}
+            st.count = 0
+
+        for k, value in values.items():
+            if k not in st.stats:
+                st.stats[k] = Accumulator(self.sigma)
+            st.stats[k].add(value)
+        st.count += 1
+
+        if changed and sched.fast_period:
+            st.fast_until = now + self.hold
+        fast = now < st.fast_until
+        if fast:
+            st.next_due = now + sched.fast_period
+        else:
+            st.next_due = now + sched.period / max(sched.samples, 1)
+
+        if fast or st.count >= sched.samples:
+            batch = ( st.stats, st.last )
+            st.stats = {}
+            st.last = {}
+            st.count = 0
+            return batch
+        return None
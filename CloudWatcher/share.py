@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Share one CloudWatcher between several processes
+
+The daemon owns the serial port and serves commands over a Unix or TCP
+socket.  Commands from every client are serialized on the port, each
+response is cached for a time to live per command, and a command already
+waiting on the unit is not sent again: every client asking for it gets the
+one response.  Readings then cost the 9600 baud port the same however many
+clients poll it.
+
+    python3 -m CloudWatcher.share -p /dev/ttyUSB0 -l unix:/run/cloudwatcher/ttyUSB0.sock
+
+Clients use proxy.SharedCloudWatcher, a CloudWatcher with the same get_*
+API which decodes the forwarded blocks itself ( cw2mqtt takes the address
+as its port ), see proxy for the socket protocol.  Commands which set
+something are passed straight through and empty the cache.
+'''
+
+import argparse, asyncio, math, os, time
+from typing import Dict, List, Optional, Tuple
+
+from . import SAFETY_COMMANDS, command_name
+from .aio import AsyncCloudWatcher
+from .proxy import COUNT, NO_RESPONSE, parse_address
+
+# Commands answered from the cache, the rest ( switch, heater and shutdown
+# settings ) always go to the unit, and their handshake is waited for
+READ_COMMANDS = { b"A!", b"B!", b"C!", b"E!", b"F!", b"K!", b"M!", b"Q!", b"S!", b"T!", b"V!", b"h!", b"m!", b"p!", b"q!", b"t!", b"v!" }
+# Name, version, serial number, constants and wind sensor presence
+STATIC_COMMANDS = { b"A!", b"B!", b"K!", b"M!", b"v!" }
+
+DEFAULT_TTL = 1.0
+SAFETY_TTL = 0.2
+
+
+def default_ttls(default: float = DEFAULT_TTL) -> Dict[ bytes, float ]:
+    '''
+    Static data never expires, safety commands expire quickly
+    '''
+    ttls = { cmd: default for cmd in READ_COMMANDS }
+    ttls.update({ cmd: math.inf for cmd in STATIC_COMMANDS })
+    ttls.update({ cmd: min(default, SAFETY_TTL) for cmd in SAFETY_COMMANDS })
+    return ttls
+
+def parse_ttls(specs: List[ str ]) -> Dict[ bytes, float ]:
+    '''
+    SECONDS for every command or CMD=SECONDS, later ones win
+    '''
+    default = DEFAULT_TTL
+    for spec in specs:
+        if "=" not in spec:
+            default = float(spec)
+    ttls = default_ttls(default)
+    for spec in specs:
+        cmd, sep, seconds = spec.partition("=")
+        if sep:
+            cmd = str.encode(cmd, "ascii")
+            if cmd not in READ_COMMANDS:
+                raise ValueError(f"{cmd} is not a read command")
+            ttls[cmd] = float(seconds)
+    return ttls
+
+class SharedUnit(AsyncCloudWatcher):
+    '''
+    The unit on the daemon's side, exchanging raw blocks
+    '''
+    blocks: Optional[list] = None
+
+    def merge_block(self, result: dict, block: bytes) -> None:
+        if self.blocks is not None:
+            self.blocks.append(block)
+        super().merge_block(result, block)
+
+    async def exchange(self, cmd: bytes) -> Optional[ List[ bytes ] ]:
+        '''
+        Send cmd, returns the blocks of its response or None
+        '''
+        async with self.lock:
+            if not await self.reset_serial_buffers():
+                return None
+            self.blocks = blocks = []
+            start = time.perf_counter()
+            try:
+                self.write(cmd)
+                result = await self.read_block()
+            finally:
+                self.blocks = None
+            self.metrics.observe(command_name(cmd), time.perf_counter() - start, result is not None)
+        return blocks if result is not None else None
+
+class ShareServer:
+    '''
+    Serves one unit.  `ttls` is the cache time to live of each read
+    command, see default_ttls(); commands without one are not cached.
+    '''
+    def __init__(self, unit, ttls: Optional[ Dict[ bytes, float ] ] = None):
+        self.unit = unit
+        self.ttls = default_ttls() if ttls is None else ttls
+        self.cache: Dict[ bytes, Tuple[ float, Optional[ List[ bytes ] ] ] ] = {}
+        self.inflight: Dict[ bytes, asyncio.Future ] = {}
+        self.clients = 0
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    async def request(self, cmd: bytes) -> Optional[ List[ bytes ] ]:
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        ttl = self.ttls.get(cmd)
+        if ttl is None:
+            # Switch, heater and shutdown settings change what the cache holds
+            self.sent += 1
+            self.cache.clear()
+            return await self.unit.exchange(cmd)
+
+        cached = self.cache.get(cmd)
+        if cached is not None and loop.time() < cached[0]:
+            self.hits += 1
+            return cached[1]
+        pending = self.inflight.get(cmd)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        pending = self.inflight[cmd] = loop.create_future()
+        blocks = None
+        try:
+            self.sent += 1
+            blocks = await self.unit.exchange(cmd)
+        finally:
+            # Waiting clients see a failure as no response
+            del self.inflight[cmd]
+            pending.set_result(blocks)
+        if blocks is not None and ttl > 0:
+            self.cache[cmd] = ( loop.time() + ttl, blocks )
+        return blocks
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.clients += 1
+        try:
+            while True:
+                size = ( await reader.readexactly(1) )[0]
+                cmd = await reader.readexactly(size)
+                blocks = await self.request(cmd)
+                if blocks is None:
+                    writer.write(COUNT.pack(NO_RESPONSE))
+                else:
+                    writer.write(COUNT.pack(len(blocks)) + b"".join(blocks))
+                await writer.drain()
+        except ( asyncio.IncompleteReadError, ConnectionError ):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def serve(self, address: str) -> None:
+        family, where = parse_address(address)
+        await self.unit.start()
+        if family == "unix":
+            if os.path.exists(where):
+                # Left behind by a previous daemon
+                os.unlink(where)
+            server = await asyncio.start_unix_server(self.handle, where)
+        else:
+            server = await asyncio.start_server(self.handle, *where)
+        async with server:
+            await server.serve_forever()
+
+    def snapshot(self) -> dict:
+        return {
+            'clients': self.clients,
+            'requests': self.requests,
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'sent': self.sent,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Share one CloudWatcher between several processes")
+    parser.add_argument("-l", "--listen", default = "unix:/run/cloudwatcher.sock", help="Address to serve on, unix:PATH or tcp:HOST:PORT ( default unix:/run/cloudwatcher.sock )")
+    parser.add_argument("-p", "--port",   default = "/dev/ttyAMA3",                help="Comm port descriptor, e.g /dev/ttyUSB0")
+    parser.add_argument("-t", "--ttl",    action = 'append', default = [],         help=f"Seconds a response is served from the cache, SECONDS or CMD=SECONDS, may be repeated ( default {DEFAULT_TTL:g}, {SAFETY_TTL:g} for E! and F!, static data forever )")
+    args = parser.parse_args()
+
+    server = ShareServer(SharedUnit(args.port, 0), parse_ttls(args.ttl))
+    try:
+        asyncio.run(server.serve(args.listen))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.snapshot())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+'''
+CloudWatcher device simulator on a Linux pseudo terminal
+
+Answers the commands CloudWatcher sends with 15 byte blocks followed by the
+!\x11 handshake block, paced like a 9600 baud line, and can inject faults:
+garbage bytes, short blocks and missing responses.
+
+    sim = Simulator()
+    port = sim.start()
+    cw = CloudWatcher(port, 0)
+
+Or standalone, printing the port to point cw2mqtt at:
+
+    python3 -m CloudWatcher.simulator
+'''
+
+import argparse, os, random, select, threading, time, tty
+from typing import Dict, List, Optional
+
+from . import BLOCK_SIZE, HANDSHAKE
+
+
+def block(payload: bytes) -> bytes:
+    return (b"!" + payload + b" " * BLOCK_SIZE)[:BLOCK_SIZE]
+
+def field(prefix: bytes, value) -> bytes:
+    '''
+    A numeric block, the value right aligned after the prefix
+    '''
+    return block(prefix + str(value).rjust(BLOCK_SIZE - 1 - len(prefix)).encode("ascii"))
+
+class Simulator:
+    '''
+    The simulated unit state is held in `values`, the raw readings keyed by
+    block prefix, and may be changed at any time, e.g. values["R"] = 1200 to
+    start raining.  `switch_open` gives the !X / !Y switch state.
+
+    Faults are probabilities per response: garbage inserts random bytes
+    between blocks, short drops the tail of a block and timeout sends
+    nothing at all.
+    '''
+    values: Dict[ str, int ]
+    commands: int
+    blocks: int
+    bytes_written: int
+
+    def __init__(self, baud: int = 9600, garbage: float = 0, short: float = 0, timeout: float = 0, seed: Optional[int] = None):
+        self.baud = baud
+        self.garbage = garbage
+        self.short = short
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.values = {
+            "1": -1850,   # Sky IR, 1/100 degC
+            "2": 1520,    # IR sensor ambient, 1/100 degC
+            "3": 520,     # Ambient NTC ADC
+            "4": 800,     # LDR ADC
+            "5": 490,     # Rain sensor NTC ADC
+            "6": 260,     # Zener ADC
+            "R": 2750,    # Rain frequency, Hz
+            "Q": 512,     # PWM duty cycle
+            "hh": 31210,  # Humidity, 16 bit
+            "th": 24312,  # Humidity sensor temperature, 16 bit
+            "p": 15840,   # Pressure, 1/16 hPa
+            "q": 1523,    # Pressure sensor temperature, 1/100 degC
+            "w": 12,      # Wind
+            "v": 1,       # Wind sensor present
+        }
+        self.name = "CloudWatcher"
+        self.serial = "1234"
+        self.version = "5.89"
+        # zener, LDR max, LDR pull up, rain beta, rain R25, rain pull up, 1/100 and 1/10 units
+        self.constants = [ 300, 0, 560, 3450, 10, 10 ]
+        self.shutdown = [ 0, 0, 0, 0 ]
+        self.switch_open = True
+        self.commands = 0
+        self.blocks = 0
+        self.bytes_written = 0
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.running = False
+
+    def start(self) -> str:
+        '''
+        Open the pseudo terminal and start answering, returns the port name
+        '''
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return os.ttyname(self.slave)
+
+    def stop(self) -> None:
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in ( self.master, self.slave ):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def run(self) -> None:
+        buf = b""
+        while self.running:
+            ready, _, _ = select.select([ self.master ], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                buf += os.read(self.master, 256)
+            except OSError:
+                break
+            while True:
+                cmd, buf = self.next_command(buf)
+                if cmd is None:
+                    break
+                self.commands += 1
+                self.send(self.respond(cmd))
+
+    def next_command(self, buf: bytes) -> tuple:
+        '''
+        Split the first complete command off buf.  Commands are two bytes
+        except P####! ( 6 bytes ) and the 14 byte binary l...! packet.
+        '''
+        if not buf:
+            return None, buf
+        size = { b"P": 6, b"l": 14 }.get(buf[0:1], 2)
+        if len(buf) < size:
+            return None, buf
+        if buf[size - 1:size] != b"!":
+            # Out of step, skip a byte
+            return self.next_command(buf[1:])
+        return buf[:size], buf[size:]
+
+    def respond(self, cmd: bytes) -> List[ bytes ]:
+        c = cmd[0:1]
+        v = self.values
+        if c == b"A":
+            blocks = [ block(b"N" + self.name.encode("ascii")) ]
+        elif c == b"B":
+            blocks = [ block(b"V" + self.version.encode("ascii")) ]
+        elif c == b"C":
+            blocks = [ field(b"6", v["6"]), field(b"3", v["3"]), field(b"4", v["4"]), field(b"5", v["5"]) ]
+            if "8" in v:
+                blocks.append(field(b"8", v["8"]))
+        elif c == b"E":
+            blocks = [ field(b"R", v["R"]) ]
+        elif c in ( b"F", b"G", b"H" ):
+            if c == b"G":
+                self.switch_open = True
+            elif c == b"H":
+                self.switch_open = False
+            blocks = [ block(b"X" if self.switch_open else b"Y") ]
+        elif c == b"K":
+            blocks = [ block(b"K" + self.serial.encode("ascii")) ]
+        elif c == b"M":
+            blocks = [ block(b"M" + b"".join(bytes([ x >> 8, x & 255 ]) for x in self.constants) + b" ") ]
+        elif c == b"m":
+            blocks = [ block(b"m" + bytes(self.shutdown)) ]
+        elif c == b"P":
+            try:
+                v["Q"] = int(cmd[1:5])
+            except ValueError:
+                pass
+            blocks = []
+        elif c == b"l":
+            self.shutdown = list(cmd[1:5])
+            blocks = []
+        elif c == b"Q":
+            blocks = [ field(b"Q", v["Q"]) ]
+        elif c == b"S":
+            blocks = [ field(b"1", v["1"]) ]
+        elif c == b"T":
+            blocks = [ field(b"2", v["2"]) ]
+        elif c == b"V":
+            blocks = [ field(b"w", v["w"]) ]
+        elif c == b"h":
+            blocks = [ field(b"hh", v["hh"]) ]
+        elif c == b"p":
+            blocks = [ field(b"p", v["p"]) ]
+        elif c == b"q":
+            blocks = [ field(b"q", v["q"]) ]
+        elif c == b"t":
+            blocks = [ field(b"th", v["th"]) ]
+        elif c == b"v":
+            blocks = [ field(b"v", v["v"]) ]
+        else:
+            blocks = []
+        return blocks + [ block(HANDSHAKE[1:] + b"      0") ]
+
+    def send(self, blocks: List[ bytes ]) -> None:
+        rnd = self.random
+        if self.timeout and rnd.random() < self.timeout:
+            return
+        for b in blocks:
+            if self.garbage and rnd.random() < self.garbage:
+                b = bytes(rnd.randrange(256) for i in range(rnd.randrange(1, BLOCK_SIZE))) + b
+            if self.short and rnd.random() < self.short:
+                b = b[:rnd.randrange(1, BLOCK_SIZE)]
+            if self.baud:
+                # 10 bits per byte on the wire
+                time.sleep(len(b) * 10 / self.baud)
+            try:
+                os.write(self.master, b)
+            except OSError:
+                return
+            self.blocks += 1
+            self.bytes_written += len(b)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--baud",    default = 9600, type=int,  help="Simulated line speed, 0 for no pacing ( default 9600 )")
+    parser.add_argument("-g", "--garbage", default = 0, type=float,   help="Probability of garbage before a block")
+    parser.add_argument("-s", "--short",   default = 0, type=float,   help="Probability of a short block")
+    parser.add_argument("-t", "--timeout", default = 0, type=float,   help="Probability of no response to a command")
+    args = parser.parse_args()
+
+    sim = Simulator(args.baud, args.garbage, args.short, args.timeout)
+    print(sim.start(), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+if __name__ == "__main__":
+    main()
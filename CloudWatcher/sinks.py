@@ -0,0 +1,344 @@
+'''
+Output sinks for cw2mqtt besides MQTT
+
+Every sink has its own bounded queue and worker thread, like the MQTT
+Publisher, so a slow disk or dashboard only ever drops its own oldest
+messages and never holds up sampling.  The worker writes messages in
+batches of up to `batch`, waiting at most `linger` seconds for one to
+fill.  Sinks are given on the cw2mqtt command line as KIND:TARGET with
+optional settings:
+
+    csv:/var/lib/cloudwatcher/csv               daily CSV files
+    parquet:/var/lib/cloudwatcher/parquet       Parquet files, needs pyarrow
+    jsonl:/var/log/cloudwatcher.jsonl           one JSON document per line
+    http:8080                                   latest value of every topic as JSON
+    csv:/srv/archive,batch=500,linger=60,queue=10000,policy=drop
+
+publisher.Pipeline hands each publish to the Publisher and every sink.
+'''
+
+import abc, collections, csv, itertools, json, os, threading, time
+from typing import Dict, List, Optional, Tuple
+
+from .profiling import phase
+from .readings import dumps, value_of
+from .tslog import DAY, day_name
+
+# ( time, topic, payload, retain ) as queued
+Item = Tuple[ float, str, object, bool ]
+
+
+class Sink(abc.ABC):
+    '''
+    Bounded queue and worker thread in front of write(), which subclasses
+    implement.
+
+    With policy "coalesce" a newer message for a topic replaces the queued
+    one in its place in line, with "drop" every message is kept in order.
+    Either way the oldest message is dropped once `size` are queued.
+    '''
+    size = 1000
+    policy = "drop"
+    batch = 100
+    linger = 5.0
+    # Anything with a phase(name) context manager, e.g. profiling.Profiler
+    profiler = None
+
+    def __init__(self, target: str, queue: Optional[int] = None, policy: Optional[str] = None, batch: Optional[int] = None, linger: Optional[float] = None):
+        self.target = target
+        self.size = self.size if queue is None else queue
+        self.policy = self.policy if policy is None else policy
+        self.batch = self.batch if batch is None else batch
+        self.linger = self.linger if linger is None else linger
+        if self.policy not in ( "coalesce", "drop" ):
+            raise ValueError(f"Unknown queue policy {self.policy}")
+        self.pending = collections.OrderedDict()
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.first = 0.0
+        self.busy = False
+        self.running = False
+        self.thread = None
+        self.written = 0
+        self.batches = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def name(self) -> str:
+        return f"{type(self).__name__}({self.target})"
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        '''
+        Write what is queued without waiting for full batches, then close
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.close()
+
+    def publish(self, messages: list, prefix: str, retain: Optional[bool] = None, urgent: bool = False) -> None:
+        '''
+        Queue the messages under prefix, see Publisher.publish.  Urgent
+        messages are queued like any other.
+        '''
+        now = time.time()
+        with self.cond:
+            if not self.pending:
+                self.first = time.monotonic()
+            for message in messages:
+                for key, payload in message.items():
+                    topic = f"{prefix}/{key}"
+                    self.enqueue(topic, ( now, topic, payload, bool(retain) ))
+            self.cond.notify_all()
+
+    def enqueue(self, topic: str, item: Item) -> None:
+        # Called with the lock held
+        key = topic if self.policy == "coalesce" else next(self.sequence)
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = item
+        if len(self.pending) > self.size:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+
+    def run(self) -> None:
+        while True:
+            with self.cond:
+                self.busy = False
+                while self.running and not self.pending:
+                    self.cond.wait()
+                # Let a batch fill, for at most linger after its first message
+                while self.running and len(self.pending) < self.batch:
+                    remaining = self.first + self.linger - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self.pending:
+                    return
+                items = [ self.pending.popitem(last=False)[1] for i in range(min(self.batch, len(self.pending))) ]
+                self.first = time.monotonic()
+                self.busy = True
+            try:
+                with phase(self.profiler, "sinks"):
+                    self.write(items)
+                self.written += len(items)
+                self.batches += 1
+            except Exception as e:
+                self.failed += len(items)
+                print(f"{self.name}: {e}")
+
+    @abc.abstractmethod
+    def write(self, items: List[ Item ]) -> None:
+        '''
+        Write a batch, from the worker thread.  An exception counts its
+        items as failed.
+        '''
+
+    def close(self) -> None:
+        pass
+
+    def snapshot(self) -> dict:
+        return {
+            'queued': len(self.pending),
+            'written': self.written,
+            'batches': self.batches,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+def plain_value(payload):
+    '''
+    The value of a reading for a column, None for documents
+    '''
+    value = value_of(payload)
+    if type(value) is bytes:
+        return value.decode("utf-8", "replace")
+    return value if isinstance(value, ( int, float, str )) else None
+
+def to_json(payload) -> str:
+    '''
+    readings.dumps, but always JSON: bytes published as they are to MQTT,
+    e.g. b"online" on the availability topic, become a JSON string
+    '''
+    if type(payload) is bytes:
+        return json.dumps(payload.decode("utf-8", "replace"))
+    return dumps(payload)
+
+class CSVSink(Sink):
+    '''
+    time, topic, value and JSON payload rows in YYYY-MM-DD.csv files, one
+    per UTC day
+    '''
+    def __init__(self, target: str, **options):
+        super().__init__(target, **options)
+        os.makedirs(target, exist_ok=True)
+        self.day = None
+        self.file = None
+        self.writer = None
+
+    def open(self, day: int) -> None:
+        self.close()
+        self.file = open(os.path.join(self.target, day_name(day, ".csv")), "a", newline="")
+        self.writer = csv.writer(self.file)
+        self.day = day
+        if self.file.tell() == 0:
+            self.writer.writerow([ "time", "topic", "value", "payload" ])
+
+    def write(self, items: List[ Item ]) -> None:
+        for t, topic, payload, retain in items:
+            day = int(t // DAY)
+            if day != self.day:
+                self.open(day)
+            value = plain_value(payload)
+            self.writer.writerow([ f"{t:.3f}", topic, "" if value is None else value, to_json(payload) ])
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.day = None
+
+class ParquetSink(Sink):
+    '''
+    One Parquet file per batch, in a YYYY-MM-DD directory per UTC day, with
+    the columns of CSVSink.  Values which are not numbers are left null.
+    '''
+    batch = 10000
+    linger = 3600
+
+    def __init__(self, target: str, **options):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ValueError("Parquet sinks need pyarrow")
+        super().__init__(target, **options)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+    def write(self, items: List[ Item ]) -> None:
+        values = [ plain_value(payload) for t, topic, payload, retain in items ]
+        table = self.pa.table({
+            'time': self.pa.array([ item[0] for item in items ], self.pa.float64()),
+            'topic': [ item[1] for item in items ],
+            'value': self.pa.array([ float(v) if isinstance(v, ( int, float )) else None for v in values ], self.pa.float64()),
+            'payload': [ to_json(item[2]) for item in items ],
+        })
+        first = items[0][0]
+        directory = os.path.join(self.target, day_name(int(first // DAY), ""))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{first:.3f}.parquet")
+        self.pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+class JSONLinesSink(Sink):
+    '''
+    Appends {"time": ..., "topic": ..., "payload": ...} lines to a file,
+    opened for every batch so it can be rotated
+    '''
+    def write(self, items: List[ Item ]) -> None:
+        lines = [ f'{{"time": {t:.3f}, "topic": {json.dumps(topic)}, "payload": {to_json(payload)}}}\n' for t, topic, payload, retain in items ]
+        with open(self.target, "a") as f:
+            f.write("".join(lines))
+
+class HTTPSink(Sink):
+    '''
+    Serves the latest payload of every topic as one JSON object on
+    [HOST:]PORT, or of the topics under a path, e.g. /cloudwatcher/skyir.
+    Only the latest message of a topic matters, so the queue coalesces.
+    '''
+    policy = "coalesce"
+    batch = 1000
+    linger = 0
+
+    def __init__(self, target: str, **options):
+        super().__init__(target, **options)
+        host, sep, port = target.rpartition(":")
+        self.latest: Dict[ str, str ] = {}
+        self.lock = threading.Lock()
+        self.server = self.serve(host, int(port))
+
+    def write(self, items: List[ Item ]) -> None:
+        # Serialized here rather than for every request
+        docs = { topic: to_json(payload) for t, topic, payload, retain in items }
+        with self.lock:
+            self.latest.update(docs)
+
+    def document(self, path: str) -> Optional[str]:
+        topic = path.strip("/")
+        with self.lock:
+            if topic in self.latest:
+                return self.latest[topic]
+            found = [ ( t, doc ) for t, doc in self.latest.items() if not topic or t.startswith(topic + "/") ]
+        if not found:
+            return None
+        return "{" + ", ".join(f"{json.dumps(t)}: {doc}" for t, doc in sorted(found)) + "}"
+
+    def serve(self, host: str, port: int):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                doc = sink.document(self.path.split("?", 1)[0])
+                if doc is None:
+                    self.send_error(404)
+                    return
+                body = doc.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                # For dashboards served from elsewhere
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(( host, port ), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+SINKS = {
+    "csv": CSVSink,
+    "http": HTTPSink,
+    "jsonl": JSONLinesSink,
+    "parquet": ParquetSink,
+}
+
+def parse_sink(spec: str) -> Sink:
+    '''
+    KIND:TARGET[,queue=N][,policy=coalesce|drop][,batch=N][,linger=SECONDS]
+    '''
+    kind, sep, rest = spec.partition(":")
+    if kind not in SINKS or not rest:
+        raise ValueError(f"Bad sink {spec}, expected KIND:TARGET with KIND one of {', '.join(SINKS)}")
+    target, *settings = rest.split(",")
+    options = {}
+    for setting in settings:
+        name, sep, value = setting.partition("=")
+        if name in ( "queue", "batch" ):
+            options[name] = int(value)
+        elif name == "linger":
+            options[name] = float(value)
+        elif name == "policy":
+            options[name] = value
+        else:
+            raise ValueError(f"Unknown sink setting {setting} in {spec}")
+    return SINKS[kind](target, **options)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+'''
+Sky temperature model over whole arrays, and fitting it to logged data
+
+The model gives the sky IR temperature of a clear sky for an ambient
+temperature, and the clouds value is how much warmer the sky is than that.
+clear_sky() and adjusted_sky() evaluate it over NumPy arrays of ( Ts, Ta )
+with the same results as CloudWatcher.get_adjusted_sky(), so months of
+readings take one pass:
+
+    data = pairs(TimeSeriesReader("/var/lib/cloudwatcher/ttyUSB0"))
+    clouds = adjusted_sky(data["sky"], data["ambient"], model)
+
+fit() estimates K1 to K7 from clear sky samples, and fit_clear() finds
+them, starting from the coldest readings of the sky at each ambient
+temperature.  From the shell:
+
+    python3 -m CloudWatcher.skymodel fit /var/lib/cloudwatcher/ttyUSB0 -o /etc/cloudwatcher/skymodel.json
+    python3 -m CloudWatcher.skymodel clouds /var/lib/cloudwatcher/ttyUSB0 -m /etc/cloudwatcher/skymodel.json -o /tmp/clouds
+
+cw2mqtt and replay take the JSON file as their -m option.
+'''
+
+import argparse, dataclasses, math, os, sys
+from typing import Optional, Sequence
+
+import numpy as np
+
+from . import SkyTemperatureModel, lunatico_sky_temperature_model
+from .derived import SKY_ADJUSTED
+from .tslog import DAY, DailyLog, TimeSeriesReader, day_files, load_numpy, parse_time
+
+NAMES = [ field.name for field in dataclasses.fields(SkyTemperatureModel) ]
+# K3 * exp( Ta * K4 / 1000 ) ^ ( K5 / 100 ) only depends on K4 * K5
+DEFAULT_FIXED = ( "K5", )
+
+# Block prefixes of the sky IR and ambient ( humidity sensor ) temperatures
+SKY_PREFIX = b"1"
+AMBIENT_PREFIXES = ( b"th", b"t" )
+
+
+def clear_sky(Ta, model: SkyTemperatureModel):
+    '''
+    Modelled clear sky temperature for the ambient temperatures Ta
+    '''
+    Ta = np.asarray(Ta, dtype=float)
+    d = Ta - model.K2 / 10
+    sign = np.copysign(1, d)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        far = model.K6 / 10 * sign * ( np.log10(np.abs(d)) + model.K7 / 100 )
+    T67 = np.where(np.abs(d) < 1, math.copysign(1, model.K6) * sign * np.abs(d), far)
+    return (
+        ( model.K1 / 100 ) * d
+        + ( model.K3 / 100 ) * np.exp(Ta * model.K4 / 1000) ** ( model.K5 / 100 )
+        + T67
+    )
+
+def adjusted_sky(Ts, Ta, model: SkyTemperatureModel):
+    '''
+    Sky minus modelled clear sky temperature, rounded as by
+    CloudWatcher.get_adjusted_sky()
+    '''
+    return np.round(np.asarray(Ts, dtype=float) - clear_sky(Ta, model), 2)
+
+def pairs(reader: TimeSeriesReader, start: Optional[float] = None, end: Optional[float] = None, max_gap: float = 60):
+    '''
+    Every sky IR reading with the ambient temperature interpolated to its
+    time, as a record array of time, sky and ambient.  Readings more than
+    max_gap seconds from an ambient reading are left out.
+    '''
+    sky = reader.read(start, end, SKY_PREFIX)
+    for prefix in AMBIENT_PREFIXES:
+        ambient = reader.read(start, end, prefix)
+        if len(ambient):
+            break
+    out = np.empty(0, [ ( "time", "f8" ), ( "sky", "f8" ), ( "ambient", "f8" ) ])
+    if not len(sky) or not len(ambient):
+        return out
+    at = ambient["time"]
+    t = sky["time"]
+    i = np.searchsorted(at, t)
+    gap = np.minimum(np.abs(t - at[np.maximum(i - 1, 0)]), np.abs(at[np.minimum(i, len(at) - 1)] - t))
+    keep = gap <= max_gap
+    out = np.empty(int(keep.sum()), out.dtype)
+    out["time"] = t[keep]
+    out["sky"] = sky["value"][keep]
+    out["ambient"] = np.interp(t[keep], at, ambient["value"])
+    return out
+
+def clear_samples(Ts, Ta, quantile: float = 0.05, width: float = 1.0, minimum: int = 20):
+    '''
+    Mask of the samples taken as clear sky: at or below the quantile of the
+    sky temperature among those with the same ambient temperature, within
+    width degrees.  Ambient temperatures seen fewer than minimum times are
+    left out.
+    '''
+    Ts = np.asarray(Ts, dtype=float)
+    bins = np.floor(np.asarray(Ta, dtype=float) / width).astype(np.int64)
+    keys, inverse, counts = np.unique(bins, return_inverse=True, return_counts=True)
+    limit = np.full(len(keys), -np.inf)
+    for k in np.flatnonzero(counts >= minimum):
+        limit[k] = np.quantile(Ts[inverse == k], quantile)
+    return Ts <= limit[inverse]
+
+def fit(Ts, Ta, initial: SkyTemperatureModel = lunatico_sky_temperature_model, fixed: Sequence[ str ] = DEFAULT_FIXED,
+        iterations: int = 200) -> SkyTemperatureModel:
+    '''
+    Least squares fit of the clear sky temperature to the samples, by
+    Levenberg-Marquardt from initial.  Coefficients in fixed keep their
+    initial value.
+    '''
+    Ts = np.asarray(Ts, dtype=float)
+    Ta = np.asarray(Ta, dtype=float)
+    free = [ name for name in NAMES if name not in fixed ]
+    if len(Ts) < len(free):
+        raise ValueError(f"{len(Ts)} samples are too few to fit {len(free)} coefficients")
+
+    def model_of(x) -> SkyTemperatureModel:
+        return dataclasses.replace(initial, **dict(zip(free, x.tolist())))
+
+    def residuals(x):
+        return Ts - clear_sky(Ta, model_of(x))
+
+    x = np.array([ getattr(initial, name) for name in free ], dtype=float)
+    r = residuals(x)
+    cost = r @ r
+    damping = 1e-3
+    for i in range(iterations):
+        # Forward difference Jacobian, one evaluation per coefficient
+        h = 1e-6 * np.maximum(np.abs(x), 1)
+        J = np.empty(( len(r), len(x) ))
+        for j in range(len(x)):
+            step = x.copy()
+            step[j] += h[j]
+            J[:, j] = ( residuals(step) - r ) / h[j]
+        A = J.T @ J
+        g = J.T @ r
+        scale = np.diag(A).copy()
+        scale[scale == 0] = 1
+        while damping < 1e10:
+            try:
+                delta = np.linalg.solve(A + damping * np.diag(scale), -g)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            r_new = residuals(x + delta)
+            cost_new = r_new @ r_new
+            if np.isfinite(cost_new) and cost_new < cost:
+                break
+            damping *= 10
+        else:
+            break
+        x += delta
+        improvement = cost - cost_new
+        r, cost = r_new, cost_new
+        damping = max(damping / 10, 1e-12)
+        if improvement <= 1e-10 * cost:
+            break
+    return model_of(x)
+
+def fit_clear(Ts, Ta, initial: SkyTemperatureModel = lunatico_sky_temperature_model, fixed: Sequence[ str ] = DEFAULT_FIXED,
+              quantile: float = 0.05, rounds: int = 3):
+    '''
+    fit() to the clear sky samples, returns the model and the mask of the
+    samples used.  The coldest skies are biased low by the sensor noise, so
+    after a first fit to them the samples within the noise of the model are
+    taken instead and fitted again.  Clouds only make the sky warmer, so the
+    noise is estimated from the samples below the model.
+    '''
+    Ts = np.asarray(Ts, dtype=float)
+    Ta = np.asarray(Ta, dtype=float)
+    clear = clear_samples(Ts, Ta, quantile) if quantile < 1 else np.ones(len(Ts), bool)
+    model = fit(Ts[clear], Ta[clear], initial, fixed)
+    if quantile >= 1:
+        return model, clear
+    for i in range(rounds):
+        r = Ts - clear_sky(Ta, model)
+        below = r[r < 0]
+        if not len(below):
+            break
+        sigma = 1.4826 * np.median(np.abs(below))
+        clear = np.abs(r) <= 2 * sigma
+        model = fit(Ts[clear], Ta[clear], model, fixed)
+    return model, clear
+
+def rms(Ts, Ta, model: SkyTemperatureModel) -> float:
+    return float(np.sqrt(np.mean(( np.asarray(Ts, dtype=float) - clear_sky(Ta, model) ) ** 2)))
+
+def write_clouds(out: str, t, clouds) -> int:
+    '''
+    Append the clouds values to reading logs in out ( prefix c ), a day
+    file at a time.  Returns the number of records written.
+    '''
+    load_numpy()
+    from .tslog import RECORD_DTYPE
+    records = np.zeros(len(t), RECORD_DTYPE)
+    records["time"] = t
+    records["prefix"] = SKY_ADJUSTED.prefix
+    records["raw"] = np.trunc(clouds)
+    records["value"] = clouds
+    log = DailyLog(out, autoflush=False)
+    try:
+        days = ( np.asarray(t) // DAY ).astype(np.int64)
+        edges = np.flatnonzero(np.diff(days)) + 1
+        for part in np.split(records, edges):
+            if len(part):
+                log.append(part.tobytes(), len(part), float(part["time"][0]))
+    finally:
+        log.close()
+    return log.records
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit and apply the sky temperature model")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("fit", help="Fit K1 to K7 to the clear sky readings of a reading log")
+    p.add_argument("directory",                                      help="Log directory of one unit")
+    p.add_argument("-e", "--end",      default = None,               help="End time, epoch seconds or ISO 8601 ( default now )")
+    p.add_argument(      "--fix",      action = 'append', default = None, help=f"Keep this coefficient at its initial value, may be repeated ( default {', '.join(DEFAULT_FIXED)} )")
+    p.add_argument("-m", "--model",    default = "30,200,6,140,100,0,0", help="Initial model, K1,...,K7 or a JSON file ( default 30,200,6,140,100,0,0 )")
+    p.add_argument("-o", "--out",      default = "",                 help="Write the model to this JSON file")
+    p.add_argument("-q", "--quantile", default = 0.05, type=float,   help="Fraction of the coldest skies at each ambient temperature first taken as clear, 1 takes every reading as is ( default 0.05 )")
+    p.add_argument("-s", "--start",    default = None,               help="Start time, epoch seconds or ISO 8601 ( default first record )")
+
+    p = commands.add_parser("clouds", help="Compute the clouds value of every sky reading of a reading log")
+    p.add_argument("directory",                                      help="Log directory of one unit")
+    p.add_argument("-e", "--end",      default = None,               help="End time, epoch seconds or ISO 8601 ( default now )")
+    p.add_argument("-m", "--model",    default = "30,200,6,140,100,0,0", help="Model, K1,...,K7 or a JSON file ( default 30,200,6,140,100,0,0 )")
+    p.add_argument("-o", "--out",      default = "",                 help="Write reading logs to this directory instead of CSV to stdout")
+    p.add_argument("-s", "--start",    default = None,               help="Start time, epoch seconds or ISO 8601 ( default first record )")
+    args = parser.parse_args()
+
+    model = SkyTemperatureModel.parse(args.model)
+    data = pairs(TimeSeriesReader(args.directory), parse_time(args.start), parse_time(args.end))
+
+    if args.command == "fit":
+        fitted, clear = fit_clear(data["sky"], data["ambient"], model, DEFAULT_FIXED if args.fix is None else args.fix, args.quantile)
+        Ts, Ta = data["sky"][clear], data["ambient"][clear]
+        print(f"{len(Ts)} of {len(data)} readings taken as clear, ambient {Ta.min():.1f} to {Ta.max():.1f} degC")
+        print(f"rms {rms(Ts, Ta, model):.2f} degC with the initial model, {rms(Ts, Ta, fitted):.2f} degC fitted")
+        print(",".join(f"{getattr(fitted, name):.6g}" for name in NAMES))
+        if args.out:
+            fitted.save(args.out, samples=int(len(Ts)), rms=round(rms(Ts, Ta, fitted), 3))
+        return
+
+    clouds = adjusted_sky(data["sky"], data["ambient"], model)
+    if args.out:
+        if os.path.isdir(args.out) and day_files(args.out):
+            # Logs are appended to, so a second run would duplicate every record
+            raise SystemExit(f"{args.out} already holds reading logs")
+        print(f"{write_clouds(args.out, data['time'], clouds)} records written to {args.out}")
+        return
+    out = sys.stdout
+    out.write("time,sky,ambient,clouds\n")
+    for t, s, a, c in zip(data["time"].tolist(), data["sky"].tolist(), data["ambient"].tolist(), clouds.tolist()):
+        out.write(f"{t:.3f},{s},{a:.2f},{c}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+'''
+Statistics of CloudWatcher readings
+'''
+
+from array import array
+from dataclasses import dataclass
+import math
+from typing import Iterable, Optional
+
+
+@dataclass
+class Summary:
+    count: int
+    rejected: int
+    mean: float
+    stdev: float
+    min: float
+    max: float
+
+class Accumulator:
+    '''
+    The samples of one interval, N sigma clipped when summarized.
+
+    Clipping runs over the whole interval ( see clipped_summary ), so a
+    step change part way through, e.g. rain starting, moves the mean
+    instead of being rejected against the samples before it.  min and max
+    cover every sample, including rejected ones, so max doubles as the gust
+    of a wind reading.
+    '''
+    __slots__ = ( "sigma", "samples", "min", "max" )
+
+    def __init__(self, sigma: float = 2.0):
+        self.sigma = sigma
+        self.reset()
+
+    def reset(self) -> None:
+        self.samples = array("d")
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x: float) -> None:
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        self.samples.append(x)
+
+    def extend(self, values: Iterable[float]) -> None:
+        for x in values:
+            self.add(x)
+
+    @property
+    def count(self) -> int:
+        return len(self.samples)
+
+    def summary(self) -> Optional[Summary]:
+        return clipped_summary(self.samples, self.sigma)
+
+def mean_stdev(values) -> tuple:
+    n = len(values)
+    mean = math.fsum(values) / n
+    if n < 2:
+        return mean, 0.0
+    return mean, math.sqrt(math.fsum(( x - mean ) ** 2 for x in values) / ( n - 1 ))
+
+def resolution(values) -> float:
+    '''
+    Smallest difference between two distinct values, the quantization step
+    of the readings, 0 when they are all equal
+    '''
+    ordered = sorted(set(values))
+    return min(( b - a for a, b in zip(ordered, ordered[1:]) ), default=0.0)
+
+def clipped_summary(values, sigma: float = 2.0, iterations: int = 5) -> Optional[Summary]:
+    '''
+    N sigma clipping over a whole window of samples.
+
+    Clipping is repeated against the mean and stdev of the surviving samples
+    until nothing more is removed.  A sample within one quantization step
+    of the mean, the smallest difference between two values, is never
+    removed, however small the stdev; nor, as a result, is anything from a
+    window holding only two levels, e.g. a step.
+    '''
+    data = list(values)
+    if not data:
+        return None
+    keep = data
+    mean, stdev = mean_stdev(keep)
+    if sigma:
+        step = resolution(data)
+        for i in range(iterations):
+            limit = max(sigma * stdev, step)
+            kept = [ x for x in keep if abs(x - mean) <= limit ]
+            if len(kept) == len(keep) or not kept:
+                break
+            keep = kept
+            mean, stdev = mean_stdev(keep)
+    return Summary(len(keep), len(data) - len(keep), mean, stdev, min(data), max(data))
+
+class RingBuffer:
+    '''
+    Fixed size window of the most recent samples, backed by an array.
+
+    append() is O(1) and keeps a running total for the mean; the total is
+    recomputed every time the write position wraps so rounding errors do not
+    accumulate.  Iteration goes from the oldest to the newest sample.
+    '''
+    __slots__ = ( "data", "size", "count", "pos", "total" )
+
+    def __init__(self, size: int, typecode: str = "d"):
+        if size < 1:
+            raise ValueError("RingBuffer size must be at least 1")
+        self.data = array(typecode, bytes(array(typecode).itemsize * size))
+        self.size = size
+        self.clear()
+
+    def clear(self) -> None:
+        self.count = 0
+        self.pos = 0
+        self.total = 0.0
+
+    def append(self, x: float) -> None:
+        if self.count == self.size:
+            self.total -= self.data[self.pos]
+        else:
+            self.count += 1
+        self.data[self.pos] = x
+        self.total += x
+        self.pos += 1
+        if self.pos == self.size:
+            self.pos = 0
+            self.total = sum(self.data[:self.count])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        if self.count < self.size:
+            return iter(self.data[:self.count])
+        return iter(self.data[self.pos:] + self.data[:self.pos])
+
+    def values(self) -> list:
+        return list(self)
+
+    @property
+    def mean(self) -> Optional[float]:
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, p: float) -> Optional[float]:
+        '''
+        p-th percentile ( 0 - 100 ) of the window, linearly interpolated
+        '''
+        if not self.count:
+            return None
+        ordered = sorted(self.data[:self.count])
+        k = ( len(ordered) - 1 ) * p / 100
+        f = math.floor(k)
+        c = min(f + 1, len(ordered) - 1)
+        return ordered[f] + ( ordered[c] - ordered[f] ) * ( k - f )
+
+    def summary(self, digits: int = 2) -> dict:
+        '''
+        Window statistics in the form published over MQTT
+        '''
+        if not self.count:
+            return {}
+        window = self.data[:self.count]
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, digits),
+            'min': round(min(window), digits),
+            'max': round(max(window), digits),
+            'median': round(self.percentile(50), digits),
+        }
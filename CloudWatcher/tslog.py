@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+'''
+Append only binary log of CloudWatcher readings
+
+One file per UTC day, YYYY-MM-DD.cwl, of a 16 byte header followed by
+fixed size little endian records:
+
+    time    f8  seconds since the epoch
+    prefix  2s  block prefix, e.g. b"1" ( sky IR ) or b"hh"
+            2x
+    raw     i4  raw value from the unit
+    value   f8  decoded value
+
+Only readings measured by the unit are logged, see Sensor.prefix.  Files
+are read through mmap as NumPy record arrays without parsing, and each
+day is sorted by time as written, so slicing a time range is a binary
+search in the days it spans:
+
+    log = TimeSeriesLog("/var/lib/cloudwatcher/ttyUSB0")
+    cw.recorder = log
+
+    data = TimeSeriesReader("/var/lib/cloudwatcher/ttyUSB0").read(start, end, b"1")
+    data["time"], data["value"]
+
+Or from the shell, as CSV:
+
+    python3 -m CloudWatcher.tslog /var/lib/cloudwatcher/ttyUSB0 --start 2024-01-01
+
+CaptureLog keeps the raw blocks instead, in YYYY-MM-DD.cwc files, for
+CloudWatcher.replay to decode again with other constants.
+'''
+
+import argparse, datetime, mmap, os, struct, sys, time
+from typing import Iterator, List, Optional
+
+
+MAGIC = b"CWLOG\x00\x01\x00"
+HEADER = struct.Struct("<8sI4x")
+RECORD = struct.Struct("<d2s2xid")
+SUFFIX = ".cwl"
+DAY = 86400
+
+# Raw capture files, see CaptureLog
+CAPTURE_MAGIC = b"CWCAP\x00\x01\x00"
+CAPTURE_RECORD = struct.Struct("<d15sx")
+CAPTURE_SUFFIX = ".cwc"
+
+# NumPy and the record dtype, set by load_numpy()
+np = None
+RECORD_DTYPE = None
+
+def load_numpy():
+    '''
+    Import NumPy on first use, writers never need it
+    '''
+    global np, RECORD_DTYPE
+    if np is None:
+        import numpy
+        RECORD_DTYPE = numpy.dtype({
+            'names': [ "time", "prefix", "raw", "value" ],
+            'formats': [ "<f8", "S2", "<i4", "<f8" ],
+            'offsets': [ 0, 8, 12, 16 ],
+            'itemsize': RECORD.size,
+        })
+        np = numpy
+    return np
+
+def day_name(day: int, suffix: str = SUFFIX) -> str:
+    return datetime.datetime.fromtimestamp(day * DAY, datetime.timezone.utc).strftime("%Y-%m-%d") + suffix
+
+def day_of(name: str, suffix: str = SUFFIX) -> Optional[int]:
+    try:
+        d = datetime.datetime.strptime(name[:-len(suffix)], "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+    return int(d.timestamp()) // DAY
+
+def day_files(directory: str, suffix: str = SUFFIX, start: Optional[float] = None, end: Optional[float] = None) -> List[ str ]:
+    '''
+    Paths of the day files in directory overlapping [ start, end ), oldest
+    first
+    '''
+    first = None if start is None else int(start // DAY)
+    last = None if end is None else int(end // DAY)
+    found = []
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        day = day_of(name, suffix)
+        if day is None or ( first is not None and day < first ) or ( last is not None and day > last ):
+            continue
+        found.append(( day, os.path.join(directory, name) ))
+    return [ path for day, path in sorted(found) ]
+
+class DailyLog:
+    '''
+    Append only files of fixed size records, one per UTC day.  Writes are
+    flushed straight away unless autoflush is off.
+    '''
+    magic = MAGIC
+    record = RECORD
+    suffix = SUFFIX
+
+    def __init__(self, directory: str, autoflush: bool = True):
+        self.directory = directory
+        self.autoflush = autoflush
+        self.day = None
+        self.file = None
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, day: int) -> bool:
+        '''
+        Switch to the file of day, returns True when it was created
+        '''
+        self.close()
+        path = os.path.join(self.directory, day_name(day, self.suffix))
+        self.file = open(path, "ab")
+        self.day = day
+        size = self.file.tell()
+        if size == 0:
+            self.file.write(HEADER.pack(self.magic, self.record.size))
+            return True
+        if ( size - HEADER.size ) % self.record.size:
+            # A record cut short by a crash, drop it to keep records aligned
+            self.file.truncate(size - ( size - HEADER.size ) % self.record.size)
+        return False
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, data: bytes, count: int, now: float) -> None:
+        day = int(now // DAY)
+        if day != self.day:
+            self.open(day)
+        self.file.write(data)
+        if self.autoflush:
+            self.file.flush()
+        self.records += count
+
+class TimeSeriesLog(DailyLog):
+    '''
+    Writer, one per unit and directory.  write() takes the dict of Readings
+    a command returns.
+    '''
+    def write(self, result: dict, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        pack = RECORD.pack
+        chunk = []
+        for reading in result.values():
+            prefix = getattr(getattr(reading, "sensor", None), "prefix", None)
+            if prefix is None:
+                continue
+            try:
+                chunk.append(pack(now, prefix, reading.raw if reading.raw is not None else int(reading.value), float(reading.value)))
+            except (TypeError, ValueError, struct.error):
+                continue
+        if chunk:
+            self.append(b"".join(chunk), len(chunk), now)
+
+class CaptureLog(DailyLog):
+    '''
+    Raw blocks as received, for CloudWatcher.capture, to be decoded again
+    later by CloudWatcher.replay.  Records are time f8, the 15 byte block
+    and a pad byte.  Each day file starts with the last constants ( !M )
+    block seen, so every file can be decoded on its own.
+    '''
+    magic = CAPTURE_MAGIC
+    record = CAPTURE_RECORD
+    suffix = CAPTURE_SUFFIX
+    constants: Optional[bytes] = None
+
+    def open(self, day: int) -> bool:
+        created = super().open(day)
+        if created and self.constants is not None:
+            self.file.write(CAPTURE_RECORD.pack(day * DAY, self.constants))
+            self.records += 1
+        return created
+
+    def write(self, block: bytes, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        self.append(CAPTURE_RECORD.pack(now, block), 1, now)
+        if block[1:2] == b"M":
+            # Only after append(), a day file it opens starts with the
+            # constants of the previous day, not this block twice
+            self.constants = block
+
+class TimeSeriesReader:
+    '''
+    Reads the logs of one unit.  Needs NumPy for read(), records() works
+    without it.
+    '''
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def days(self, start: Optional[float] = None, end: Optional[float] = None) -> List[ str ]:
+        return day_files(self.directory, SUFFIX, start, end)
+
+    def map(self, path: str):
+        '''
+        The records of one day file as a read only memory mapped array
+        '''
+        load_numpy()
+        count = ( os.path.getsize(path) - HEADER.size ) // RECORD.size
+        if count <= 0:
+            return np.empty(0, RECORD_DTYPE)
+        return np.memmap(path, RECORD_DTYPE, "r", HEADER.size, ( count, ))
+
+    def read(self, start: Optional[float] = None, end: Optional[float] = None, prefix: Optional[bytes] = None):
+        '''
+        Records with start <= time < end, optionally of one block prefix
+        '''
+        try:
+            load_numpy()
+        except ImportError:
+            raise ImportError("TimeSeriesReader.read needs numpy, use records() instead")
+        parts = []
+        for path in self.days(start, end):
+            data = self.map(path)
+            times = data["time"]
+            lo = 0 if start is None else int(np.searchsorted(times, start, "left"))
+            hi = len(data) if end is None else int(np.searchsorted(times, end, "left"))
+            if hi > lo:
+                part = data[lo:hi]
+                if prefix is not None:
+                    part = part[part["prefix"] == prefix]
+                parts.append(part)
+        if not parts:
+            return np.empty(0, RECORD_DTYPE)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def records(self, start: Optional[float] = None, end: Optional[float] = None, prefix: Optional[bytes] = None) -> Iterator[ tuple ]:
+        '''
+        ( time, prefix, raw, value ) tuples, without NumPy
+        '''
+        for path in self.days(start, end):
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                count = ( size - HEADER.size ) // RECORD.size
+                if count <= 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    view = memoryview(m)[HEADER.size:HEADER.size + count * RECORD.size]
+                    try:
+                        for t, p, raw, value in RECORD.iter_unpack(view):
+                            if ( start is not None and t < start ) or ( prefix is not None and p.rstrip(b"\0") != prefix ):
+                                continue
+                            if end is not None and t >= end:
+                                break
+                            yield ( t, p.rstrip(b"\0"), raw, value )
+                    finally:
+                        view.release()
+
+def parse_time(text: Optional[str]) -> Optional[float]:
+    '''
+    Epoch seconds or an ISO 8601 date / time, UTC unless it has an offset
+    '''
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    d = datetime.datetime.fromisoformat(text)
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=datetime.timezone.utc)
+    return d.timestamp()
+
+def main():
+    parser = argparse.ArgumentParser(description="Print logged readings as CSV")
+    parser.add_argument("directory",                     help="Log directory of one unit")
+    parser.add_argument("-e", "--end",   default = None, help="End time, epoch seconds or ISO 8601 ( default now )")
+    parser.add_argument("-p", "--prefix", default = None, help="Only this block prefix, e.g. 1 for sky IR")
+    parser.add_argument("-s", "--start", default = None, help="Start time, epoch seconds or ISO 8601 ( default first record )")
+    args = parser.parse_args()
+
+    prefix = None if args.prefix is None else str.encode(args.prefix, "ascii")
+    out = sys.stdout
+    out.write("time,prefix,raw,value\n")
+    for t, p, raw, value in TimeSeriesReader(args.directory).records(parse_time(args.start), parse_time(args.end), prefix):
+        out.write(f"{t:.3f},{p.decode('ascii')},{raw},{value}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import pytest
+
+from CloudWatcher import CloudWatcher
+from CloudWatcher.replay import read_capture, replay, replay_readings
+from CloudWatcher.simulator import Simulator
+from CloudWatcher.tslog import CaptureLog, TimeSeriesReader
+
+SWEEP = [ b"M!", b"C!", b"E!", b"S!", b"T!", b"h!", b"p!" ]
+
+
+@pytest.fixture
+def captured(tmp_path):
+    '''
+    Capture directory of one sweep read from the simulator, and the
+    readings decoded live
+    '''
+    sim = Simulator(baud=0, seed=1)
+    cw = CloudWatcher(sim.start(), 0)
+    cw.capture = CaptureLog(str(tmp_path / "capture"))
+    try:
+        results = cw.query(SWEEP)
+    finally:
+        cw.capture.close()
+        cw.close()
+        sim.stop()
+    live = {}
+    for result in results:
+        live.update(result)
+    return tmp_path / "capture", live
+
+def test_capture_records_blocks(captured):
+    directory, live = captured
+    path, = directory.iterdir()
+    frames = list(read_capture(str(path)))
+    # Every block once, at the time it was read
+    assert [ block[1:2] for t, block in frames ] == [ b"M", b"6", b"3", b"4", b"5", b"R", b"1", b"2", b"h", b"p" ]
+    assert frames[0][0] % 86400 != 0
+
+def test_replay_decodes_as_live(captured):
+    directory, live = captured
+    replayed = { reading.sensor.key: reading for t, reading in replay_readings([ str(directory) ]) }
+    assert set(live) <= set(replayed)
+    for key, reading in live.items():
+        assert replayed[key].value == reading.value, key
+
+def test_replay_constants(captured):
+    directory, live = captured
+    replayed = { reading.sensor.key: reading for t, reading in replay_readings([ str(directory) ], constants={ "zener_voltage": 3.3 }) }
+    assert replayed["zener_voltage"].value == 3.0
+    assert replayed["zvolt"].value != live["zvolt"].value
+
+def test_replay_to_logs(captured, tmp_path):
+    directory, live = captured
+    out = str(tmp_path / "logs")
+    count = replay([ str(directory) ], out, workers=1)
+    records = list(TimeSeriesReader(out).records())
+    assert count == len(records) > 0
+    assert { prefix for t, prefix, raw, value in records } >= { b"1", b"2", b"R" }
+    with pytest.raises(ValueError):
+        replay([ str(directory) ], out, workers=1)
+
+def test_constants_carried_to_the_next_day(tmp_path):
+    sim = Simulator(baud=0)
+    constants = sim.respond(b"M!")[0]
+    sim.constants[0] = 310
+    changed = sim.respond(b"M!")[0]
+    sky = sim.respond(b"S!")[0]
+    capture = CaptureLog(str(tmp_path))
+    day = 20000 * 86400
+    capture.write(constants, day + 100)
+    capture.write(sky, day + 200)
+    capture.write(sky, day + 86400 + 100)
+    capture.write(changed, day + 2 * 86400 + 100)
+    capture.close()
+    files = [ [ ( t - day, block ) for t, block in read_capture(str(path)) ] for path in sorted(tmp_path.iterdir()) ]
+    assert files == [
+        [ ( 100, constants ), ( 200, sky ) ],
+        # A new day file opens with the constants in force
+        [ ( 86400, constants ), ( 86500, sky ) ],
+        # Then the block which changed them, once
+        [ ( 2 * 86400, constants ), ( 2 * 86400 + 100, changed ) ],
+    ]
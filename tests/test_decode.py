@@ -0,0 +1,22 @@
+from CloudWatcher import CloudWatcher
+from CloudWatcher.simulator import Simulator, block, field
+
+
+def decoder() -> CloudWatcher:
+    return CloudWatcher(None, 0)
+
+def test_version_decimal():
+    reading = decoder().process_block(block(b"V5.89"))
+    assert reading.key == "version"
+    assert reading.value == 5.89
+
+def test_version_right_aligned():
+    assert decoder().process_block(field(b"V", "5.72")).value == 5.72
+
+def test_version_hundredths():
+    assert decoder().process_block(field(b"V", 589)).value == 5.89
+
+def test_version_from_simulator():
+    cw = decoder()
+    blocks = Simulator().respond(b"B!")
+    assert [ cw.process_block(b).value for b in blocks[:-1] ] == [ 5.89 ]
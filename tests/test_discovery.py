@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from CloudWatcher import FW_VERSION, CloudWatcher
+from CloudWatcher.discovery import Discovery
+from CloudWatcher.publisher import Publisher
+from CloudWatcher.readings import Reading
+from CloudWatcher.simulator import Simulator
+
+SWEEP = [ b"K!", b"B!", b"t!", b"h!", b"C!", b"S!", b"T!" ]
+
+
+@pytest.fixture(scope="module")
+def messages():
+    '''
+    The results of one sweep of the simulator, as cw2mqtt publishes them
+    '''
+    sim = Simulator(baud=0, seed=1)
+    cw = CloudWatcher(sim.start(), 0)
+    try:
+        return [ r for r in cw.query(SWEEP) if r ]
+    finally:
+        cw.close()
+        sim.stop()
+
+def configs_of(discovery: Discovery, messages: list) -> dict:
+    configs = discovery.update(messages)
+    return configs[0] if configs else {}
+
+def send(discovery: Discovery, configs: dict) -> None:
+    for topic in configs:
+        discovery.sent(topic)
+
+def test_configs(messages):
+    configs = configs_of(Discovery("", "cloudwatcher", will="cw2mqtt/availability"), messages)
+    config = configs["sensor/cloudwatcher_1234/skyir/config"]
+    assert config["state_topic"] == "cloudwatcher/skyir"
+    assert config["unit_of_measurement"] == "°C" and config["device_class"] == "temperature"
+    assert [ a["topic"] for a in config["availability"] ] == [ "cloudwatcher/availability", "cw2mqtt/availability" ]
+    assert config["device"]["serial_number"] == "1234" and config["device"]["sw_version"] == "5.89"
+    assert configs["sensor/cloudwatcher_1234/hum/config"]["device_class"] == "humidity"
+    # Device data is not an entity
+    assert not any("/serial/" in topic or "/version/" in topic for topic in configs)
+
+def test_combined(messages):
+    configs = configs_of(Discovery("", "cloudwatcher", combined=True), messages)
+    config = configs["sensor/cloudwatcher_1234/skyir/config"]
+    assert config["state_topic"] == "cloudwatcher/state"
+    assert "value_json['skyir']" in config["value_template"]
+
+def test_nothing_before_the_serial(messages):
+    discovery = Discovery("", "cloudwatcher")
+    assert discovery.update(messages[2:]) == []
+    assert configs_of(discovery, messages[:2])
+
+def test_hashes_saved_once_sent(messages, tmp_path):
+    discovery = Discovery(str(tmp_path), "cloudwatcher")
+    configs = configs_of(discovery, messages)
+    assert configs
+    # Handed out, not sent: nothing saved, not handed out twice
+    assert list(tmp_path.iterdir()) == []
+    assert configs_of(discovery, messages) == {}
+    sent = sorted(configs)[:2]
+    send(discovery, sent)
+    saved = json.loads((tmp_path / "discovery-1234.json").read_text())
+    assert sorted(saved["hashes"]) == sent
+
+    # A restart sends only what was not sent before
+    restarted = Discovery(str(tmp_path), "cloudwatcher")
+    assert set(configs_of(restarted, messages)) == set(configs) - set(sent)
+
+def test_retry_and_force(messages):
+    discovery = Discovery("", "cloudwatcher")
+    configs = configs_of(discovery, messages)
+    sent = sorted(configs)[:2]
+    send(discovery, sent)
+    # Lost with the connection
+    discovery.retry()
+    assert set(configs_of(discovery, messages)) == set(configs) - set(sent)
+    # Home Assistant came back
+    discovery.force()
+    assert set(configs_of(discovery, messages)) == set(configs)
+
+def test_new_firmware_sent_again(messages):
+    discovery = Discovery("", "cloudwatcher")
+    send(discovery, configs_of(discovery, messages))
+    configs = configs_of(discovery, messages + [ { 'version': Reading(FW_VERSION, 5.9) } ])
+    assert len(configs) == len(discovery.hashes)
+    assert all(config["device"]["sw_version"] == "5.9" for config in configs.values())
+
+class Info:
+    def __init__(self, published: bool):
+        self.published = published
+
+    def is_published(self) -> bool:
+        return self.published
+
+class Client:
+    def __init__(self, published: bool):
+        self.published = published
+        self.topics = []
+
+    def publish(self, topic, payload, retain=False):
+        self.topics.append(topic)
+        return Info(self.published)
+
+@pytest.mark.parametrize("published", [ True, False ])
+def test_publisher_reports_sent(messages, published):
+    discovery = Discovery("", "cloudwatcher")
+    configs = discovery.update(messages)
+    client = Client(published)
+    publisher = Publisher(client)
+    publisher.start()
+    publisher.publish(configs, "homeassistant", retain=True, urgent=True, sent=discovery.sent)
+    publisher.stop()
+    assert client.topics == [ f"homeassistant/{topic}" for topic in configs[0] ]
+    if published:
+        assert set(discovery.hashes) == set(configs[0]) and not discovery.sending
+    else:
+        assert discovery.hashes == {} and set(discovery.sending) == set(configs[0])
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+from CloudWatcher import CloudWatcher
+from CloudWatcher.heater import HeaterController, parse_heater
+from CloudWatcher.simulator import Simulator
+
+
+@pytest.fixture
+def unit():
+    sim = Simulator(baud=0, seed=1)
+    cw = CloudWatcher(sim.start(), 0)
+    cw.max_wait = 1
+    yield cw, sim
+    cw.close()
+    sim.stop()
+
+def test_hysteresis():
+    heater = HeaterController(None, "ambient", 4, mode="hysteresis", band=1, low=10, high=90)
+    levels = [ heater.control(temp, 20, 0) for temp in ( 18.5, 19.5, 20.5, 21.5, 20.5, 19.5, 18.5 ) ]
+    assert levels == [ 90, 90, 90, 10, 10, 10, 90 ]
+
+def test_pid_proportional_and_limits():
+    heater = HeaterController(None, "ambient", 4, kp=10, ki=0)
+    assert heater.control(18, 20, 0) == 20
+    assert heater.control(0, 20, 1) == 100
+    assert heater.control(30, 20, 2) == 0
+
+def test_pid_integral_does_not_wind_up():
+    heater = HeaterController(None, "ambient", 4, kp=10, ki=1)
+    # Far below target for a long time: held at high, integral not growing
+    for t in range(100):
+        assert heater.control(0, 20, t) == 100
+    assert heater.integral <= heater.high
+    # Once above target the output comes down at once
+    assert heater.control(25, 20, 101) < 100
+
+def test_tick_reads_and_sets_the_unit(unit):
+    cw, sim = unit
+    heater = HeaterController(cw, "ambient", 12, kp=10, ki=0)
+    cw.heater = heater
+    heater.tick(time.monotonic())
+    assert heater.queries == 1 and heater.missed == 0
+    sensor = heater.seen["sensor"][1]
+    reference = heater.seen["hum_temp"][1]
+    assert heater.target == pytest.approx(reference + 12)
+    # The simulated sensor is about 3 degrees below the target
+    assert 0 < heater.level < 100
+    assert heater.level == pytest.approx(10 * ( reference + 12 - sensor ))
+    # The unit was sent the level
+    assert sim.values["Q"] == heater.pwm == round(heater.level * 1023 / 100)
+    assert heater.writes == 1
+
+    # Inputs the sampling sweep read are not read again, an unchanged
+    # level is not sent again
+    cw.query([ b"C!", b"t!" ])
+    commands = sim.commands
+    heater.tick(time.monotonic())
+    assert sim.commands == commands
+    assert heater.queries == 1 and heater.writes == 1
+
+def test_level_changed_behind_our_back(unit):
+    cw, sim = unit
+    heater = HeaterController(cw, "ambient", 12, kp=10, ki=0)
+    cw.heater = heater
+    heater.tick(time.monotonic())
+    pwm = heater.pwm
+    sim.values["Q"] = 0
+    cw.query([ b"Q!", b"C!", b"t!" ])
+    assert heater.pwm is None
+    heater.tick(time.monotonic())
+    assert sim.values["Q"] == pwm and heater.writes == 2
+
+def test_thread_ticks(unit):
+    cw, sim = unit
+    heater = HeaterController(cw, "dewpoint", 4, period=0.05)
+    cw.heater = heater
+    heater.start()
+    time.sleep(0.3)
+    heater.stop()
+    snapshot = heater.snapshot()
+    assert snapshot['ticks'] >= 3 and snapshot['errors'] == 0
+    assert snapshot['reference'] == "dewpoint" and snapshot['target'] is not None
+
+def test_parse_heater():
+    heater = parse_heater(None, "dewpoint:3,mode=hysteresis,band=0.5,period=10")
+    assert ( heater.reference, heater.delta, heater.mode, heater.band, heater.period ) == ( "dewpoint", 3, "hysteresis", 0.5, 10 )
+    for spec in ( "ground:3", "ambient:warm", "ambient:3,mode=bang", "ambient:3,speed=2", "ambient:3,low=50,high=20" ):
+        with pytest.raises(ValueError):
+            parse_heater(None, spec)
@@ -0,0 +1,123 @@
+import os, time
+
+import pytest
+
+from CloudWatcher import CloudWatcher
+from CloudWatcher.simulator import Simulator
+
+
+class Unit:
+    '''
+    A simulator behind a stable port name, which can be unplugged and
+    plugged in again like a USB adapter
+    '''
+    def __init__(self, directory):
+        self.port = str(directory / "ttyCW")
+        self.sim = None
+
+    def plug(self) -> Simulator:
+        self.sim = Simulator(baud=0, seed=1)
+        path = self.sim.start()
+        if os.path.lexists(self.port):
+            os.unlink(self.port)
+        os.symlink(path, self.port)
+        return self.sim
+
+    def unplug(self) -> None:
+        os.unlink(self.port)
+        self.sim.stop()
+
+
+@pytest.fixture
+def unit(tmp_path):
+    unit = Unit(tmp_path)
+    unit.plug()
+    yield unit
+    if unit.sim.running:
+        unit.sim.stop()
+
+def open_unit(unit: Unit, events: list) -> CloudWatcher:
+    cw = CloudWatcher(unit.port, 0)
+    cw.max_wait = 0.2
+    cw.min_backoff = cw.backoff = 0.05
+    cw.max_backoff = 0.2
+    cw.on_link = events.append
+    return cw
+
+def sky(cw: CloudWatcher):
+    result, = cw.query([ b"S!" ])
+    return result and result["skyir"].value
+
+def wait_retry(cw: CloudWatcher) -> None:
+    time.sleep(max(cw.retry_at - time.monotonic(), 0) + 0.01)
+
+def test_timeouts_take_link_down(unit):
+    events = []
+    cw = open_unit(unit, events)
+    try:
+        assert sky(cw) == -18.5
+        unit.sim.timeout = 1
+        # Each query reads the response to its buffer reset first
+        for i in range(cw.error_limit):
+            assert sky(cw) is None
+            if events:
+                break
+        assert events == [ False ] and not cw.link_up
+        assert cw.errors == cw.error_limit
+        # Commands fail at once until the backoff is over
+        rejected = cw.metrics.rejected
+        start = time.monotonic()
+        assert sky(cw) is None
+        assert time.monotonic() - start < cw.max_wait
+        assert cw.metrics.rejected == rejected + 1
+
+        unit.sim.timeout = 0
+        wait_retry(cw)
+        assert sky(cw) == -18.5
+        assert events == [ False, True ] and cw.link_up
+        assert cw.metrics.reconnects == 1
+        assert cw.backoff == cw.min_backoff
+    finally:
+        cw.close()
+
+def test_unplug_and_replug(unit):
+    events = []
+    cw = open_unit(unit, events)
+    try:
+        assert sky(cw) == -18.5
+        unit.unplug()
+        # The failed port takes the link down without waiting for timeouts
+        for i in range(cw.error_limit):
+            sky(cw)
+            if events:
+                break
+        assert events == [ False ]
+
+        unit.plug().values["1"] = -2000
+        deadline = time.monotonic() + 5
+        while not cw.link_up and time.monotonic() < deadline:
+            wait_retry(cw)
+            sky(cw)
+        assert events == [ False, True ]
+        assert sky(cw) == -20.0
+    finally:
+        cw.close()
+
+def test_backoff_doubles_up_to_max(unit):
+    events = []
+    cw = open_unit(unit, events)
+    try:
+        unit.unplug()
+        cw.lost(OSError("unplugged"))
+        assert events == [ False ]
+        assert cw.backoff == 0.1
+        backoffs = []
+        for i in range(4):
+            wait_retry(cw)
+            assert sky(cw) is None
+            backoffs.append(cw.backoff)
+        assert backoffs == [ 0.2, 0.2, 0.2, 0.2 ]
+        assert cw.metrics.reconnects == 0
+        assert events == [ False ]
+    finally:
+        cw.close()
@@ -0,0 +1,44 @@
+import json
+
+from CloudWatcher import CloudWatcher
+from CloudWatcher.metadata import METADATA, MetadataCache
+from CloudWatcher.simulator import Simulator
+
+
+def responses(sim: Simulator) -> list:
+    cw = CloudWatcher(None, 0)
+    results = []
+    for cmd in METADATA:
+        result = {}
+        for block in sim.respond(cmd)[:-1]:
+            cw.merge_block(result, block)
+        results.append(result)
+    return results
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "ttyUSB0.json")
+    cache = MetadataCache(path, "/dev/ttyUSB0")
+    assert cache.update(METADATA, responses(Simulator()))
+    loaded = MetadataCache(path, "/dev/ttyUSB0")
+    assert loaded.load()
+    assert loaded.messages() == cache.messages()
+    assert loaded.constants()["RainBeta"] == 3450
+    assert not loaded.update(METADATA, responses(Simulator()))
+
+def test_needs_every_response(tmp_path):
+    path = tmp_path / "ttyUSB0.json"
+    cache = MetadataCache(str(path), "/dev/ttyUSB0")
+    cache.update(METADATA, responses(Simulator()))
+    data = json.loads(path.read_text())
+    del data["responses"]["B!"]
+    path.write_text(json.dumps(data))
+    assert not MetadataCache(str(path), "/dev/ttyUSB0").load()
+    assert not MetadataCache(str(path), "/dev/ttyUSB1").load()
+
+def test_firmware_change_drops_the_rest():
+    cache = MetadataCache("", "/dev/ttyUSB0")
+    cache.update(METADATA, responses(Simulator()))
+    sim = Simulator()
+    sim.version = "5.90"
+    assert cache.update([ b"B!" ], responses(sim)[1:2])
+    assert list(cache.responses) == [ "B!" ]
@@ -0,0 +1,73 @@
+import time
+
+from CloudWatcher import SKY_IR
+from CloudWatcher.publisher import Publisher
+from CloudWatcher.readings import Reading
+
+
+def test_urgent_overflow_is_counted():
+    # Never connected, so nothing drains
+    publisher = Publisher(None, size=2)
+    for i in range(3):
+        publisher.publish([ { 'safety/rain': { 'value': i } } ], "cloudwatcher", urgent=True)
+    assert publisher.dropped == 1
+    assert [ entry[1]['value'] for entry in publisher.urgent ] == [ 1, 2 ]
+
+def test_overflow_is_counted():
+    publisher = Publisher(None, size=2, policy="drop")
+    for i in range(3):
+        publisher.publish([ { 'skyir': Reading(SKY_IR, -18 - i, -1800 - i * 100) } ], "cloudwatcher")
+    assert publisher.dropped == 1 and len(publisher.pending) == 2
+
+class Info:
+    published = False
+    rc = 0
+
+    def is_published(self) -> bool:
+        return self.published
+
+class Client:
+    def __init__(self):
+        self.topics = []
+        self.infos = []
+
+    def publish(self, topic, payload, retain=False):
+        self.topics.append(topic)
+        self.infos.append(Info())
+        return self.infos[-1]
+
+def wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_sent_does_not_hold_up_the_queue():
+    client = Client()
+    sent = []
+    publisher = Publisher(client)
+    publisher.start()
+    try:
+        publisher.publish([ { 'config': {} } ], "homeassistant", retain=True, urgent=True, sent=sent.append)
+        publisher.publish([ { 'skyir': Reading(SKY_IR, -18.5, -1850) } ], "cloudwatcher")
+        # The reading goes out while the config is still in the client
+        wait_for(lambda: len(client.topics) == 2)
+        assert sent == []
+        client.infos[0].published = True
+        wait_for(lambda: sent == [ "config" ])
+    finally:
+        publisher.stop()
+
+def test_sent_not_called_on_failure():
+    client = Client()
+    sent = []
+    publisher = Publisher(client)
+    publisher.start()
+    try:
+        publisher.publish([ { 'config': {} } ], "homeassistant", urgent=True, sent=sent.append)
+        wait_for(lambda: client.topics)
+        client.infos[0].rc = 4
+        wait_for(lambda: not publisher.unsent)
+        assert sent == []
+    finally:
+        publisher.stop()
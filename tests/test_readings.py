@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from CloudWatcher import SKY_IR
+from CloudWatcher.readings import Reading, Sensor, dumps
+
+SERIAL = Sensor("serial", bare=True)
+
+
+def test_item_access():
+    reading = Reading(SKY_IR, -18.5, -1850)
+    assert [ reading[f] for f in ( 'name', 'raw', 'value', 'unit' ) ] == [ "Sky IR Temp", -1850, -18.5, "degC" ]
+    assert { f: reading[f] for f in reading.to_dict() } == reading.to_dict()
+
+def test_item_access_missing():
+    reading = Reading(Sensor("light"), 1234)
+    assert reading['value'] == 1234
+    for f in ( 'raw', 'name', 'unit', 'sensor', 'key' ):
+        with pytest.raises(KeyError):
+            reading[f]
+
+def test_item_access_bare():
+    with pytest.raises(TypeError):
+        Reading(SERIAL, "1234")['value']
+
+def test_json_matches_dict():
+    for reading in ( Reading(SKY_IR, -18.5, -1850), Reading(Sensor("light"), 1234), Reading(SERIAL, "1234") ):
+        assert json.loads(dumps(reading)) == reading.to_dict()
@@ -0,0 +1,86 @@
+import csv, json, os, time, urllib.error, urllib.request
+
+import pytest
+
+from CloudWatcher import SKY_IR
+from CloudWatcher.readings import Reading
+from CloudWatcher.sinks import CSVSink, HTTPSink, JSONLinesSink, Sink, parse_sink
+
+# An interval as cw2mqtt hands it over, with the availability alert
+MESSAGES = [ { 'availability': b"online" }, { 'skyir': Reading(SKY_IR, -18.5, -1850) } ]
+
+
+def drain(sink: Sink, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while sink.pending or sink.busy:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def run(sink: Sink) -> Sink:
+    sink.start()
+    sink.publish(MESSAGES, "cloudwatcher")
+    sink.stop()
+    assert sink.written == 2 and sink.failed == 0
+    return sink
+
+def test_jsonl(tmp_path):
+    path = tmp_path / "cw.jsonl"
+    run(JSONLinesSink(str(path)))
+    docs = [ json.loads(line) for line in path.read_text().splitlines() ]
+    assert [ ( d['topic'], d['payload'] ) for d in docs ] == [
+        ( "cloudwatcher/availability", "online" ),
+        ( "cloudwatcher/skyir", { "name": "Sky IR Temp", "raw": -1850, "value": -18.5, "unit": "degC" } ),
+    ]
+
+def test_csv(tmp_path):
+    run(CSVSink(str(tmp_path)))
+    files = os.listdir(tmp_path)
+    assert len(files) == 1 and files[0].endswith(".csv")
+    with open(tmp_path / files[0], newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert rows[0]['topic'] == "cloudwatcher/availability"
+    assert rows[0]['value'] == "online"
+    assert json.loads(rows[0]['payload']) == "online"
+    assert float(rows[1]['value']) == -18.5
+
+def test_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    run(parse_sink(f"parquet:{tmp_path},linger=0"))
+    day, = os.listdir(tmp_path)
+    name, = os.listdir(tmp_path / day)
+    table = pq.read_table(str(tmp_path / day / name)).to_pydict()
+    assert json.loads(table['payload'][0]) == "online"
+    assert table['value'] == [ None, -18.5 ]
+
+def test_http():
+    sink = HTTPSink("127.0.0.1:0")
+    port = sink.server.server_address[1]
+    sink.start()
+    try:
+        sink.publish(MESSAGES, "cloudwatcher")
+        drain(sink)
+
+        def get(path: str):
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as r:
+                return json.loads(r.read())
+
+        assert get("/cloudwatcher/availability") == "online"
+        assert get("/cloudwatcher/skyir")['value'] == -18.5
+        assert get("/")["cloudwatcher/availability"] == "online"
+        assert set(get("/cloudwatcher")) == { "cloudwatcher/availability", "cloudwatcher/skyir" }
+        with pytest.raises(urllib.error.HTTPError):
+            get("/elsewhere")
+    finally:
+        sink.stop()
+
+def test_sink_is_abstract():
+    with pytest.raises(TypeError):
+        Sink("nowhere")
+
+def test_parse_sink():
+    with pytest.raises(ValueError):
+        parse_sink("ftp:/tmp")
+    with pytest.raises(ValueError):
+        parse_sink("jsonl:/tmp/x.jsonl,speed=3")
+    sink = parse_sink("jsonl:/tmp/x.jsonl,queue=5,policy=coalesce,batch=2,linger=0.5")
+    assert ( sink.size, sink.policy, sink.batch, sink.linger ) == ( 5, "coalesce", 2, 0.5 )
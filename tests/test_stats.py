@@ -0,0 +1,65 @@
+import pytest
+
+from CloudWatcher import RAIN_FREQ
+from CloudWatcher.readings import Reading
+from CloudWatcher.scheduler import Scheduler, SensorSchedule
+from CloudWatcher.stats import Accumulator, RingBuffer, clipped_summary
+
+RAIN_ONSET = [ 2750, 2751, 2749, 1200, 1190 ]
+
+
+def summary_of(values, sigma: float = 2.0):
+    acc = Accumulator(sigma)
+    acc.extend(values)
+    return acc.summary()
+
+def test_step_change_is_kept():
+    summary = summary_of(RAIN_ONSET)
+    assert summary.rejected == 0
+    assert summary.mean == pytest.approx(sum(RAIN_ONSET) / 5)
+    # Whatever the order
+    assert summary_of(sorted(RAIN_ONSET)).rejected == 0
+
+def test_quantized_input_is_kept():
+    assert summary_of([ -18.5, -18.5, -18.51, -18.49 ]).rejected == 0
+    summary = summary_of([ -18.5 ] * 9 + [ -18.51 ])
+    assert summary.rejected == 0 and summary.mean == pytest.approx(-18.501)
+
+def test_spike_is_rejected():
+    summary = summary_of([ 10, 10.1, 9.9, 10, 10.2, 9.8, 10, 50 ])
+    assert summary.rejected == 1 and summary.count == 7
+    assert summary.mean == pytest.approx(10)
+    # min and max cover every sample, max is the gust of a wind reading
+    assert ( summary.min, summary.max ) == ( 9.8, 50 )
+
+def test_sigma_zero_keeps_everything():
+    assert summary_of([ 10, 10.1, 9.9, 10, 10.2, 9.8, 10, 50 ], 0).rejected == 0
+
+def test_empty():
+    assert Accumulator().summary() is None
+    assert clipped_summary([]) is None
+    summary = summary_of([ 3 ])
+    assert ( summary.count, summary.mean, summary.stdev ) == ( 1, 3, 0 )
+
+def test_scheduler_keeps_a_step():
+    sched = Scheduler([ SensorSchedule(b"E!", 15, len(RAIN_ONSET)) ], 0)
+    for i, value in enumerate(RAIN_ONSET):
+        batch = sched.feed(b"E!", { 'rain_freq': Reading(RAIN_FREQ, value, value) }, i)
+    stats, last = batch
+    summary = stats['rain_freq'].summary()
+    assert summary.rejected == 0
+    assert summary.mean == pytest.approx(sum(RAIN_ONSET) / 5)
+
+def test_scheduler_publishes_a_new_level():
+    # Crossing the threshold publishes the new level at once, unclipped
+    sched = Scheduler([ SensorSchedule(b"E!", 15, 5, 1, 30) ], 0)
+    for i, value in enumerate(RAIN_ONSET[:3]):
+        assert sched.feed(b"E!", { 'rain_freq': Reading(RAIN_FREQ, value, value) }, i) is None
+    stats, last = sched.feed(b"E!", { 'rain_freq': Reading(RAIN_FREQ, 1200, 1200) }, 3)
+    assert stats['rain_freq'].summary().mean == 1200
+
+def test_ring_buffer():
+    ring = RingBuffer(3)
+    for x in range(5):
+        ring.append(x)
+    assert ring.values() == [ 2, 3, 4 ] and ring.mean == 3